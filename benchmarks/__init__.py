@@ -0,0 +1,7 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Benchmarks for the BIP server and client
+
+Run them from the top of the source tree, e.g. ``python3 -m benchmarks.e2e``.
+"""
@@ -0,0 +1,29 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Generates image catalogs for the benchmarks"""
+
+import os
+import random
+
+from PIL import Image
+
+
+def generate_catalog(rootdir, sizes, count=1, seed=0, first_handle=1000001):
+    """Writes count JPEG images of each width*height in sizes into rootdir,
+    named the way BIPServer looks them up, and returns {handle: (size, path)}.
+
+    The images are noise, so that they compress about as badly as photos do.
+    """
+    rng = random.Random(seed)
+    catalog = {}
+    handle = first_handle
+    for width, height in sizes:
+        for _ in range(count):
+            path = os.path.join(rootdir, "%07d_%ux%u.jpg" % (handle, width, height))
+            length = width * height * 3
+            data = rng.getrandbits(length * 8).to_bytes(length, "little")
+            Image.frombytes("RGB", (width, height), data).save(path, format="JPEG")
+            catalog["%07d" % handle] = ((width, height), path)
+            handle += 1
+    return catalog
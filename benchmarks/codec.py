@@ -0,0 +1,337 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks of the OBEX and BIP codec paths with a regression gate
+
+Measures operations per second and bytes allocated per operation (the peak
+traced by tracemalloc while one operation runs) for the header, message,
+application parameter and XML codecs, and compares them with a baseline
+file. Speeds are compared relative to a reference operation timed in the
+same run, which does not use the code being measured, so that a baseline
+recorded on one machine holds on another. The exit status is 1 if a
+benchmark is slower or allocates more than the thresholds allow, or if
+there is no baseline to compare with.
+
+    python3 -m benchmarks.codec --update     # record the baseline
+    python3 -m benchmarks.codec              # compare with it
+
+Benchmarks whose modules cannot be imported, such as the export_xml ones
+without the generated xml_data_binding package, are skipped, and only the
+benchmarks in both the run and the baseline are compared.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import struct
+import sys
+import time
+import tracemalloc
+
+import bipheaders as headers
+import common
+import protocol
+import requests
+import responses
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "codec_baseline.json")
+
+IMAGE_DESCRIPTOR = (b'<image-descriptor version="1.0">\n'
+                    b'<image encoding="JPEG" pixel="1280*960"/>\n'
+                    b'</image-descriptor>\n')
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    """Registers a function that returns the operation to be measured"""
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def _received(header):
+    """Returns header as it is built when it is received: from its data
+    without the header ID and length"""
+    prefix = 1 if header.code & 0x80 else 3
+    return type(header)(header.data[prefix:], encoded=True)
+
+
+def _request_headers():
+    return [headers.ConnectionId(1),
+            headers.Type(b"x-bt/img-img"),
+            headers.Img_Handle("1000001"),
+            headers.Img_Descriptor(IMAGE_DESCRIPTOR)]
+
+
+def _response_packet():
+    response = responses.Continue()
+    response.header_data = [headers.Length(1048576),
+                            headers.Body(bytes(4000))]
+    return response.encode()
+
+
+@benchmark
+def unicode_header_encode():
+    return lambda: headers.Name("1000001_1280x960.jpg")
+
+
+@benchmark
+def unicode_header_decode():
+    header = _received(headers.Name("1000001_1280x960.jpg"))
+    return header.decode
+
+
+@benchmark
+def data_header_encode():
+    return lambda: headers.Type(b"x-bt/img-img")
+
+
+@benchmark
+def data_header_decode():
+    header = _received(headers.Type(b"x-bt/img-img"))
+    return header.decode
+
+
+@benchmark
+def four_byte_header_encode():
+    return lambda: headers.Length(1048576)
+
+
+@benchmark
+def four_byte_header_decode():
+    header = _received(headers.Length(1048576))
+    return header.decode
+
+
+@benchmark
+def message_encode_request():
+    request = requests.GetFinal()
+    request.header_data = _request_headers()
+    return request.encode
+
+
+@benchmark
+def message_encode_body():
+    response = responses.Continue()
+    response.header_data = [headers.Length(1048576),
+                            headers.Body(bytes(4000))]
+    return response.encode
+
+
+@benchmark
+def frame_encoder_encode_body():
+    encoder = common.FrameEncoder()
+    response = responses.Continue()
+    response.header_data = [headers.Length(1048576),
+                            headers.Body.from_payload(bytes(4000))]
+    return lambda: encoder.encode(response)
+
+
+@benchmark
+def packetize_body():
+    engine = protocol.ServerProtocol(1024)
+    header_list = [headers.Length(102400),
+                   headers.End_Of_Body.from_payload(bytes(102400))]
+    return lambda: list(engine._packets(responses.Success(), header_list,
+                                        responses.Continue.code))
+
+
+@benchmark
+def read_headers():
+    request = requests.GetFinal()
+    request.header_data = _request_headers()
+    data = request.encode()[request.minimum_length:]
+    return lambda: requests.GetFinal().read_headers(data)
+
+
+@benchmark
+def read_data_body_views():
+    packet = _response_packet()
+
+    def run():
+        message = responses.Continue()
+        message.read_data(packet, body_views=True)
+        for header in message.header_data:
+            header.data
+    return run
+
+
+@benchmark
+def app_parameters_encode():
+    def run():
+        headers.App_Parameters({
+            "NbReturnedHandles": headers.NbReturnedHandles(10),
+            "ListStartOffset": headers.ListStartOffset(0),
+            "LatestCapturedImages": headers.LatestCapturedImages(1)})
+    return run
+
+
+@benchmark
+def app_parameters_decode():
+    data = headers.App_Parameters({
+        "NbReturnedHandles": headers.NbReturnedHandles(10),
+        "ListStartOffset": headers.ListStartOffset(0),
+        "LatestCapturedImages": headers.LatestCapturedImages(1)}).data[3:]
+
+    def run():
+        params = headers.App_Parameters(data, encoded=True).decode()
+        for param in params.values():
+            param.decode()
+    return run
+
+
+@benchmark
+def export_xml_capabilities():
+    import tools
+    root = tools.generate_dummy_imaging_capabilities()
+    return lambda: tools.export_xml(root)
+
+
+@benchmark
+def export_xml_images_listing():
+    import tools
+    root = tools.generate_dummy_images_listing()
+    return lambda: tools.export_xml(root)
+
+
+def reference():
+    """Returns the operation that speeds are measured relative to: plain
+    struct unpacking, as the codecs do, that does not use their code"""
+    data = bytes(range(256)) * 4
+
+    def run():
+        total = 0
+        for offset in range(0, len(data), 4):
+            total += struct.unpack_from(">I", data, offset)[0]
+        return total
+    return run
+
+
+def _timing(operation, loops):
+    start = time.perf_counter()
+    for _ in range(loops):
+        operation()
+    return time.perf_counter() - start
+
+
+def _calibrate(operation, min_time):
+    """Returns a number of loops of operation that takes at least min_time,
+    and the time it took"""
+    loops = 1
+    while True:
+        elapsed = _timing(operation, loops)
+        if elapsed >= min_time:
+            return loops, elapsed
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+
+def ops_per_sec(operation, base, min_time=0.1, repeat=7):
+    """Returns the best rates of repeat timings of at least min_time each of
+    operation and of base, timed in turn so that both see the same load"""
+    loops, best = _calibrate(operation, min_time)
+    base_loops, base_best = _calibrate(base, min_time)
+    for _ in range(repeat - 1):
+        best = min(best, _timing(operation, loops))
+        base_best = min(base_best, _timing(base, base_loops))
+    return loops / best, base_loops / base_best
+
+
+def bytes_per_op(operation, samples=21):
+    """Returns the median peak of memory allocated while one operation runs"""
+    peaks = []
+    for _ in range(samples):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        operation()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+    return int(statistics.median(peaks))
+
+
+def run(names):
+    """Measures the named benchmarks and returns {name: result}, leaving
+    out those that need a module that is not installed"""
+    base = reference()
+    results = {}
+    for name in names:
+        try:
+            operation = BENCHMARKS[name]()
+        except ImportError as err:
+            print("%-28s skipped: %s" % (name, err))
+            continue
+        # Warm up caches and lazily built state.
+        operation()
+        speed, reference_speed = ops_per_sec(operation, base)
+        results[name] = {"ops_per_sec": speed,
+                         "relative_speed": speed / reference_speed,
+                         "bytes_per_op": bytes_per_op(operation)}
+    return results
+
+
+def compare(results, baseline, speed_threshold, memory_threshold):
+    """Returns a list of messages for the results that regressed, comparing
+    only the benchmarks that are in both results and baseline"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["relative_speed"] < base["relative_speed"] * (1 - speed_threshold):
+            regressions.append("%s: %.3f of the reference speed, baseline %.3f"
+                               % (name, result["relative_speed"], base["relative_speed"]))
+        # Allow a few bytes of slack for allocator noise.
+        if result["bytes_per_op"] > base["bytes_per_op"] * (1 + memory_threshold) + 64:
+            regressions.append("%s: %u bytes/op, baseline %u bytes/op"
+                               % (name, result["bytes_per_op"], base["bytes_per_op"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OBEX/BIP codec micro-benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, default all")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON file")
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--speed-threshold", type=float, default=0.25,
+                        help="fail if ops/sec drops by more than this fraction")
+    parser.add_argument("--memory-threshold", type=float, default=0.10,
+                        help="fail if bytes/op grows by more than this fraction")
+    args = parser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+
+    results = run(names)
+    for name, result in results.items():
+        print("%-28s %12.0f ops/s %8.3f x reference %8u bytes/op"
+              % (name, result["ops_per_sec"], result["relative_speed"], result["bytes_per_op"]))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fobj:
+            baseline = json.load(fobj)
+
+    if args.update:
+        baseline.update(results)
+        with open(args.baseline, "w") as fobj:
+            json.dump(baseline, fobj, indent=2, sort_keys=True)
+            fobj.write("\n")
+        print("baseline written to %s" % args.baseline)
+        return 0
+
+    if not set(results) & set(baseline):
+        print("no baseline in %s; run with --update to record one" % args.baseline)
+        return 1
+    for name in sorted(set(results) - set(baseline)):
+        print("%s: no baseline, not compared" % name)
+
+    regressions = compare(results, baseline, args.speed_threshold, args.memory_threshold)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
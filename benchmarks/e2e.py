@@ -0,0 +1,231 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""End-to-end throughput and latency benchmark of BIPServer and BIPClient
+
+Starts a BIPServer on a local transport against a generated image catalog,
+connects a BIPClient once for each OBEX packet length and times each
+request: time to first byte (the first response), total latency and goodput
+(body bytes per second of total latency). Results are written as JSON so
+that runs can be compared. The exit status is 1 if any request failed.
+
+    python3 -m benchmarks.e2e --link coverart --output results.json
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import bipclient
+import bipheaders as headers
+import bipserver
+import client
+import linkemu
+import responses
+import transports
+
+from benchmarks.catalog import generate_catalog
+
+logger = logging.getLogger(__name__)
+
+COVERART_UUID = b"\x71\x63\xDD\x54\x4A\x7E\x11\xE2\xB4\x7C\x00\x50\xC2\x49\x00\x48"
+
+DEFAULT_SIZES = [(200, 200), (640, 480), (1280, 960)]
+DEFAULT_PACKET_LENGTHS = [1024, 4096, 0xffff]
+
+# operation name -> (function of (client, handle), needs an image handle)
+OPERATIONS = {
+    "get_capabilities": (lambda bip_client, handle: bip_client.get_capabilities(), False),
+    "get_images_list": (lambda bip_client, handle: bip_client.get_images_list(0xffff), False),
+    "get_image_properties": (lambda bip_client, handle: bip_client.get_image_properties(handle), True),
+    "get_image": (lambda bip_client, handle: bip_client.get_image(handle), True),
+    "get_linked_thumbnail": (lambda bip_client, handle: bip_client.get_linked_thumbnail(handle), True),
+}
+
+
+class TimedBIPClient(bipclient.BIPClient):
+    """BIPClient that records when the first response of each GET arrives"""
+
+    first_response_at = None
+
+    def _get(self, name=None, header_list=()):
+        self.first_response_at = None
+        for response in client.Client._get(self, name, header_list):
+            if self.first_response_at is None:
+                self.first_response_at = time.perf_counter()
+            yield response
+
+
+def make_transport(link):
+    """Returns the transport for a --link value: "unix" for plain unix
+    sockets, or the name of a linkemu profile"""
+    if link == "unix":
+        return transports.UnixTransport()
+    return linkemu.EmulatedLinkTransport(link, seed=0)
+
+
+def start_server(rootdir, transport, address):
+    """Serves rootdir on address from a background thread"""
+    bip_server = bipserver.BIPServer("", transport=transport)
+    bip_server.rootdir = rootdir
+    socket = transport.listen(address)
+    threading.Thread(target=bip_server.serve1, args=(socket,), daemon=True).start()
+    return bip_server
+
+
+def connect(transport, address, packet_length, srm=True):
+    """Returns a TimedBIPClient connected with the given maximum packet length"""
+    bip_client = TimedBIPClient(address, None, transport)
+    bip_client.max_packet_length = packet_length
+    bip_client.srm = srm
+    response = bip_client.connect(header_list=[headers.Target(COVERART_UUID)])
+    if not isinstance(response, responses.ConnectSuccess):
+        raise IOError("connect failed: %s" % response)
+    return bip_client
+
+
+def measure(bip_client, operation, handle):
+    """Runs operation once and returns (ttfb, latency, body bytes)"""
+    function, _ = OPERATIONS[operation]
+    start = time.perf_counter()
+    result = function(bip_client, handle)
+    end = time.perf_counter()
+    if not isinstance(result, tuple):
+        raise IOError("%s failed: %s" % (operation, type(result).__name__))
+    _, body = result
+    return bip_client.first_response_at - start, end - start, len(body)
+
+
+def summarise(values):
+    """Returns min/median/max of values in milliseconds"""
+    if not values:
+        return None
+    return {"min": min(values) * 1000,
+            "median": statistics.median(values) * 1000,
+            "max": max(values) * 1000}
+
+
+def run_case(state, operation, handle, runs):
+    """Runs one operation runs times and returns its result record"""
+    ttfbs, latencies, sizes, errors = [], [], [], []
+    for _ in range(runs):
+        try:
+            ttfb, latency, size = measure(state["client"], operation, handle)
+        except Exception as err:
+            errors.append(str(err) or type(err).__name__)
+            # A failed request may leave the session unusable; start again.
+            state["client"].socket.close()
+            state["client"] = connect(*state["connect_args"])
+            continue
+        ttfbs.append(ttfb)
+        latencies.append(latency)
+        sizes.append(size)
+
+    goodput = None
+    if latencies:
+        goodput = sum(sizes) / sum(latencies)
+    return {"ttfb_ms": summarise(ttfbs),
+            "latency_ms": summarise(latencies),
+            "goodput_bytes_per_s": goodput,
+            "body_bytes": sizes[0] if sizes else None,
+            "runs": len(latencies),
+            "errors": errors}
+
+
+def run(link, sizes, packet_lengths, operations, runs, srm=True):
+    """Runs the benchmark and returns the results as a dict"""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bip-bench-") as tmpdir:
+        rootdir = os.path.join(tmpdir, "images")
+        os.mkdir(rootdir)
+        catalog = generate_catalog(rootdir, sizes)
+
+        transport = make_transport(link)
+        address = os.path.join(tmpdir, "bip.sock")
+        start_server(rootdir, transport, address)
+
+        for packet_length in packet_lengths:
+            connect_args = (transport, address, packet_length, srm)
+            state = {"client": connect(*connect_args), "connect_args": connect_args}
+            negotiated = state["client"].protocol.max_length()
+
+            for operation in operations:
+                _, per_image = OPERATIONS[operation]
+                cases = catalog.items() if per_image else [(None, (None, None))]
+                for handle, (size, path) in cases:
+                    logger.info("%s handle=%s packet_length=%u", operation, handle, packet_length)
+                    record = {"operation": operation,
+                              "handle": handle,
+                              "image_pixels": "%u*%u" % size if size else None,
+                              "image_bytes": os.path.getsize(path) if path else None,
+                              "packet_length": packet_length,
+                              "negotiated_packet_length": negotiated}
+                    record.update(run_case(state, operation, handle, runs))
+                    results.append(record)
+
+            state["client"].disconnect()
+
+    return {"benchmark": "bip-e2e",
+            "created": time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()),
+            "link": link,
+            "srm": srm,
+            "runs": runs,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results}
+
+
+def parse_sizes(value):
+    return [tuple(int(n) for n in size.split("*")) for size in value.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BIP end-to-end throughput and latency benchmark")
+    parser.add_argument("--link", default="coverart", choices=["unix"] + sorted(linkemu.profiles),
+                        help="plain unix sockets or an emulated Bluetooth link profile")
+    parser.add_argument("--sizes", type=parse_sizes, default=DEFAULT_SIZES,
+                        help="image sizes as W*H,W*H,...")
+    parser.add_argument("--packet-lengths", default=DEFAULT_PACKET_LENGTHS,
+                        type=lambda value: [int(n, 0) for n in value.split(",")],
+                        help="OBEX maximum packet lengths the client connects with")
+    parser.add_argument("--operations", default=list(OPERATIONS),
+                        type=lambda value: value.split(","),
+                        help="comma separated operations, default all")
+    parser.add_argument("--runs", type=int, default=5, help="repetitions of each request")
+    parser.add_argument("--no-srm", dest="srm", action="store_false",
+                        help="do not ask for Single Response Mode")
+    parser.add_argument("--output", default="bip_e2e.json", help="JSON file to write, - for stdout")
+    args = parser.parse_args(argv)
+
+    for operation in args.operations:
+        if operation not in OPERATIONS:
+            parser.error("unknown operation %s" % operation)
+
+    # BIPServer and BIPClient print to stdout; keep it for the report.
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args.link, args.sizes, args.packet_lengths, args.operations, args.runs, args.srm)
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as fobj:
+            json.dump(report, fobj, indent=2)
+
+    failed = [record for record in report["results"] if record["errors"]]
+    for record in failed:
+        logger.error("%s handle=%s packet_length=%u: %u errors, first: %s", record["operation"],
+                     record["handle"], record["packet_length"], len(record["errors"]), record["errors"][0])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(name)s %(levelname)-8s %(message)s')
+    sys.exit(main())
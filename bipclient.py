@@ -3,12 +3,16 @@
 # -*- coding: utf-8 -*-
 """Implementation of bipclient to test bipserver ( for cover art of AVRCP )"""
 
+import asyncio
 import atexit
-import io
+import collections
+import concurrent.futures
 import logging
 import os
+import queue
 import readline
 import sys
+import time
 
 from optparse import make_option
 from PIL import Image
@@ -16,26 +20,38 @@ import bluetooth
 import cmd2
 
 import tools
+import transports
 import bipheaders as headers
 
 
 #from PyOBEX import client, responses
 import client
 import responses
+from protocol import ProtocolError
 
 
-from xml_data_binding import image_descriptor, image_handles_descriptor, images_listing
+from xml_data_binding import image_descriptor, image_handles_descriptor, image_properties, images_listing
 
 logger = logging.getLogger(__name__)
 
 sock = None
 
+# L2CAP options of the cover art client: ERTM (mode 3) with up to 10
+# transmissions of each frame and a transmit window of 5 frames.
+L2CAP_OPTIONS = {"omtu": 4096, "imtu": 4096, "mode": 3, "max_tx": 10, "tx_win_size": 5}
+
+# Target header value of the cover art service
+COVERART_TARGET = b"\x71\x63\xDD\x54\x4A\x7E\x11\xE2\xB4\x7C\x00\x50\xC2\x49\x00\x48"
+
 class BIPClient(client.Client):
     """Basic Imaging Profile Client"""
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, transport=None):
         print (address, port)
-        client.Client.__init__(self, address, port)
+        if transport is None:
+            transport = transports.L2CAPTransport(**L2CAP_OPTIONS)
+        client.Client.__init__(self, address, port, transport)
+        self.srm = True
 
     def get_capabilities(self):
         """Requests level of support for various imaging capabilities"""
@@ -48,28 +64,23 @@ class BIPClient(client.Client):
         """Requests list of handles for available images along with file info like cdate, mdate etc"""
         logger.info("get_images_list requested. params = %s", locals())
 
-        print(headers.NbReturnedHandles(nb_returned_handles))
-
         app_parameters_dict = {
             "NbReturnedHandles": headers.NbReturnedHandles(nb_returned_handles),
             "ListStartOffset": headers.ListStartOffset(list_startoffset),
             "LatestCapturedImages": headers.LatestCapturedImages(latest_captured_images)
         }
 
-        # construct the image_handles_descriptor xml using xml_data_binding
+        # construct the image_handles_descriptor xml using xml_data_binding;
+        # empty filtering parameters select all images
         root = image_handles_descriptor.image_handles_descriptor()
-
-        root.filtering_parameters = image_handles_descriptor.filtering_parameters(created="19990101T000000Z-20010101T235959Z")
+        root.filtering_parameters = image_handles_descriptor.filtering_parameters()
 
         img_handles_desc_data = tools.export_xml(root)
+        logger.debug("app parameters = %s, image handles descriptor = %s", app_parameters_dict, img_handles_desc_data)
 
-        print (app_parameters_dict, img_handles_desc_data)
-
-        header_list = [headers.Type(b'x-bt/img-listing')] #,
-                       #headers.App_Parameters(app_parameters_dict),
-                       #headers.Img_Descriptor(img_handles_desc_data)]
-
-        print(header_list)
+        header_list = [headers.Type(b'x-bt/img-listing'),
+                       headers.App_Parameters(app_parameters_dict),
+                       headers.Img_Descriptor(img_handles_desc_data.encode('utf-8'))]
 
         return self.get(header_list=header_list)
 
@@ -79,8 +90,9 @@ class BIPClient(client.Client):
         header_list = [headers.Type(b'x-bt/img-properties'), headers.Img_Handle(img_handle)]
         return self.get(header_list=header_list)
 
-    def get_image(self, image_handle):
-        """Requests an Image with specified format and encoding"""
+    def get_image(self, image_handle, sink=None):
+        """Requests an Image with specified format and encoding. The image
+        is passed to sink as it arrives if one is given; see Client.get."""
         logger.info("get_image requested")
         img_descriptor_object = image_descriptor.image_descriptor()
 
@@ -91,13 +103,227 @@ class BIPClient(client.Client):
                        headers.Img_Handle(image_handle),
                        headers.Img_Descriptor( xml.encode('utf8') )]
 
-        return self.get(header_list=header_list)
+        return self.get(header_list=header_list, sink=sink)
 
-    def get_linked_thumbnail(self, image_handle):
+    def get_linked_thumbnail(self, image_handle, sink=None):
         """Requests thumbnail version of the images"""
         logger.info("get_linked_thumbnail requested")
         header_list = [headers.Type(b'x-bt/img-thm'), headers.Img_Handle(image_handle)]
-        return self.get(header_list=header_list)
+        return self.get(header_list=header_list, sink=sink)
+
+    # kind -> (method, default decoder of the body) for fetch_batch
+    batch_requests = {
+        "properties": (get_image_properties,
+                       lambda data: image_properties.parseString(data, silence=True)),
+        "thumbnail": (get_linked_thumbnail, bytes),
+        "image": (get_image, bytes),
+    }
+
+    def fetch_batch(self, handles, kinds=("properties", "thumbnail"), decoders=None):
+        """Fetches each kind of object ("properties", "thumbnail" or "image")
+        for every handle and yields (handle, kind, result) tuples in request
+        order as they become available.
+
+        One OBEX operation runs at a time, so each request is sent as soon as
+        the previous one is complete, and its result is decoded on a worker
+        thread meanwhile. result is the decoded object, or the failure
+        response. decoders maps kinds to functions of the body data that
+        replace the default ones: an image_properties object for properties
+        and the bytes of images.
+        """
+        decoders = dict(decoders or {})
+        pending = collections.deque()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            for handle in handles:
+                for kind in kinds:
+                    method, decoder = self.batch_requests[kind]
+                    decoder = decoders.get(kind, decoder)
+                    result = method(self, handle)
+                    if isinstance(result, responses.FailureResponse):
+                        future = concurrent.futures.Future()
+                        future.set_result(result)
+                    else:
+                        future = executor.submit(decoder, result[1])
+                    pending.append((handle, kind, future))
+
+                    while pending and pending[0][2].done():
+                        handle_, kind_, future = pending.popleft()
+                        yield handle_, kind_, future.result()
+
+            while pending:
+                handle_, kind_, future = pending.popleft()
+                yield handle_, kind_, future.result()
+
+class AsyncBIPClient(client.AsyncClient, BIPClient):
+    """Basic Imaging Profile Client for asyncio
+
+    connect, get_capabilities, get_images_list, get_image_properties,
+    get_image and get_linked_thumbnail are coroutines; see client.AsyncClient
+    for how cancelled requests are aborted.
+    """
+
+    async def fetch_batch(self, handles, kinds=("properties", "thumbnail"), decoders=None):
+        """Asynchronous generator version of BIPClient.fetch_batch. Results
+        are decoded in the event loop's default executor."""
+        loop = asyncio.get_running_loop()
+        decoders = dict(decoders or {})
+        pending = collections.deque()
+
+        for handle in handles:
+            for kind in kinds:
+                method, decoder = self.batch_requests[kind]
+                decoder = decoders.get(kind, decoder)
+                result = await method(self, handle)
+                if isinstance(result, responses.FailureResponse):
+                    future = loop.create_future()
+                    future.set_result(result)
+                else:
+                    future = loop.run_in_executor(None, decoder, result[1])
+                pending.append((handle, kind, future))
+
+                while pending and pending[0][2].done():
+                    handle_, kind_, future = pending.popleft()
+                    yield handle_, kind_, future.result()
+
+        while pending:
+            handle_, kind_, future = pending.popleft()
+            yield handle_, kind_, await future
+
+
+class ChannelStats(object):
+    """Counters of one channel of a BIPClientPool"""
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.errors = 0
+        self.reconnects = 0
+
+    @property
+    def throughput(self):
+        """Body bytes returned in bytes or a bytearray per second of
+        requests on the channel"""
+        if not self.busy_time:
+            return 0.0
+        return self.bytes / self.busy_time
+
+    def __repr__(self):
+        return ("ChannelStats(requests=%i, bytes=%i, throughput=%.0f B/s, errors=%i, reconnects=%i)"
+                % (self.requests, self.bytes, self.throughput, self.errors, self.reconnects))
+
+
+class BIPClientPool(object):
+    """Keeps several OBEX sessions (channels) to one cover art server open and
+    spreads independent requests across them.
+
+    pool = BIPClientPool(address, port=0x1021, size=3, transport=None)
+
+    Each channel is a BIPClient with its own L2CAP connection. Channels stay
+    connected between requests; one whose connection fails is reconnected and
+    the request retried once. The counters of each channel are kept in stats.
+    """
+
+    def __init__(self, address, port=0x1021, size=3, transport=None, client_class=BIPClient):
+        self.address = address
+        self.port = port
+        self.size = size
+        self.transport = transport
+        self.client_class = client_class
+        self.channels = [None] * size
+        self.stats = [ChannelStats() for _ in range(size)]
+        self._idle = queue.Queue()
+        for i in range(size):
+            self._idle.put(i)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """Connects all channels"""
+        for i in range(self.size):
+            if self.channels[i] is None:
+                self._connect(i)
+
+    def _connect(self, i):
+        bip_client = self.client_class(self.address, self.port, self.transport)
+        result = bip_client.connect(header_list=[headers.Target(COVERART_TARGET)])
+        if not isinstance(result, responses.ConnectSuccess):
+            raise IOError("channel %i: connect failed: %s" % (i, result))
+        self.channels[i] = bip_client
+        logger.info("channel %i connected", i)
+
+    def _drop(self, i):
+        bip_client, self.channels[i] = self.channels[i], None
+        try:
+            bip_client.socket.close()
+        except (AttributeError, OSError):
+            pass
+
+    def call(self, function, *args):
+        """Runs function(client, *args) on the first idle channel and returns
+        its result"""
+        i = self._idle.get()
+        try:
+            return self._call(i, function, args)
+        finally:
+            self._idle.put(i)
+
+    def _call(self, i, function, args):
+        stats = self.stats[i]
+        for attempt in range(2):
+            if self.channels[i] is None:
+                self._connect(i)
+                stats.reconnects += 1
+            start = time.monotonic()
+            try:
+                result = function(self.channels[i], *args)
+            except (OSError, ProtocolError) as err:
+                stats.errors += 1
+                logger.warning("channel %i failed: %s", i, err)
+                self._drop(i)
+                if attempt:
+                    raise
+                continue
+            finally:
+                stats.busy_time += time.monotonic() - start
+            stats.requests += 1
+            # Data passed to a file or callable sink is not counted.
+            if isinstance(result, tuple) and isinstance(result[1], (bytes, bytearray)):
+                stats.bytes += len(result[1])
+            return result
+
+    def map(self, function, items):
+        """Runs function(client, item) for each item, spread across the
+        channels, and yields (item, result) tuples as they complete"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = {executor.submit(self.call, function, item): item for item in items}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+
+    def fetch(self, handles, kind="thumbnail"):
+        """Fetches one kind of object (see BIPClient.fetch_batch) for each
+        handle and yields (handle, result) tuples as they complete"""
+        method, _ = BIPClient.batch_requests[kind]
+        return self.map(method, handles)
+
+    def close(self):
+        """Disconnects all channels"""
+        for i, bip_client in enumerate(self.channels):
+            if bip_client is None:
+                continue
+            try:
+                bip_client.disconnect()
+            except (OSError, ProtocolError) as err:
+                logger.warning("channel %i: disconnect failed: %s", i, err)
+            self.channels[i] = None
+        logger.info("channel stats: %s", self.stats)
+
 
 class REPL(cmd2.Cmd):
     """REPL to use BIP client"""
@@ -114,6 +340,7 @@ class REPL(cmd2.Cmd):
         self.intro = self.colorize("Welcome to the Basic Imaging Profile!", "green")
         
         self.client = None
+        self.transport = None
         self._valid_image_handle = None
         self._store_history()
         #cmd2.set_use_arg_list(False) # If you want to be able to pass arguments with spaces to scripts, https://cmd2.readthedocs.io/_/downloads/en/0.7.8/pdf/
@@ -159,34 +386,13 @@ class REPL(cmd2.Cmd):
 
         host = server_address
         port=0x1021
-        self.client = BIPClient(host, port) 
-        uuid = b"\x71\x63\xDD\x54\x4A\x7E\x11\xE2\xB4\x7C\x00\x50\xC2\x49\x00\x48"
+        self.client = BIPClient(host, port, self.transport)
+        uuid = COVERART_TARGET
         logger.info("Connecting to bip server = (%s, %s)", host, port)
-        sock=bluetooth.BluetoothSocket(bluetooth.L2CAP)
-        #bd_addr = "B8:27:EB:C6:CA:CE"
-        #port = 0x1021
-        opt = bluetooth.get_l2cap_options(sock)
-
-        opt[0] = 4096
-        opt[1] = 4096
-        #opt[2] = 0x2000 #flush_to
-        opt[3] = 3  #mode
-        opt[5] = 10 #max_tx
-        opt[6] = 5  #tx_win_size
-        print(opt)
-
-        bluetooth.set_l2cap_options(sock, opt)
-
-        sock.connect( (host, port) )
-
-        opt = bluetooth.get_l2cap_options(sock)
-        print (opt)
-        #bluetooth.set_l2cap_mtu (sock, 8087)
-        self.client.set_socket ( sock )
 
         print(uuid)
         result = self.client.connect ( header_list = [headers.Target(uuid)] )
-        print (bluetooth.get_l2cap_options(sock) )
+        print (self.client.transport.mtu(self.client.socket))
         if not isinstance(result, responses.ConnectSuccess):
             logger.error("Connect Failed, Terminating the bip client..")
             return
@@ -248,29 +454,30 @@ class REPL(cmd2.Cmd):
     def do_getimage(self, line, opts = {}):
         """Gets image for given image_handle"""
         logger.debug("Requesting for image of handle = %s", line)
-        result = self.client.get_image(line)
+        # The image is written to the file as it arrives, as sent.
+        filename = "%s_.jpg" % line
+        with open(filename, "wb") as fobj:
+            result = self.client.get_image(line, sink=fobj)
         if isinstance(result, responses.FailureResponse):
+            os.remove(filename)
             logger.error("GetImage failed ... reason = %s", result)
             return
-        header, image_data = result
-        im = Image.open(io.BytesIO(image_data))
-        im.save("%s_.jpg" % line)
-        logger.debug("getimage response. image saved in %s_.jpg" % line)
-        im.show()
+        logger.debug("getimage response. image saved in %s" % filename)
+        Image.open(filename).show()
 
     #@options([], arg_desc="image_handle")
     def do_getthumbnail(self, line, opts = {}):
         """Gets Thumbnail version of image for given image_handle"""
         logger.debug("Requesting for thumbnail image of handle = %s", line)
-        result = self.client.get_linked_thumbnail(line)
+        filename = "%s_thumbnail_image.jpg" % line
+        with open(filename, "wb") as fobj:
+            result = self.client.get_linked_thumbnail(line, sink=fobj)
         if isinstance(result, responses.FailureResponse):
+            os.remove(filename)
             logger.error("GetThumbnail failed ... reason = %s", result)
             return
-        header, image_data = result
-        im = Image.open(io.BytesIO(image_data))
-        im.save("%s_thumbnail_image.jpg" % line)
-        logger.debug("getthumbnail response. image saved in %s_thumbnail_image.jpg" %  line)
-        im.show()
+        logger.debug("getthumbnail response. image saved in %s" % filename)
+        Image.open(filename).show()
 
     #@options([], arg_desc="server_address")
     def do_test(self, line, opts = {}):
@@ -176,22 +176,21 @@ def extended_decode(self):
     """Decodes the App_Parameters header data into AppParamProperties dict"""
     # size of tagid = 1 byte
     # size of length = 1 byte
-    data = self.data
+    data = bytes(self.data)
     res_dict = {}
-    while data:
-        tagid = ord(data[0])
-        length = ord(data[1])
+    i = 0
+    while i < len(data):
+        tagid = data[i]
+        length = data[i + 1]
         app_param_class = app_parameters_dict[tagid]
-        res_dict[app_param_class.__name__] = app_param_class(data[:length + 2], encoded=True)
-        data = data[length + 2:]
+        res_dict[app_param_class.__name__] = app_param_class(data[i:i + length + 2], encoded=True)
+        i += length + 2
     return res_dict
 
 
 def extended_encode(self, data_dict):
     """Encodes the AppParamProperties dict + super().encode"""
-    data = ""
-    for item in data_dict.values():
-        data += item.data
+    data = b"".join(item.data for item in data_dict.values())
     return struct.pack(">BH", self.code, len(data) + 3) + data
 
 
@@ -8,26 +8,31 @@ import dbus.mainloop.glib
 
 
 import argparse
-import copy
+import asyncio
+import concurrent.futures
 import logging
-import operator
+import multiprocessing
 import os
+import signal
 import sys
+import tempfile
+import threading
 
 import dateutil.parser
 
 import bluetooth
 import time
+import imagecatalog
+import imagewatcher
 import tools
+import transports
+import imagecache
 import bipheaders as headers
 
 import server
 import responses
 import requests
 import common
-import glob
-
-from PIL import Image
 
 from xml_data_binding import image_descriptor, image_handles_descriptor, images_listing
 
@@ -40,26 +45,86 @@ logger = logging.getLogger(__name__)
 
 socket = None
 
+# L2CAP options of the cover art service: ERTM (mode 3) with up to 10
+# transmissions of each frame and a transmit window of 5 frames.
+L2CAP_OPTIONS = {"omtu": 1024, "imtu": 1024, "mode": 3, "max_tx": 10, "tx_win_size": 5}
+
 class BIPServer(server.Server):
-    def __init__(self, device_address, rootdir=""):
-        server.Server.__init__(self, device_address)
+    def __init__(self, device_address, rootdir="", transport=None):
+        if transport is None:
+            transport = transports.L2CAPTransport(**L2CAP_OPTIONS)
+        server.Server.__init__(self, device_address, transport)
         if len(rootdir) == 0: 
             self.rootdir = os.getcwd()
         else:
             self.rootdir = "%s/%s" % ( os.getcwd(), rootdir )
         logger.info (self.rootdir)
+        # Connections served at once by serve1, and requests processed at
+        # once by serve_async.
+        self.max_connections = 4
+        # Serialises the creation of dummy images missing from rootdir,
+        # which all connections share.
+        self._rootdir_lock = threading.Lock()
+        self._image_index = None
+        self._dummy_listing = None
+        # imagecatalog.CatalogStore that keeps the image index between runs,
+        # if any; set it before the index is first used.
+        self.catalog = None
+        # Process that built the index, and the imagewatcher.ImageWatcher
+        # keeping it up to date in this process, if any
+        self._index_pid = None
+        self._watcher = None
+        # Generation of the index published by a watcher in another process,
+        # as a multiprocessing.Value, and the last one that this process
+        # has followed
+        self._shared_generation = None
+        self._followed_generation = 0
+        # Cover art runs over L2CAP (GOEP 2.0), so stream image bodies in
+        # Single Response Mode to clients that ask for it.
+        self.srm = True
+        # Bytes of an image that may be read ahead of the link for each
+        # connection; 0 reads each packet when it is made.
+        self.read_ahead = 0x20000
+        # imagecache.ImageCache shared by the worker processes, if any;
+        # create it before they are started.
+        self.image_cache = None
+
+    def create_session(self, socket):
+        """Override: also counts the reads ahead of the link for the connection."""
+        session = server.Server.create_session(self, socket)
+        session.read_ahead_stats = common.ReadAheadStats()
+        # Keys of the image cache entries that the response being sent uses
+        session.cached_images = []
+        return session
+
+    def session_closed(self, session):
+        """Override: releases the image cache entries of the last response."""
+        self._release_cached_images(session)
+
+    def _release_cached_images(self, session):
+        while session.cached_images:
+            self.image_cache.release(session.cached_images.pop())
+
+    def read_ahead_stats(self, socket):
+        """Returns the common.ReadAheadStats of the connection on socket."""
+        return self.session(socket).read_ahead_stats
 
     def process_request(self, connection, request):
         """Processes the request from the connection."""
         logger.info("\n-----------------------------------")
+        # The response to the previous request has been sent.
+        self._release_cached_images(self.session(connection))
         if isinstance(request, requests.Connect):
             logger.debug("Request type = connect")
             self.connect(connection, request)
-            logger.debug(self.remote_info.max_packet_length)
-            logger.debug(self.remote_info.minimum_length)
+            logger.debug(request.max_packet_length)
+            logger.debug(request.minimum_length)
         elif isinstance(request, requests.Disconnect):
             logger.debug("Request type = disconnect")
             self.disconnect(connection, request)
+            logger.info("read-ahead: %s", self.read_ahead_stats(connection))
+            if self.image_cache is not None:
+                logger.info("image cache: %s", self.image_cache.stats)
         elif isinstance(request, requests.Put):
             logger.debug("Request type = put")
             self.put(connection, request)
@@ -142,7 +207,10 @@ class BIPServer(server.Server):
 
     def _decode_app_params(self, app_params):
         """This will decode or populate app_params with default value."""
-        decoded_app_params = {}
+        # defaults for parameters the client leaves out: all handles from the start
+        decoded_app_params = {"NbReturnedHandles": 0xffff,
+                              "ListStartOffset": 0,
+                              "LatestCapturedImages": 0}
         if "NbReturnedHandles" in app_params:
             decoded_app_params["NbReturnedHandles"] = app_params["NbReturnedHandles"].decode()
         if "ListStartOffset" in app_params:
@@ -156,76 +224,96 @@ class BIPServer(server.Server):
         logger.info("_get_capabilities invoked")
         # TODO: replace with real data
         capabilities_object = tools.generate_dummy_imaging_capabilities()
-        header_list = [headers.End_Of_Body(tools.export_xml(capabilities_object))]
+        header_list = [headers.End_Of_Body(tools.export_xml(capabilities_object).encode('utf-8'))]
         self.send_response(socket, responses.Success(), header_list)
 
     def _get_images_list(self, socket, decoded_header):
         """Returns list of handles for available images along with file info like cdate, mdate etc"""
         logger.info("_get_images_list invoked")
-        app_params = self._decode_app_params(decoded_header["App_Parameters"])
+        app_params = self._decode_app_params(decoded_header.get("App_Parameters", {}))
 
-        # TODO: replace with real data
-        images_listing_object = tools.generate_dummy_images_listing()
+        listing = self._image_listing()
 
         nb_returned_handles = app_params["NbReturnedHandles"]
         list_startoffset = app_params["ListStartOffset"]
         latest_captured_images = app_params["LatestCapturedImages"]
 
-        # filtering images of images_listing using filtering_parameters
-        img_handles_desc = image_handles_descriptor.parseString(decoded_header["Img_Descriptor"], silence=True)
-        filtered_images_listing = self._filter_images_listing(img_handles_desc, images_listing_object)
+        # filtering images of the listing using filtering_parameters
+        if "Img_Descriptor" in decoded_header:
+            img_handles_desc = image_handles_descriptor.parseString(decoded_header["Img_Descriptor"], silence=True)
+        else:
+            img_handles_desc = image_handles_descriptor.image_handles_descriptor()
+        positions = self._filter_image_listing(img_handles_desc, listing, latest_captured_images)
         if nb_returned_handles == 0:
             nb_returned_handles_hdr = {"NbReturnedHandles":
-                                       headers.NbReturnedHandles(len(filtered_images_listing.image))
+                                       headers.NbReturnedHandles(len(positions))
                                        }
             empty_image_listing = images_listing.images_listing()
             header_list = [headers.App_Parameters(nb_returned_handles_hdr),
-                           headers.Img_Descriptor(tools.export_xml(img_handles_desc)),
-                           headers.End_Of_Body(tools.export_xml(empty_image_listing))]
+                           headers.Img_Descriptor(tools.export_xml(img_handles_desc).encode('utf-8')),
+                           headers.End_Of_Body(tools.export_xml(empty_image_listing).encode('utf-8'))]
 
         else:
-            # restrict the images of images_listing using ListStartOffset and NbReturnedHandles
-            restricted_images_listing = self._restricted_images_listing(filtered_images_listing,
-                                                                        list_startoffset,
-                                                                        nb_returned_handles)
-
-            # order descending based on created time to get latest captured images
-            if latest_captured_images:
-                restricted_images_listing.image.sort(key=operator.attrgetter("created"), reverse=True)
+            # restrict the images using ListStartOffset and NbReturnedHandles,
+            # latest captured images first if asked for
+            entries = listing.page(positions, list_startoffset, nb_returned_handles, latest_captured_images)
+            restricted_images_listing = images_listing.images_listing()
+            for entry in entries:
+                restricted_images_listing.image.append(
+                    images_listing.image(handle=entry.handle,
+                                         created=tools.format_datetime(entry.created),
+                                         modified=tools.format_datetime(entry.modified)))
 
             nb_returned_handles_hdr = {"NbReturnedHandles":
-                                       headers.NbReturnedHandles(len(restricted_images_listing.image))
+                                       headers.NbReturnedHandles(len(entries))
                                        }
             header_list = [headers.App_Parameters(nb_returned_handles_hdr),
-                           headers.Img_Descriptor(tools.export_xml(img_handles_desc)),
-                           headers.End_Of_Body(tools.export_xml(restricted_images_listing))]
+                           headers.Img_Descriptor(tools.export_xml(img_handles_desc).encode('utf-8')),
+                           headers.End_Of_Body(tools.export_xml(restricted_images_listing).encode('utf-8'))]
         self.send_response(socket, responses.Success(), header_list)
 
-    @staticmethod
-    def _restricted_images_listing(images_listing, list_startoffset, nb_returned_handles):
-        images_listing_copy = copy.deepcopy(images_listing)
-        images_listing_copy.image = images_listing_copy.image[list_startoffset:
-                                                              list_startoffset + nb_returned_handles]
-        return images_listing_copy
+    def _image_listing(self):
+        """Returns the imagecatalog.ImageListing of the images in rootdir, or
+        of the dummy images listing if there are none"""
+        index = self.image_index
+        if len(index):
+            return index.listing()
+        if self._dummy_listing is None:
+            entries = []
+            for image in tools.generate_dummy_images_listing().image:
+                created = dateutil.parser.parse(image.created).timestamp()
+                modified = dateutil.parser.parse(image.modified).timestamp() if image.modified else created
+                entries.append(imagecatalog.ImageEntry(image.handle, None, 0, None, None, None,
+                                                       created, modified, None, None))
+            self._dummy_listing = imagecatalog.ImageListing(entries)
+        return self._dummy_listing
 
     @staticmethod
-    def _filter_images_listing(img_handles_desc, images_listing):
-        """filters the images_listing based on filtering_parameters in img_handles_desc"""
+    def _filter_image_listing(img_handles_desc, listing, latest_captured_images):
+        """Returns the positions in listing of the images that match the
+        filtering_parameters in img_handles_desc. The parameters are parsed
+        once; the created and modified ranges are looked up by bisection."""
         filtering_parameters = img_handles_desc.filtering_parameters
-        images_listing_copy = copy.deepcopy(images_listing)
-        for image in images_listing.image:
-            match = True
+        created = modified = None
+        conditions = []
+        if filtering_parameters is not None:
             if filtering_parameters.created:
-                match &= (dateutil.parser.parse(image.created) in tools.DatetimeRange(filtering_parameters.created))
+                created = tools.timestamp_range(filtering_parameters.created)
             if filtering_parameters.modified:
-                match &= (dateutil.parser.parse(image.modified) in tools.DatetimeRange(filtering_parameters.modified))
+                modified = tools.timestamp_range(filtering_parameters.modified)
             if filtering_parameters.encoding:
-                match &= (image.encoding == filtering_parameters.encoding)
+                encoding = filtering_parameters.encoding
+                conditions.append(lambda entry: entry.encoding == encoding)
             if filtering_parameters.pixel:
-                match &= (tools.Pixel(image.pixel) in tools.PixelRange(filtering_parameters.pixel))
-            if not match:
-                images_listing_copy.image.remove(image)
-        return images_listing_copy
+                pixel_range = tools.PixelRange(filtering_parameters.pixel)
+                smallest = (pixel_range.start.height, pixel_range.start.width)
+                largest = (pixel_range.end.height, pixel_range.end.width)
+                conditions.append(lambda entry: entry.width is not None and
+                                  smallest <= (entry.height, entry.width) <= largest)
+        accept = None
+        if conditions:
+            accept = lambda entry: all(condition(entry) for condition in conditions)
+        return listing.select(created, modified, accept, latest_captured_images)
 
     def _get_image_properties(self, socket, decoded_header):
         # TODO: replace with real data and get the properties for specified handle
@@ -235,17 +323,16 @@ class BIPServer(server.Server):
         if len(handle) != 7: # not in tools.DUMMY_IMAGE_HANDLES:
             self.send_response(socket, responses.Not_Found(), [])
             return
-        filelist = glob.glob("%s/%s_*.jpg" % (self.rootdir, handle) )
-        if len(filelist)==0:
-            im_file_name = "%s/%s_.jpg" % (self.rootdir, handle)
-            imagefile = tools.generate_dummy_image(handle, thumbnail=True)
-            file1 = open(im_file_name, 'wb'); file1.write(imagefile); file1.close()
-        else:
-            im_file_name = filelist[0]
-        fs=os.path.getsize(im_file_name)
+        entry = self._image_entry(handle, lambda: tools.generate_dummy_image(handle, thumbnail=True))
+        im_file_name = entry.path
+        fs = entry.size
         logger.info( "image %s %u" % (im_file_name, fs) )
 
-        img_prop_obj = tools.generate_image_properties(handle, fs)
+        if entry.width is not None:
+            img_prop_obj = tools.generate_image_properties(handle, fs, "%u*%u" % (entry.width, entry.height),
+                                                           entry.encoding)
+        else:
+            img_prop_obj = tools.generate_image_properties(handle, fs)
 
         exp = tools.export_xml(img_prop_obj)
         logger.info("<xmp>%s</xmp>" % exp )
@@ -274,56 +361,131 @@ class BIPServer(server.Server):
 
         # construct a dummy image
 
-        filelist = glob.glob("%s/%s_*.jpg" % (self.rootdir, handle) )
-        logger.info(filelist)
-
-        if len(filelist) > 0:
-            im_file=filelist[0]
-            if os.path.isfile( im_file ):
-                with open(im_file, 'rb') as fp:
-                    imagefile = fp.read()
-        
+        if not thumbnail:
+            generate = lambda: tools.generate_dummy_image(handle, description.image.encoding, thumbnail=False)
         else:
-            im_file = "%s/%s_.jpg" % (self.rootdir, handle)
-            if not thumbnail:
-                imagefile = tools.generate_dummy_image(handle, description.image.encoding, thumbnail=False)
-            else:
-                imagefile = tools.generate_dummy_image(handle, thumbnail=True)
-
-            file1 = open(im_file, 'wb'); file1.write(imagefile); file1.close()
+            generate = lambda: tools.generate_dummy_image(handle, thumbnail=True)
+        entry = self._image_entry(handle, generate)
+        im_file = entry.path
 
-        imagefile_size = os.path.getsize(im_file)
+        imagefile = open(im_file, 'rb')
+        imagefile_size = os.fstat(imagefile.fileno()).st_size
         logger.info("ImageSize %u" % imagefile_size)
-        with Image.open( im_file ) as img:
-            logger.info ("JPEG Size %s*%s" % (img.width, img.height) )
-
-        # TODO: adjust the max packet length in obex connect, since bt rfcomm can send only ~1000 bytes at once
-        max_length = min(self.mtu, self.remote_info.max_packet_length) - 64
-        bytes_transferred = 0
-
-        header_list = [headers.Length(imagefile_size)]
+        logger.info ("JPEG Size %s*%s" % (entry.width, entry.height) )
+
+        # The protocol engine splits the image over packets filled to the
+        # negotiated maximum, which create_session caps at the L2CAP MTU.
+        # It sends the first packet now and each of the others when the
+        # client asks for it with GetFinal, or all of them back to back if
+        # the client enabled Single Response Mode. Images in the shared
+        # image cache are sent from it without copying. Others are read
+        # ahead of the link on a background thread, up to self.read_ahead
+        # bytes, or as each packet is made.
+        payload = self._cached_image(socket, imagefile, imagefile_size)
+        if payload is not None:
+            imagefile.close()
+        elif self.read_ahead:
+            payload = common.ReadAheadPayload(imagefile, imagefile_size,
+                                              max_buffered=self.read_ahead,
+                                              stats=self.read_ahead_stats(socket))
+        else:
+            payload = common.FilePayload(imagefile, imagefile_size)
+        header_list = [headers.Length(imagefile_size),
+                       headers.End_Of_Body.from_payload(payload)]
+        self.send_response(socket, responses.Success(), header_list)
 
-        while bytes_transferred < imagefile_size:
-            if  imagefile_size - bytes_transferred > max_length:
-                image_chunk = imagefile[bytes_transferred: (bytes_transferred + max_length)]
-                header_list.append(headers.Body(image_chunk))
-                self.send_response(socket, responses.Continue(), header_list)
-            else:
-                image_chunk = imagefile[bytes_transferred:]
-                header_list.append(headers.End_Of_Body(image_chunk))
-                self.send_response(socket, responses.Success(), header_list)
-
-            header_list = []
-            bytes_transferred += len(image_chunk)
-            if bytes_transferred < imagefile_size:
-                request = self.request_handler.decode(self.connection)
-                # 'continue' response and process the subsequent requests
-                if not isinstance(request, requests.Get_Final):
-                    raise IOError("didn't receive get final request for continuation")
-                    #self.connected = False #restart connection
-                    break
-            else:
-                logger.info("bytes_transferred %u/%u" % (len(image_chunk), bytes_transferred) )
+    def _cached_image(self, socket, imagefile, size):
+        """Returns a memoryview of the image in imagefile from the image
+        cache, storing it first if it is not there, or None if it is not
+        cached. The images are sent as they are stored, so the image is
+        identified by the file's path, size and modification time."""
+        if self.image_cache is None:
+            return None
+        status = os.fstat(imagefile.fileno())
+        key = (imagefile.name, status.st_size, status.st_mtime_ns)
+        data = self.image_cache.get(key)
+        if data is None:
+            data = self.image_cache.put_file(key, imagefile, size)
+        if data is not None:
+            self.session(socket).cached_images.append(key)
+        return data
+
+    @property
+    def image_index(self):
+        """The imagecatalog.ImageIndex of rootdir, built on first use"""
+        with self._rootdir_lock:
+            if self._image_index is None or self._image_index.rootdir != os.path.abspath(self.rootdir):
+                index = imagecatalog.ImageIndex(self.rootdir, self.catalog)
+                index.refresh()
+                self._image_index = index
+                self._index_pid = os.getpid()
+                if self._watcher is not None:
+                    self._watcher.stop()
+                    self._watcher = imagewatcher.ImageWatcher(index, catch_up=False).start()
+            index = self._image_index
+            follow = (self._shared_generation is not None and
+                      self._shared_generation.value != self._followed_generation)
+            if follow:
+                self._followed_generation = self._shared_generation.value
+        if follow:
+            # Not under the lock, so that the other requests go on with the
+            # index as it is meanwhile.
+            index.follow()
+        return index
+
+    @property
+    def catalog_generation(self):
+        """The generation of the image index, which changes each time images
+        are added, changed or removed"""
+        if self._shared_generation is not None:
+            return self._shared_generation.value
+        return self.image_index.generation
+
+    def start_watcher(self):
+        """Keeps the image index up to date with the images written to,
+        changed in and removed from rootdir, from a thread of this process"""
+        index = self.image_index
+        self._watcher = imagewatcher.ImageWatcher(index, catch_up=self._index_pid != os.getpid()).start()
+
+    def start_watcher_process(self):
+        """Keeps the image index up to date as start_watcher() does, from a
+        process forked for it, and returns the multiprocessing.Process. Only
+        that process reads the new files and writes the catalog; the worker
+        processes forked after this follow its changes."""
+        context = multiprocessing.get_context("fork")
+        self._shared_generation = context.Value("Q", self.image_index.generation, lock=False)
+        self._followed_generation = self._shared_generation.value
+        process = context.Process(target=self._watch, name="ImageWatcher", daemon=True)
+        process.start()
+        return process
+
+    def _watch(self):
+        # The accepting process stops the watcher.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        imagewatcher.ImageWatcher(self._image_index, shared_generation=self._shared_generation).run()
+
+    def _image_entry(self, handle, generate):
+        """Returns the imagecatalog.ImageEntry of the image for handle,
+        writing the image data returned by generate to a new file in rootdir
+        if there is none. Only one connection of a process at a time may
+        create a missing file, and the file is written under a temporary name
+        and then renamed, so that no connection, in this process or in
+        another worker, reads a file that is still being written."""
+        index = self.image_index
+        entry = index.get(handle)
+        if entry is not None:
+            return entry
+        with self._rootdir_lock:
+            entry = index.get(handle)
+            if entry is not None:
+                return entry
+            im_file = os.path.join(index.rootdir, "%s_.jpg" % handle)
+            if not os.path.exists(im_file):
+                imagefile = generate()
+                with tempfile.NamedTemporaryFile(dir=index.rootdir, suffix=".tmp", delete=False) as file1:
+                    file1.write(imagefile)
+                os.replace(file1.name, im_file)
+            return index.add(im_file)
 
     def _get_linked_thumbnail(self, socket, decoded_header):
         """Returns thumbnail version of the images"""
@@ -332,101 +494,86 @@ class BIPServer(server.Server):
 
 
     def serve1(self, socket):
-        """Override: changes 'connection' as instance variable.
-        So we can access it in other methods, enables handling
-        of 'Continue' response and subsequent requests
-        """
-        self.socket = socket
+        """Serves up to self.max_connections connections at once, each with
+        its own session, from a pool of threads."""
         logger.info ("SERVE")
-        while True:
-            connection, address = socket.accept()
-            if not self.accept_connection():
-                print ("close")
-                connection.close()
-                continue
-            self.connected = True
-
-            logger.info("OBEX, Connection from %s %s", address, dir(connection))
-            self.connection = connection
-            opt = bluetooth.get_l2cap_options(socket)
-            self.mtu = min(opt[0], opt[1])
-            
-            while self.connected:
-                logger.info ("+++++++++++++++++++++++++++++++++READY omtu:%u imtu:%u", opt[0], opt[1])
-                try:
-                    #data = connection.recv(1024)
-                    #logger.info("OBEX, Connection from %s", data)
-                    request = self.request_handler.decode(connection)
-                    print("==", request)
-                    self.process_request(connection, request)
-                    if not self.connected: 
-                        connection.close()
-                except Exception  as err: #Exception
-                    logger.info("error:close connection %s" % (err))  
-                    connection.close()  
-                    self.connected = False
-
-def run_server(device_address, rootdir=""):
+        self.serve_threaded(socket, self.max_connections)
+
+    def serve_connection(self, connection):
+        """Override: logs the errors of a connection instead of raising them,
+        so that the other connections are served on."""
+        session = self.session(connection)
+        logger.info ("+++++++++++++++++++++++++++++++++READY mtu:%u",
+                     session.protocol.max_packet_length)
+        try:
+            server.Server.serve_connection(self, connection)
+        except Exception  as err: #Exception
+            logger.info("error:close connection %s" % (err))
+
+    async def serve_async(self, socket, executor=None):
+        """Override: processes requests on a pool of self.max_connections
+        threads unless an executor is given."""
+        logger.info ("SERVE (asyncio)")
+        if executor is None:
+            with concurrent.futures.ThreadPoolExecutor(self.max_connections) as executor:
+                await server.Server.serve_async(self, socket, executor)
+        else:
+            await server.Server.serve_async(self, socket, executor)
+
+def run_server(device_address, rootdir="", use_asyncio=False, transport=None, port=None, workers=0,
+               image_cache_size=0, catalog_file=None, watch=False):
     # Run the server in a function so that, if the server causes an exception
     # to be raised, the server instance will be deleted properly, giving us a
     # chance to create a new one and start the service again without getting
     # errors about the address still being in use.
     socket = None
 
-    bip_server = BIPServer(device_address, rootdir)
-
-    while True:
-        try:
-            port=0x1021 #11
-            socket = BluetoothSocket(bluetooth.L2CAP) #RFCOMM)   #server_sock=bluetooth.BluetoothSocket( bluetooth.L2CAP 
-            socket.bind((device_address, port))
-            #bluetooth.set_l2cap_mtu( socket, 65535 )
-
-            opt = bluetooth.get_l2cap_options(socket)
-            print(opt)
-            opt[0] = 1024 #omtu
-            opt[1] = 1024 #imtu
-            #opt[2] = 1 #flush_to
-            opt[3] = 3  #mode
-            opt[5] = 10 #max_tx
-            opt[6] = 5  #tx_win_size
-            print(opt)
-            bluetooth.set_l2cap_options(socket, opt)
-
-            socket.listen(1)
-            print("Starting server for %s on port %i" % (socket.getsockname(), port) )
-            #socket = bip_server.start_service()
-            bip_server.serve1(socket)
-        except Exception  as err:
-            logger.debug (err) 
-            if (socket):
-                socket.close()
-            else:
-                raise err
-
-
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG,  filename='/tmp/bip_log', format='%(asctime)s %(name)s %(levelname)-8s %(message)s')
-#    <attribute id="0x0003">                                        \
-#        <!-- ServiceID -->                                         \
-#        <uuid value="7163DD54-4A7E-11E2-B47C-0050C2490048" />      \
-#    </attribute>          
-    console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG)
-# set a format which is simpler for console use
-    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-# tell the handler to use this format
-    console.setFormatter(formatter)
-# add the handler to the root logger
-    logging.getLogger().addHandler(console)                                         \
-
-    parser = argparse.ArgumentParser(description="Basic Imaging Profile server...")
-    parser.add_argument("--address", required=True, help="bluetooth address to start the server")
-    parser.add_argument("--imagedir", default="", help="images directory from where images needs to be served")
-    args = parser.parse_args()
-
-    logger.info("Starting server on address %s and imagedir %s" % (args.address, args.imagedir) )
-
+    bip_server = BIPServer(device_address, rootdir, transport)
+    if catalog_file:
+        bip_server.catalog = imagecatalog.CatalogStore(catalog_file)
+    # Index the images before serving, and before any worker is forked.
+    logger.info("%u images in %s", len(bip_server.image_index), bip_server.rootdir)
+    watcher_process = None
+    if watch and workers:
+        # One watcher for all the workers, forked before them so that no
+        # watcher thread runs in the accepting process when they are forked
+        watcher_process = bip_server.start_watcher_process()
+    elif watch:
+        bip_server.start_watcher()
+    if image_cache_size:
+        bip_server.image_cache = imagecache.ImageCache(image_cache_size)
+
+    try:
+        while True:
+            try:
+                # port 0x1021 (PSM) for L2CAP, 650 for TCP, unused for unix sockets
+                socket = bip_server.transport.listen(device_address, port, 5)
+                print("Starting server for %s" % (socket.getsockname(),) )
+                #socket = bip_server.start_service()
+                if workers:
+                    bip_server.serve_processes(socket, workers, bip_server.max_connections)
+                elif use_asyncio:
+                    asyncio.run(bip_server.serve_async(socket))
+                else:
+                    bip_server.serve1(socket)
+            except Exception  as err:
+                logger.debug (err) 
+                if (socket):
+                    socket.close()
+                else:
+                    raise err
+    finally:
+        if watcher_process is not None:
+            watcher_process.terminate()
+            watcher_process.join()
+        # serve_processes has joined the workers by now, so free the shared
+        # memory from this, the accepting process, which created it.
+        if bip_server.image_cache is not None:
+            bip_server.image_cache.close()
+
+
+def register_profile(address):
+    """Registers the cover art SDP record with BlueZ"""
     bus = dbus.SystemBus()
 
     file1 = open('coverart_record.xml', 'r')
@@ -462,7 +609,7 @@ if __name__ == "__main__":
     }, signature="sv")
     manager.RegisterProfile("/org/bluez/profile/obex_push", UUID, opts)
     """
-    services = bluetooth.find_service(address=args.address, uuid="110c")
+    services = bluetooth.find_service(address=address, uuid="110c")
     if not services:
         sys.stderr.write("No BIP (IMAGEPUSH_UUID) service found\n")
         #sys.exit(1)
@@ -470,5 +617,52 @@ if __name__ == "__main__":
         for service in services:
             print(service)
 
-    run_server(args.address, args.imagedir)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG,  filename='/tmp/bip_log', format='%(asctime)s %(name)s %(levelname)-8s %(message)s')
+#    <attribute id="0x0003">                                        \
+#        <!-- ServiceID -->                                         \
+#        <uuid value="7163DD54-4A7E-11E2-B47C-0050C2490048" />      \
+#    </attribute>          
+    console = logging.StreamHandler()
+    console.setLevel(logging.DEBUG)
+# set a format which is simpler for console use
+    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+# tell the handler to use this format
+    console.setFormatter(formatter)
+# add the handler to the root logger
+    logging.getLogger().addHandler(console)                                         \
+
+    parser = argparse.ArgumentParser(description="Basic Imaging Profile server...")
+    parser.add_argument("--address", required=True, help="bluetooth address to start the server")
+    parser.add_argument("--imagedir", default="", help="images directory from where images needs to be served")
+    parser.add_argument("--asyncio", action="store_true", help="serve any number of connections from one asyncio event loop")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="accept connections in this process and serve them from this many worker processes")
+    parser.add_argument("--image-cache", type=int, default=None,
+                        help="bytes of shared memory for caching the images sent to the worker processes, "
+                             "0 for none; 8 MiB by default with --workers, none without")
+    parser.add_argument("--catalog", default=None,
+                        help="SQLite file that keeps the image catalog between runs, so that only new and changed images are read at startup")
+    parser.add_argument("--watch", action="store_true",
+                        help="pick up the images written to, changed in and removed from imagedir while serving")
+    parser.add_argument("--transport", default="l2cap", choices=sorted(transports.transport_dict),
+                        help="link to serve on; --address is a path for unix sockets")
+    parser.add_argument("--port", type=int, default=None, help="PSM, channel or TCP port to listen on")
+    args = parser.parse_args()
+
+    logger.info("Starting server on address %s and imagedir %s" % (args.address, args.imagedir) )
+
+    transport = None
+    if args.transport != "l2cap":
+        transport = transports.transport_dict[args.transport]()
+    if transports.transport_dict[args.transport].bluetooth:
+        register_profile(args.address)
+    # A single process gains nothing from sharing the cache, and sends the
+    # images it does not cache by reading them ahead of the link.
+    image_cache_size = args.image_cache
+    if image_cache_size is None:
+        image_cache_size = 0x800000 if args.workers else 0
+    run_server(args.address, args.imagedir, args.asyncio, transport, args.port, args.workers,
+               image_cache_size, args.catalog, args.watch)
 
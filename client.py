@@ -19,17 +19,28 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import io
+import os
+import stat
+
 import headers
 import requests
 import responses
-from common import ObexVersion, Socket
+from common import (FilePayload, FrameEncoder, ObexVersion, flush_async,
+                    nonblocking)
+from protocol import ClientProtocol, ConnectionClosed
+from transports import RFCOMMTransport
+
+# Zeros to grow bytearray sinks with, without allocating them each time.
+_ZEROS = memoryview(bytes(0x10000))
 
 
 class Client:
 
     """Client
 
-    client = Client(address, port)
+    client = Client(address, port, transport=None)
 
     Provides common functionality for OBEX clients, including methods for
     connecting to and disconnecting from a server, sending and receiving
@@ -38,63 +49,77 @@ class Client:
 
     The address used is a standard six-field bluetooth address, and the port
     should correspond to the port providing the service you wish to access.
+
+    The transport creates the socket when a connection is made. It is an
+    RFCOMMTransport by default; see the transports module for others, which
+    take their own form of address.
+
+    Set srm to True before connecting to ask the server for OBEX Single
+    Response Mode in get and put operations, so that the packets of an
+    object are sent back to back instead of one per round trip. Servers
+    that do not support it are used as before. GOEP 2.0 only allows it on
+    L2CAP connections.
     """
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, transport=None):
 
         self.address = address
         self.port = port
+        if transport is None:
+            transport = RFCOMMTransport()
+        self.transport = transport
         self.max_packet_length = 0xffff
         self.obex_version = ObexVersion()
-        self.response_handler = responses.ResponseHandler()
+        self.srm = False
+        self.protocol = None
+        self.frame_encoder = FrameEncoder()
 
         self.socket = None
         self._external_socket = False
         self.connection_id = None
         self.remote_info = None
 
-    def _send_headers(self, request, header_list, max_length):
+    def _flush(self):
 
-        """Convenience method to add headers to a request and send one or
-        more requests with those headers."""
+        """Sends the messages that the protocol engine has queued."""
 
-        # Ensure that any Connection ID information is sent first.
-        if self.connection_id:
-            header_list.insert(0, self.connection_id)
+        while True:
+            message = self.protocol.next_message()
+            if message is None:
+                return
+            self.frame_encoder.send(self.socket, message)
 
-        while header_list:
+    def _responses(self):
 
-            if request.add_header(header_list[0], max_length):
-                header_list.pop(0)
-            else:
-                print(request.encode())
-                self.socket.sendall(request.encode())
+        """Yields each response received until the operation in progress is
+        complete."""
 
-                if isinstance(request, requests.Connect):
-                    response = self.response_handler.decode_connection(
-                        self.socket)
-                else:
-                    response = self.response_handler.decode(self.socket)
+        while True:
+            self._flush()
+            for event in self.protocol.receive_from(self.socket):
+                if isinstance(event, ConnectionClosed):
+                    raise ConnectionError("connection closed by peer")
+                yield event.response
+                if event.final:
+                    return
 
-                if not isinstance(response, responses.Continue):
-                    return response
+    def _request(self, request, header_list=(), bodies=()):
 
-                request.reset_headers()
+        """Starts an operation with the request and headers given, and
+        yields each response received until it is complete. The headers in
+        bodies are sent after header_list and read as they are sent."""
 
-        # Always send at least one request.
-        if isinstance(request, requests.Get):
-            # Turn the last Get request containing the headers into a
-            # GetFinal request.
-            request.code = requests.GetFinal.code
+        self.protocol.queue(request, header_list, bodies)
+        yield from self._responses()
 
-        print("Send\n", request.encode())
-        self.socket.sendall(request.encode())
+    def _send_headers(self, request, header_list):
 
-        if isinstance(request, requests.Connect):
-            response = self.response_handler.decode_connection(self.socket)
-        else:
-            response = self.response_handler.decode(self.socket)
+        """Convenience method to send a request with the headers given, split
+        over as many packets as necessary, and return the final response."""
 
+        response = None
+        for response in self._request(request, header_list):
+            pass
         return response
 
     @staticmethod
@@ -113,6 +138,21 @@ class Client:
 
         return new_headers, b"".join(body)
 
+    @staticmethod
+    def _split_bodies(response):
+
+        """Returns the headers of response other than Body and EndOfBody, and
+        an iterable of memoryviews of the data of those."""
+
+        new_headers = []
+        bodies = []
+        for header in response.header_data:
+            if isinstance(header, (headers.Body, headers.EndOfBody)):
+                bodies.append(memoryview(header.data))
+            else:
+                new_headers.append(header)
+        return new_headers, bodies
+
     def set_socket(self, socket):
 
         """set_socket(self, socket)
@@ -153,31 +193,36 @@ class Client:
         """
 
         if not self._external_socket:
-            self.socket = Socket()
-            self.socket.connect((self.address, self.port))
+            self.socket = self.transport.connect(self.address, self.port)
 
-        flags = 0
-        data = (self.obex_version.to_byte(), flags, self.max_packet_length)
-
-        max_length = self.max_packet_length
-        request = requests.Connect(data)
+        request = self._start_session()
 
         header_list = list(header_list)
-        response = self._send_headers(request, header_list, max_length)
+        response = self._send_headers(request, header_list)
 
         if isinstance(response, responses.ConnectSuccess):
-            self.remote_info = response
-            for header in response.header_data:
-                if isinstance(header, headers.ConnectionId):
-                    # Recycle the Connection ID data to create a new header
-                    # for future use.
-                    self.connection_id = headers.ConnectionId(header.decode())
+            self.remote_info = self.protocol.remote_info
+            self.connection_id = self.protocol.connection_id
 
         elif not self._external_socket:
             self.socket.close()
 
         return response
 
+    def _start_session(self):
+
+        """Creates the protocol engine for a new connection and returns the
+        Connect request to send."""
+
+        self.protocol = ClientProtocol(self.max_packet_length)
+        self.protocol.obex_version = self.obex_version
+        self.protocol.srm = self.srm
+
+        flags = 0
+        data = (self.obex_version.to_byte(), flags, self.max_packet_length)
+
+        return requests.Connect(data)
+
     def disconnect(self, header_list=()):
 
         """disconnect(self, header_list=())
@@ -192,11 +237,10 @@ class Client:
         If the socket was not supplied using set_socket(), it will be closed.
         """
 
-        max_length = self.remote_info.max_packet_length
         request = requests.Disconnect()
 
         header_list = list(header_list)
-        response = self._send_headers(request, header_list, max_length)
+        response = self._send_headers(request, header_list)
 
         if not self._external_socket:
             self.socket.close()
@@ -213,6 +257,13 @@ class Client:
         Sends a file with the given name, containing the file_data specified,
         to the server for storage in the current directory for the session.
 
+        file_data may be a bytes-like object, the path of a file, a file
+        object opened for reading or an iterable of bytes-like objects.
+        Files are read as they are sent, one packet at a time, and their
+        length is sent in a Length header if it can be found with fstat;
+        the other forms are sent without copying them. File objects passed
+        in are not closed.
+
         If a callback is specified, it will be called with each response
         obtained during the put operation. If no callback is specified, the
         final response is returned when the put operation is complete or an
@@ -247,58 +298,86 @@ class Client:
 
     def _put(self, name, file_data, header_list=()):
 
-        header_list = [
-            headers.Name(name),
-            headers.Length(len(file_data))
-            ] + list(header_list)
+        yield from self._request(
+            requests.Put(), *self._put_headers(name, file_data, header_list))
 
-        max_length = self.remote_info.max_packet_length
-        request = requests.Put()
+    def _put_headers(self, name, file_data, header_list):
 
-        response = self._send_headers(request, header_list, max_length)
-        yield response
+        # Send the name and length first, followed by the file data. The
+        # protocol engine splits the data over as many packets as needed,
+        # each filled to the maximum length accepted by the server, and
+        # sends each packet when the server answers the previous one with
+        # Continue, or all of them at once in Single Response Mode, and the
+        # last packet as PutFinal.
+        length, bodies = self._body_headers(file_data)
 
-        if not isinstance(response, responses.Continue):
-            return
+        new_headers = [headers.Name(name)]
+        if length is not None:
+            new_headers.append(headers.Length(length))
+        return new_headers + list(header_list), bodies
 
-        # Send the file data.
+    def _body_headers(self, file_data):
 
-        # The optimum size is the maximum packet length accepted by the
-        # remote device minus three bytes for the header ID and length
-        # minus three bytes for the request.
-        optimum_size = max_length - 3 - 3
+        """Returns the length of file_data, or None if it is not known, and
+        the headers that carry it."""
 
-        i = 0
-        while i < len(file_data):
+        if isinstance(file_data, (str, os.PathLike)):
+            payload = FilePayload(open(file_data, "rb"))
+            return payload.length, [headers.EndOfBody.from_payload(payload)]
 
-            data = file_data[i:i+optimum_size]
-            i += len(data)
-            if i < len(file_data):
-                request = requests.Put()
-                request.add_header(headers.Body(data, False), max_length)
-                self.socket.sendall(request.encode())
+        try:
+            data = memoryview(file_data)
+        except TypeError:
+            pass
+        else:
+            return data.nbytes, [headers.EndOfBody.from_payload(data.cast("B"))]
+
+        if hasattr(file_data, "read"):
+            try:
+                mode = os.fstat(file_data.fileno()).st_mode
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                mode = 0
+            if stat.S_ISREG(mode):
+                payload = FilePayload(file_data, close=False)
+                return payload.length, [headers.EndOfBody.from_payload(payload)]
+            # Read pipes and in-memory files a packet at a time.
+            file_data = self._read_chunks(file_data,
+                                          self.protocol.max_length())
+
+        return None, self._iter_body_headers(file_data)
 
-                response = self.response_handler.decode(self.socket)
-                yield response
+    @staticmethod
+    def _read_chunks(fileobj, size, buffers=3):
 
-                if not isinstance(response, responses.Continue):
-                    return
+        """Yields memoryviews of the data read from fileobj, up to size bytes
+        at a time. Like FilePayload, it reads into a small set of buffers
+        that are reused, so each view stays valid until as many more have
+        been yielded as there are buffers."""
 
-            else:
-                request = requests.PutFinal()
-                request.add_header(headers.EndOfBody(data, False),
-                                   max_length)
-                self.socket.sendall(request.encode())
+        if not hasattr(fileobj, "readinto"):
+            yield from iter(lambda: fileobj.read(size), b"")
+            return
 
-                response = self.response_handler.decode(self.socket)
-                yield response
+        views = [memoryview(bytearray(size)) for _ in range(buffers)]
+        i = 0
+        while True:
+            received = fileobj.readinto(views[i])
+            if not received:
+                return
+            yield views[i][:received]
+            i = (i + 1) % buffers
 
-                if not isinstance(response, responses.Success):
-                    return
+    @staticmethod
+    def _iter_body_headers(buffers):
+
+        for data in buffers:
+            if len(data):
+                yield headers.Body.from_payload(data)
+        yield headers.EndOfBody.from_payload(b"")
 
-    def get(self, name=None, header_list=(), callback=None):
+    def get(self, name=None, header_list=(), callback=None, sink=None):
 
-        """get(self, name=None, header_list=(), callback=None)
+        """get(self, name=None, header_list=(), callback=None, sink=None)
 
         Requests the specified file from the server's current directory for
         the session.
@@ -315,58 +394,39 @@ class Client:
         Additional headers can be sent by passing a sequence as the
         header_list keyword argument. These will be sent after the name
         information.
+
+        If a sink is specified, the file data is passed to it as it arrives
+        instead of being collected, and the tuple returned holds the sink in
+        place of the data. The sink may be a file object opened for writing,
+        a function that is called with a memoryview of each piece of data,
+        which is only valid during the call, or a bytearray. A bytearray is
+        resized to the length given by the server's Length header, if any,
+        filled in place and truncated to the data received.
         """
 
-        returned_headers = []
+        result = _GetResult(sink, callback)
 
         for response in self._get(name, header_list):
+            if not result.add(response):
+                break
 
-            if isinstance(response, (responses.Continue, responses.Success)):
-
-                # Report successful responses if using a callback or collect
-                # them for later.
-                if callback:
-                    callback(response)
-                else:
-                    returned_headers += response.header_data
+        return result.result()
 
-            elif callback:
-                # Report failure responses using the callback, then return.
-                callback(response)
-                return
-            else:
-                # Return failure responses directly.
-                return response
+    def _get(self, name=None, header_list=()):
 
-        # Finally, return the collected responses if not using a callback.
-        if not callback:
-            return self._collect_parts(returned_headers)
+        # The protocol engine sends GetFinal requests for as long as the
+        # server answers Continue, unless the server has agreed to Single
+        # Response Mode and streams the responses by itself.
+        yield from self._request(requests.Get(),
+                                 self._get_headers(name, header_list))
 
-    def _get(self, name=None, header_list=()):
+    @staticmethod
+    def _get_headers(name, header_list):
 
         header_list = list(header_list)
         if name is not None:
             header_list = [headers.Name(name)] + header_list
-
-        max_length = self.remote_info.max_packet_length
-        request = requests.Get()
-
-        response = self._send_headers(request, header_list, max_length)
-        yield response
-
-        if not isinstance(response, (responses.Continue, responses.Success)):
-
-            return
-
-        # Retrieve the file data.
-        request = requests.GetFinal()
-
-        while isinstance(response, responses.Continue):
-
-            self.socket.sendall(request.encode())
-
-            response = self.response_handler.decode(self.socket)
-            yield response
+        return header_list
 
     def setpath(self, name="", create_dir=False, to_parent=False,
                 header_list=()):
@@ -390,8 +450,6 @@ class Client:
         if name is not None:
             header_list = [headers.Name(name)] + header_list
 
-        max_length = self.remote_info.max_packet_length
-
         flags = 0
         if not create_dir:
             flags |= requests.SetPath.DontCreateDir
@@ -400,7 +458,7 @@ class Client:
 
         request = requests.SetPath((flags, 0))
 
-        response = self._send_headers(request, header_list, max_length)
+        response = self._send_headers(request, header_list)
         return response
 
     def delete(self, name, header_list=()):
@@ -415,10 +473,9 @@ class Client:
             headers.Name(name)
             ] + list(header_list)
 
-        max_length = self.remote_info.max_packet_length
         request = requests.PutFinal()
 
-        return self._send_headers(request, header_list, max_length)
+        return self._send_headers(request, header_list)
 
     def abort(self, header_list=()):
 
@@ -435,10 +492,264 @@ class Client:
         """
 
         header_list = list(header_list)
-        max_length = self.remote_info.max_packet_length
-        request = requests.Abort()
+        self.protocol.abort(header_list)
+
+        response = None
+        for response in self._responses():
+            pass
+        return response
+
+
+class _GetResult:
+
+    """Collects the headers and data of the responses to a get operation,
+    passing the data to sink as it arrives if one is given, and reports the
+    responses to callback if one is given (see Client.get)."""
+
+    def __init__(self, sink=None, callback=None):
+
+        self.sink = sink
+        self.callback = callback
+        self.headers = []
+        self.offset = 0
+        self.failure = None
+
+    def add(self, response):
+
+        """Handles response and returns False if it is a failure, which ends
+        the operation."""
+
+        succeeded = isinstance(response,
+                               (responses.Continue, responses.Success))
+
+        # Report successful responses if using a callback or collect them
+        # for later. Data always goes to the sink.
+        if not succeeded:
+            self.failure = response
+        elif self.sink is not None or not self.callback:
+            self._collect(response)
 
-        response = self._send_headers(request, header_list, max_length)
+        if self.callback:
+            self.callback(response)
+        return succeeded
+
+    def _collect(self, response):
+
+        if self.sink is None:
+            self.headers += response.header_data
+            return
+
+        new_headers, bodies = Client._split_bodies(response)
+        self.headers += new_headers
+
+        sink = self.sink
+        if isinstance(sink, bytearray):
+            self._size_buffer(new_headers)
+        for data in bodies:
+            if isinstance(sink, bytearray):
+                sink[self.offset:self.offset+len(data)] = data
+            elif hasattr(sink, "write"):
+                sink.write(data)
+            else:
+                sink(data)
+            self.offset += len(data)
+
+    def _size_buffer(self, header_list):
+
+        for header in header_list:
+            if isinstance(header, headers.Length):
+                length = header.decode()
+                while len(self.sink) < length:
+                    self.sink += _ZEROS[:length - len(self.sink)]
+
+    def result(self):
+
+        """Returns the value returned by Client.get: nothing if using a
+        callback, the failure response if there was one, or the tuple of
+        headers and data."""
+
+        if self.callback:
+            return None
+        if self.failure is not None:
+            return self.failure
+        if self.sink is None:
+            return Client._collect_parts(self.headers)
+        if isinstance(self.sink, bytearray):
+            del self.sink[self.offset:]
+        return self.headers, self.sink
+
+
+class AsyncClient(Client):
+
+    """AsyncClient(address, port, transport=None)
+
+    A Client whose connect, disconnect, get, put, setpath, delete and abort
+    methods are coroutines, so that many sessions can run in one thread
+    with asyncio.
+
+    The socket is created by the transport, in the event loop's default
+    executor, and then driven by the event loop, so any transport whose
+    sockets have a file descriptor can be used. A socket supplied with
+    set_socket() is used through a non-blocking duplicate.
+
+    Only one operation may be in progress on a client at a time. If the
+    task running a get or put operation is cancelled, an Abort request is
+    sent and its response awaited for at most abort_timeout seconds before
+    the cancellation goes on. If the abort fails, or another operation is
+    cancelled, the connection is closed as it is no longer usable.
+    """
+
+    abort_timeout = 5.0
+
+    # The non-blocking socket used by the event loop.
+    _loop_socket = None
+
+    def _close(self):
+
+        if self._loop_socket is not self.socket:
+            self._loop_socket.close()
+        if not self._external_socket:
+            self.socket.close()
+
+    async def _flush(self):
+
+        await flush_async(self.protocol, self._loop_socket, self.frame_encoder)
+
+    async def _responses(self):
+
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._flush()
+            data = await loop.sock_recv(self._loop_socket, 0x10000)
+            for event in self.protocol.receive_data(data):
+                if isinstance(event, ConnectionClosed):
+                    raise ConnectionError("connection closed by peer")
+                yield event.response
+                if event.final:
+                    return
+
+    async def _request(self, request, header_list=(), bodies=()):
+
+        self.protocol.queue(request, header_list, bodies)
+        try:
+            async for response in self._responses():
+                yield response
+        except asyncio.CancelledError:
+            await self._cancelled(request)
+            raise
+
+    async def _cancelled(self, request):
+
+        """Aborts the operation started by request after its task has been
+        cancelled, or closes the connection if that is not possible."""
+
+        aborted = False
+        try:
+            if isinstance(request, (requests.Get, requests.Put)):
+                await asyncio.wait_for(self.abort(), self.abort_timeout)
+                aborted = True
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            if not aborted:
+                self._close()
+
+    async def _send_headers(self, request, header_list):
+
+        response = None
+        async for response in self._request(request, header_list):
+            pass
+        return response
+
+    async def connect(self, header_list=()):
+
+        """Coroutine version of Client.connect."""
+
+        if not self._external_socket:
+            loop = asyncio.get_running_loop()
+            self.socket = await loop.run_in_executor(
+                None, self.transport.connect, self.address, self.port)
+        self._loop_socket = nonblocking(self.socket)
+
+        request = self._start_session()
+
+        header_list = list(header_list)
+        response = await self._send_headers(request, header_list)
+
+        if isinstance(response, responses.ConnectSuccess):
+            self.remote_info = self.protocol.remote_info
+            self.connection_id = self.protocol.connection_id
+        else:
+            self._close()
+
+        return response
+
+    async def disconnect(self, header_list=()):
+
+        """Coroutine version of Client.disconnect."""
+
+        request = requests.Disconnect()
+
+        header_list = list(header_list)
+        response = await self._send_headers(request, header_list)
+
+        self._close()
+
+        self.connection_id = None
+        self.remote_info = None
+
+        return response
+
+    async def put(self, name, file_data, header_list=(), callback=None):
+
+        """Coroutine version of Client.put. Files are read in the event
+        loop's thread as they are sent."""
+
+        response = None
+        async for response in self._put(name, file_data, header_list):
+            if callback:
+                callback(response)
+            if not isinstance(response,
+                              (responses.Continue, responses.Success)):
+                break
+
+        if not callback:
+            return response
+
+    def _put(self, name, file_data, header_list=()):
+
+        return self._request(
+            requests.Put(), *self._put_headers(name, file_data, header_list))
+
+    async def get(self, name=None, header_list=(), callback=None, sink=None):
+
+        """Coroutine version of Client.get."""
+
+        result = _GetResult(sink, callback)
+
+        async for response in self._get(name, header_list):
+            if not result.add(response):
+                break
+
+        return result.result()
+
+    def _get(self, name=None, header_list=()):
+
+        return self._request(requests.Get(),
+                             self._get_headers(name, header_list))
+
+    # setpath and delete return the coroutine from _send_headers.
+
+    async def abort(self, header_list=()):
+
+        """Coroutine version of Client.abort."""
+
+        header_list = list(header_list)
+        self.protocol.abort(header_list)
+
+        response = None
+        async for response in self._responses():
+            pass
         return response
 
 
@@ -18,12 +18,21 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import asyncio
+import collections
+import os
+import queue
 import socket
 import struct
-import sys
+import threading
+import time
+import weakref
 
 import headers
 
+# IDs of the headers whose data Message.read_headers can give out as views
+BODY_IDS = (headers.Body.code, headers.EndOfBody.code)
+
 if hasattr(socket, "AF_BLUETOOTH"):
 
     class Socket(socket.socket):
@@ -51,6 +60,34 @@ else:
                         raise socket.error
 
 
+def nonblocking(socket_):
+
+    """Returns a non-blocking socket.socket for socket_, which may also be a
+    PyBluez BluetoothSocket, for use with the event loop's socket methods."""
+
+    if not isinstance(socket_, socket.socket):
+        socket_ = socket.socket(fileno=os.dup(socket_.fileno()))
+    socket_.setblocking(False)
+    return socket_
+
+
+async def flush_async(protocol, socket_, frame_encoder):
+
+    """Sends the messages that protocol has queued, encoded by
+    frame_encoder, on the non-blocking socket_ from the running event
+    loop."""
+
+    loop = asyncio.get_running_loop()
+    while True:
+        message = protocol.next_message()
+        if message is None:
+            return
+        # Send each packet with a single call so that it goes out as a
+        # single L2CAP SDU.
+        data = b"".join(frame_encoder.encode(message))
+        await loop.sock_sendall(socket_, data)
+
+
 class ObexVersion:
 
     major = 1
@@ -87,35 +124,46 @@ class Message:
 
         return format_.count("B") + format_.count("H") * 2
 
-    def read_data(self, data):
+    def read_data(self, data, body_views=False):
 
         # Extract the header data from the complete data.
-        header_data = data[self.minimum_length:]
-        self.read_headers(header_data)
-
-    def read_headers(self, header_data):
-
-        i = 0
+        if body_views:
+            self.read_headers(data, body_views, self.minimum_length)
+        else:
+            header_data = data[self.minimum_length:]
+            self.read_headers(header_data)
+
+    def read_headers(self, header_data, body_views=False, start=0):
+
+        # With body_views, the data of Body and EndOfBody headers is given
+        # out as a memoryview of header_data instead of being copied; the
+        # other headers are decoded as usual. The headers start at offset
+        # start in header_data.
+        view = memoryview(header_data) if body_views else None
+        i = start
         header_list = []
         data = None
         while i < len(header_data):
 
             # Read header ID and data type.
-            header_id = struct.unpack(">B", header_data[i:i+1])[0]
+            header_id = header_data[i]
             id_type = header_id & 0xc0
             if id_type == 0x00:
                 # text
-                length = struct.unpack(">H", header_data[i+1:i+3])[0] - 3
+                length = struct.unpack_from(">H", header_data, i+1)[0] - 3
                 data = header_data[i+3:i+3+length]
                 i += 3 + length
             elif id_type == 0x40:
                 # bytes
-                length = struct.unpack(">H", header_data[i+1:i+3])[0] - 3
-                data = header_data[i+3:i+3+length]
+                length = struct.unpack_from(">H", header_data, i+1)[0] - 3
+                if view is not None and header_id in BODY_IDS:
+                    data = view[i+3:i+3+length]
+                else:
+                    data = header_data[i+3:i+3+length]
                 i += 3 + length
             elif id_type == 0x80:
                 # 1 byte
-                data = header_data[i+1]
+                data = header_data[i+1:i+2]
                 i += 2
             elif id_type == 0xc0:
                 # 4 bytes
@@ -129,7 +177,9 @@ class Message:
 
     def add_header(self, header, max_length):
 
-        if self.minimum_length + len(header.data) > max_length:
+        length = self.minimum_length + sum(
+            h.encoded_length() for h in self.header_data)
+        if length + header.encoded_length() > max_length:
             return False
 
         self.header_data.append(header)
@@ -140,55 +190,470 @@ class Message:
 
     def encode(self):
 
-        length = self.minimum_length + sum(map(lambda h: len(h.data),
+        length = self.minimum_length + sum(map(lambda h: h.encoded_length(),
                                                self.header_data))
         args = (Message.format + self.format, self.code, length) + self.data
         return struct.pack(*args) + b"".join(map(lambda h: h.data,
                                                  self.header_data))
 
 
+class FrameEncoder:
+
+    """FrameEncoder(size=0x10000)
+
+    Encodes messages into a list of buffers for sending with sendmsg.
+
+    The packet prefix and the data of ordinary headers are packed into a
+    buffer that is reused for every message. The payloads of headers created
+    with from_payload() are passed on as separate buffers, so body data is
+    never concatenated with the rest of the packet. The buffers returned are
+    only valid until the next message is encoded.
+    """
+
+    def __init__(self, size=0x10000):
+
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def encode(self, message):
+
+        length = message.minimum_length + sum(
+            header.encoded_length() for header in message.header_data)
+        struct.pack_into(Message.format + message.format, self.buffer, 0,
+                         message.code, length, *message.data)
+
+        buffers = []
+        start = 0
+        i = message.minimum_length
+        for header in message.header_data:
+
+            if header.payload is None:
+                data = header.data
+                self.view[i:i+len(data)] = data
+                i += len(data)
+            else:
+                struct.pack_into(">BH", self.buffer, i, header.code,
+                                 len(header.payload) + 3)
+                i += 3
+                buffers.append(self.view[start:i])
+                if len(header.payload):
+                    buffers.append(header.payload)
+                start = i
+
+        if i > start:
+            buffers.append(self.view[start:i])
+
+        return buffers
+
+    def send(self, socket_, message):
+
+        """Encodes message and sends it on socket_ as a single packet."""
+
+        buffers = self.encode(message)
+
+        sendmsg = getattr(socket_, "sendmsg", None)
+        if sendmsg is None:
+            socket_.sendall(b"".join(buffers))
+            return
+
+        while buffers:
+            sent = sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+
+class FilePayload:
+
+    """FilePayload(fileobj, length=None, buffers=3, close=True)
+
+    The payload of a Body or EndOfBody header that is read from fileobj
+    while the header is being sent, for use with from_payload(). The
+    protocol engine reads the data of one packet at a time with read()
+    into a small set of buffers that are reused, so sending a file takes
+    the same memory whatever its size.
+
+    length is the number of bytes to send from the current position of
+    fileobj; by default, the rest of the file. len() returns the number of
+    bytes not read yet. The file is closed once all of them have been read,
+    unless close is False.
+    """
+
+    def __init__(self, fileobj, length=None, buffers=3, close=True):
+
+        if length is None:
+            length = os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+        self.fileobj = fileobj
+        self.length = length
+        self.remaining = length
+        self.close_file = close
+        self._buffers = [bytearray() for _ in range(buffers)]
+        self._i = 0
+
+    def __len__(self):
+
+        return self.remaining
+
+    def read(self, size):
+
+        """Returns a memoryview of the next size bytes of the file. It stays
+        valid until read() has been called as many times again as there are
+        buffers."""
+
+        size = min(size, self.remaining)
+        buffer = self._buffers[self._i]
+        if len(buffer) < size:
+            buffer = self._buffers[self._i] = bytearray(size)
+        self._i = (self._i + 1) % len(self._buffers)
+
+        view = memoryview(buffer)[:size]
+        filled = 0
+        while filled < size:
+            received = self.fileobj.readinto(view[filled:])
+            if not received:
+                raise IOError("file ended %i bytes early" % (size - filled))
+            filled += received
+
+        self.remaining -= size
+        if not self.remaining and self.close_file:
+            self.fileobj.close()
+        return view
+
+    def close(self):
+
+        if self.close_file:
+            self.fileobj.close()
+
+
+class ReadAheadStats:
+
+    """Counters of the ReadAheadPayload objects of one connection: the
+    packets read, how many of them had to wait for the disk and the total
+    time spent waiting, in seconds."""
+
+    def __init__(self):
+
+        self.reads = 0
+        self.bytes = 0
+        self.disk_waits = 0
+        self.disk_wait_time = 0.0
+
+    def __repr__(self):
+
+        return ("ReadAheadStats(reads=%i, bytes=%i, disk_waits=%i,"
+                " disk_wait_time=%.3f)" % (self.reads, self.bytes,
+                                           self.disk_waits,
+                                           self.disk_wait_time))
+
+
+class ReadAheadPayload(FilePayload):
+
+    """ReadAheadPayload(fileobj, length=None, chunk_size=0x4000,
+                        max_buffered=0x20000, stats=None)
+
+    A FilePayload that reads the file on a background thread while the
+    packets made from it are being sent, so that the disk and the link work
+    at the same time.
+
+    The thread reads chunk_size bytes at a time into buffers that are
+    reused, and stays at most max_buffered bytes ahead of the packets. No
+    more buffers are allocated than the file needs, and a file that fits in
+    one chunk is read as each packet is made, without a thread. A packet
+    that fits in a chunk is given out as a view of it; others are copied
+    from the chunks into the packet buffers. read() counts the packets that
+    had to wait for the thread in stats, a ReadAheadStats object. The
+    thread stops, and closes the file, at the end of the data, when the
+    payload is closed or when it is garbage collected.
+    """
+
+    def __init__(self, fileobj, length=None, chunk_size=0x4000,
+                 max_buffered=0x20000, stats=None):
+
+        FilePayload.__init__(self, fileobj, length)
+        self.stats = stats or ReadAheadStats()
+        self._stop = None
+        if self.length <= chunk_size:
+            return
+
+        # Chunks given out as views are only reused once read() has been
+        # called as many times again as there are packet buffers, so keep
+        # enough for the thread to read on meanwhile.
+        count = max(len(self._buffers) + 2, max_buffered // chunk_size)
+        count = min(count, -(-self.length // chunk_size))
+        self._free = queue.Queue()
+        for _ in range(count):
+            self._free.put(bytearray(chunk_size))
+        self._filled = queue.Queue()
+        self._chunk = None
+        self._chunk_offset = 0
+        self._chunk_length = 0
+        # The chunks given out as views, with the number of the read() that
+        # finished with each, and the number of read() calls so far.
+        self._retired = collections.deque()
+        self._reads = 0
+        self._viewed = False
+
+        self._stop = threading.Event()
+        threading.Thread(target=_read_ahead,
+                         args=(fileobj, self.length, self._free,
+                               self._filled, self._stop),
+                         daemon=True).start()
+        weakref.finalize(self, _stop_read_ahead, self._stop, self._free)
+
+    def read(self, size):
+
+        size = min(size, self.remaining)
+        self.stats.reads += 1
+        self.stats.bytes += size
+        if self._stop is None:
+            return FilePayload.read(self, size)
+
+        self._reads += 1
+        while (self._retired and
+               self._retired[0][1] + len(self._buffers) <= self._reads):
+            self._free.put(self._retired.popleft()[0])
+
+        if self._chunk_offset == self._chunk_length:
+            self._next_chunk()
+
+        if self._chunk_length - self._chunk_offset >= size:
+            # The packet fits in the chunk: give out a view of it.
+            view = memoryview(self._chunk)[
+                self._chunk_offset:self._chunk_offset+size]
+            self._chunk_offset += size
+            self._viewed = True
+            self.remaining -= size
+            return view
+
+        buffer = self._buffers[self._i]
+        if len(buffer) < size:
+            buffer = self._buffers[self._i] = bytearray(size)
+        self._i = (self._i + 1) % len(self._buffers)
+
+        view = memoryview(buffer)[:size]
+        filled = 0
+        while filled < size:
+
+            if self._chunk_offset == self._chunk_length:
+                self._next_chunk()
+
+            n = min(size - filled, self._chunk_length - self._chunk_offset)
+            view[filled:filled+n] = memoryview(self._chunk)[
+                self._chunk_offset:self._chunk_offset+n]
+            self._chunk_offset += n
+            filled += n
+
+        self.remaining -= size
+        return view
+
+    def _next_chunk(self):
+
+        # Hand the chunk that has been used up back to the thread, at once
+        # if no view of it was given out.
+        if self._chunk is not None:
+            if self._viewed:
+                self._retired.append((self._chunk, self._reads))
+            else:
+                self._free.put(self._chunk)
+        self._viewed = False
+
+        try:
+            item = self._filled.get_nowait()
+        except queue.Empty:
+            self.stats.disk_waits += 1
+            start = time.monotonic()
+            item = self._filled.get()
+            self.stats.disk_wait_time += time.monotonic() - start
+
+        if isinstance(item, Exception):
+            raise item
+        self._chunk, self._chunk_length = item
+        self._chunk_offset = 0
+
+    def close(self):
+
+        self.remaining = 0
+        if self._stop is None:
+            FilePayload.close(self)
+        else:
+            # The thread closes the file when it stops.
+            _stop_read_ahead(self._stop, self._free)
+
+
+def _read_ahead(fileobj, length, free, filled, stop):
+
+    """Reads length bytes of fileobj into the buffers taken from free and
+    puts each one in filled with the number of bytes read, until stop is
+    set."""
+
+    try:
+        while length > 0:
+            buffer = free.get()
+            if buffer is None or stop.is_set():
+                break
+            view = memoryview(buffer)[:length]
+            n = 0
+            while n < len(view):
+                received = fileobj.readinto(view[n:])
+                if not received:
+                    raise IOError("file ended %i bytes early" % (length - n))
+                n += received
+            length -= n
+            filled.put((buffer, n))
+    except (IOError, ValueError) as err:
+        filled.put(err)
+    finally:
+        fileobj.close()
+
+
+def _stop_read_ahead(stop, free):
+
+    stop.set()
+    free.put(None)
+
+
+class PacketReader:
+
+    """PacketReader(size=0x20000)
+
+    Splits the data received on a connection into whole OBEX packets.
+
+    Data is received into a preallocated buffer with recv_into. A single
+    receive may hold several back-to-back packets or only part of one;
+    complete packets are returned one at a time and any remaining bytes are
+    kept for the next call. The default size leaves room for a partial
+    packet plus a full 64 KiB receive, so that datagram-style sockets such
+    as L2CAP never truncate what they deliver.
+    """
+
+    def __init__(self, size=0x20000):
+
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+
+        return self.end - self.start
+
+    def _make_room(self):
+
+        # Move the pending bytes to the start of the buffer.
+        pending = self.end - self.start
+        if self.start and pending:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def feed(self, data):
+
+        """Appends data that was received by other means to the buffer."""
+
+        if self.end + len(data) > len(self.buffer):
+            self._make_room()
+            if self.end + len(data) > len(self.buffer):
+                raise IOError("OBEX receive buffer overflow")
+        self.view[self.end:self.end+len(data)] = data
+        self.end += len(data)
+
+    def fill(self, socket_):
+
+        """Receives as much data as is available from socket_ into the free
+        space of the buffer and returns the number of bytes received."""
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < 0x10000:
+            self._make_room()
+
+        recv_into = getattr(socket_, "recv_into", None)
+        if recv_into is not None:
+            received = recv_into(self.view[self.end:])
+        else:
+            data = socket_.recv(len(self.buffer) - self.end)
+            received = len(data)
+            self.view[self.end:self.end+received] = data
+
+        self.end += received
+        return received
+
+    def next_packet(self):
+
+        """Returns a (type, length, data) tuple for the next complete packet
+        in the buffer, or None if more data needs to be received."""
+
+        if self.end - self.start < 3:
+            return None
+
+        type_, length = struct.unpack_from(">BH", self.buffer, self.start)
+        if length < 3:
+            raise IOError("invalid OBEX packet length %i" % length)
+        if self.end - self.start < length:
+            return None
+
+        # Copy the packet out of the buffer, which will be reused, so that
+        # views of its headers remain valid.
+        data = bytes(self.view[self.start:self.start+length])
+        self.start += length
+        return type_, length, data
+
+    def read_packet(self, socket_):
+
+        """Returns a (type, length, data) tuple for the next packet, receiving
+        from socket_ until a complete packet is available."""
+
+        packet = self.next_packet()
+        while packet is None:
+            if not self.fill(socket_):
+                raise ConnectionError("connection closed by peer")
+            packet = self.next_packet()
+        return packet
+
+
 class MessageHandler:
 
     format = ">BH"
 
-    message_dict = {}
+    # Give out the data of received Body and EndOfBody headers as views of
+    # each packet instead of copying it.
+    body_views = False
 
-    if sys.platform in ["darwin", "win32"]:
+    message_dict = {}
 
-        def _read_packet(self, socket_):
+    def __init__(self):
 
-            data = b""
-            while len(data) < 3:
-                data += socket_.recv(3 - len(data))
-            type_, length = struct.unpack(self.format, data)
-            while len(data) < length:
-                data += socket_.recv(length - len(data))
-            return type_, length, data
-    else:
+        self._readers = weakref.WeakKeyDictionary()
 
-        def _read_packet(self, socket_):
+    def reader(self, socket_):
 
-            data = socket_.recv(32768)
-            print("Receive\n", data)
+        """Returns the PacketReader buffering data received from socket_,
+        creating one on first use."""
 
-            #data = socket_.recv(3, socket.MSG_WAITALL)
-            data1 = data[:3]
-            type_, length = struct.unpack(self.format, data1)
+        try:
+            return self._readers[socket_]
+        except KeyError:
+            reader = self._readers[socket_] = PacketReader()
+            return reader
 
-            print(type_, length, len(data))
+    def _read_packet(self, socket_):
 
-            if len(data) < length:
-                data += socket_.recv(length - len(data))
- 
-            return type_, length, data
+        return self.reader(socket_).read_packet(socket_)
 
     def decode(self, socket_):
 
-        code, length, data = self._read_packet(socket_)
+        return self.decode_packet(*self._read_packet(socket_))
+
+    def decode_packet(self, code, length, data):
+
+        """Returns the message for a complete packet that was received by
+        other means, such as a protocol engine's PacketReader."""
 
         if code in self.message_dict:
             message = self.message_dict[code]()
-            message.read_data(data)
+            message.read_data(data, self.body_views)
             return message
 
         return UnknownResponse(code, length, data)
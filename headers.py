@@ -25,6 +25,9 @@ import struct
 class Header:
     code = None
 
+    # Data referenced by headers created with from_payload().
+    payload = None
+
     def __init__(self, data, encoded=False):
 
         if encoded:
@@ -32,9 +35,23 @@ class Header:
         else:
             self.data = self.encode(data)
 
+    def __getattr__(self, name):
+
+        # Headers created with from_payload() only build their encoded data
+        # if it is asked for.
+        if name == "data" and self.payload is not None:
+            return struct.pack(">BH", self.code,
+                               len(self.payload) + 3) + bytes(self.payload)
+        raise AttributeError(name)
+
     def encode(self, data):
         raise NotImplementedError()
 
+    def encoded_length(self):
+        if self.payload is not None:
+            return len(self.payload) + 3
+        return len(self.data)
+
 
 class UnicodeHeader(Header):
 
@@ -49,7 +66,20 @@ class UnicodeHeader(Header):
 
 class DataHeader(Header):
 
+    @classmethod
+    def from_payload(cls, payload):
+
+        """Returns a header that refers to payload instead of copying it.
+        The payload may be bytes, a memoryview or an mmap; the header ID and
+        length are packed separately when the header is sent."""
+
+        header = cls.__new__(cls)
+        header.payload = payload
+        return header
+
     def decode(self):
+        if self.payload is not None:
+            return self.payload
         return self.data
 
     def encode(self, data):
@@ -143,6 +173,21 @@ class ObjectClass(DataHeader):
     code = 0x51
 
 
+class SingleResponseMode(ByteHeader):
+    code = 0x97
+
+    Disable = 0x00
+    Enable = 0x01
+    Supported = 0x02
+
+
+class SingleResponseModeParameters(ByteHeader):
+    code = 0x98
+
+    # Ask the peer to wait for the next packet before sending its own.
+    Wait = 0x01
+
+
 class UserDefined:
     pass
 
@@ -163,7 +208,9 @@ header_dict = {
     0x4C: AppParameters,
     0x4D: AuthChallenge,
     0x4E: AuthResponse,
-    0x51: ObjectClass
+    0x51: ObjectClass,
+    0x97: SingleResponseMode,
+    0x98: SingleResponseModeParameters
 }
 
 
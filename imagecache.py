@@ -0,0 +1,363 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Byte-bounded cache of image files in shared memory
+
+The server sends image files as they are stored, so the cache keeps their
+contents, keyed by the path, size and modification time of the file. It
+lives in one multiprocessing.shared_memory block, so every worker process
+forked from the process that created it shares the same entries.
+The block holds an arena of fixed size blocks, a map of the blocks in use
+and an open addressing hash table of the entries. Each entry keeps its data
+in a run of consecutive blocks, so a hit is returned as a memoryview of the
+shared buffer without copying. When there is no free run large enough, the
+least recently used entries are evicted.
+
+An entry returned by get or put is pinned until it is released, so that it
+is not overwritten while it is being sent, however long that takes. Each pin
+is recorded with the pid of the process that holds it; the pins of processes
+that have died without releasing them are dropped when space is needed.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import struct
+
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+# Entry states in the hash table
+EMPTY, USED, DELETED, FILLING = range(4)
+
+# state, key digest, first block, number of blocks, length, last use, pins
+ENTRY = struct.Struct("<B16sIIQQI")
+# slot of the pinned entry, pid of the process holding the pin (0 if free)
+PIN = struct.Struct("<II")
+# clock of the last uses, number of DELETED entries
+HEADER = struct.Struct("<QQ")
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _digest(key):
+    """Returns the 16 byte digest of a hashable key made of str, bytes and numbers"""
+    return hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).digest()
+
+
+class ImageCacheStats(object):
+    """Counters of one process's use of a ImageCache"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return ("ImageCacheStats(hits=%i, misses=%i, stores=%i, evictions=%i)"
+                % (self.hits, self.misses, self.stores, self.evictions))
+
+
+class ImageCache(object):
+    """Shared memory cache of up to size bytes of data, in blocks of
+    block_size bytes. Entries larger than max_item_size (a quarter of the
+    cache by default) are not stored. Up to max_pins entries (as many as
+    there are slots by default) may be pinned at once. Create it before
+    forking the processes that share it."""
+
+    def __init__(self, size, block_size=0x1000, max_item_size=None, max_pins=None):
+        self.block_size = block_size
+        self.blocks = max(1, size // block_size)
+        self.max_item_size = max_item_size or self.blocks * block_size // 4
+        self.slots = self.blocks * 2
+        self.max_pins = max_pins or self.slots
+        self.stats = ImageCacheStats()
+
+        self._map_offset = HEADER.size
+        self._table_offset = self._map_offset + self.blocks
+        self._pins_offset = self._table_offset + self.slots * ENTRY.size
+        self._arena_offset = self._pins_offset + self.max_pins * PIN.size
+        total = self._arena_offset + self.blocks * block_size
+
+        self._shm = shared_memory.SharedMemory(create=True, size=total)
+        self._shm.buf[:self._arena_offset] = bytes(self._arena_offset)
+        self._block_map = self._shm.buf[self._map_offset:self._table_offset]
+        self._arena = self._shm.buf[self._arena_offset:total]
+        self._lock = multiprocessing.get_context("fork").Lock()
+        self._owner = os.getpid()
+
+    def get(self, key):
+        """Returns a memoryview of the data stored for key and pins it, or
+        None if there is none"""
+        digest = _digest(key)
+        with self._lock:
+            slot = self._find(digest)
+            if slot is None or not self._pin(slot):
+                self.stats.misses += 1
+                return None
+            entry = self._entry(slot)
+            self._write(slot, entry, last_used=self._tick())
+        self.stats.hits += 1
+        return self._view(entry)
+
+    def put(self, key, length, fill):
+        """Stores length bytes for key, written by fill, a function of a
+        memoryview that returns the number of bytes written into it, and
+        returns a pinned memoryview of them. Returns None if they cannot be
+        stored: if they are too large, if all the space is pinned or if fill
+        writes too little."""
+        if length > self.max_item_size or length == 0:
+            return None
+        digest = _digest(key)
+        nblocks = -(-length // self.block_size)
+
+        with self._lock:
+            if self._find(digest, FILLING) is not None:
+                # Another process is storing it.
+                return None
+            slot = self._find(digest)
+            if slot is not None:
+                # Another process has stored it meanwhile.
+                if not self._pin(slot):
+                    return None
+                entry = self._entry(slot)
+                self._write(slot, entry, last_used=self._tick())
+                return self._view(entry)
+            if self._free_pin() is None:
+                return None
+            first = self._allocate(nblocks)
+            slot = self._free_slot(digest) if first is not None else None
+            if slot is None:
+                if first is not None:
+                    self._block_map[first:first + nblocks] = bytes(nblocks)
+                return None
+            self._write(slot, (FILLING, digest, first, nblocks, length, self._tick(), 0))
+            self._pin(slot)
+            entry = self._entry(slot)
+
+        # Fill the blocks without holding the lock; other processes skip
+        # the entry until it is complete.
+        view = self._view(entry)
+        try:
+            complete = fill(view) == length
+        except Exception:
+            complete = False
+
+        with self._lock:
+            # The table may have been rebuilt meanwhile.
+            slot = self._find(digest, FILLING)
+            if complete:
+                self._write(slot, self._entry(slot), state=USED)
+            else:
+                self._unpin(slot)
+                self._remove(slot)
+        if not complete:
+            view.release()
+            return None
+        self.stats.stores += 1
+        return view
+
+    def put_file(self, key, fileobj, length):
+        """Stores length bytes read from the binary file object fileobj for
+        key, as put does"""
+        def fill(view):
+            count = 0
+            while count < length:
+                read = fileobj.readinto(view[count:])
+                if not read:
+                    break
+                count += read
+            return count
+        return self.put(key, length, fill)
+
+    def release(self, key):
+        """Unpins the data stored for key once it is no longer used"""
+        digest = _digest(key)
+        with self._lock:
+            slot = self._find(digest)
+            if slot is not None:
+                self._unpin(slot)
+
+    def close(self):
+        """Detaches this process from the cache, and frees the shared memory
+        if this is the process that created it. The memoryviews returned
+        must have been released."""
+        self._block_map.release()
+        self._arena.release()
+        try:
+            self._shm.close()
+        except BufferError:
+            # A forked process may hold views inherited from its parent;
+            # the memory is unmapped when it exits.
+            pass
+        if self._owner == os.getpid():
+            self._shm.unlink()
+
+    def _view(self, entry):
+        start = entry[2] * self.block_size
+        return self._arena[start:start + entry[4]]
+
+    def _tick(self):
+        tick, deleted = HEADER.unpack_from(self._shm.buf, 0)
+        HEADER.pack_into(self._shm.buf, 0, tick + 1, deleted)
+        return tick + 1
+
+    def _count_deleted(self, change):
+        tick, deleted = HEADER.unpack_from(self._shm.buf, 0)
+        HEADER.pack_into(self._shm.buf, 0, tick, deleted + change)
+        return deleted + change
+
+    def _entry(self, slot):
+        return ENTRY.unpack_from(self._shm.buf, self._table_offset + slot * ENTRY.size)
+
+    def _write(self, slot, entry, state=None, last_used=None, pins=None):
+        entry = list(entry)
+        for i, value in ((0, state), (5, last_used), (6, pins)):
+            if value is not None:
+                entry[i] = value
+        ENTRY.pack_into(self._shm.buf, self._table_offset + slot * ENTRY.size, *entry)
+
+    def _pin_record(self, i):
+        return PIN.unpack_from(self._shm.buf, self._pins_offset + i * PIN.size)
+
+    def _free_pin(self):
+        for i in range(self.max_pins):
+            if self._pin_record(i)[1] == 0:
+                return i
+        # Drop the pins of dead processes to make room.
+        self._reap()
+        for i in range(self.max_pins):
+            if self._pin_record(i)[1] == 0:
+                return i
+        return None
+
+    def _pin(self, slot):
+        """Pins the entry in slot for this process; returns False if there
+        are too many pins"""
+        i = self._free_pin()
+        if i is None:
+            return False
+        PIN.pack_into(self._shm.buf, self._pins_offset + i * PIN.size, slot, os.getpid())
+        entry = self._entry(slot)
+        self._write(slot, entry, pins=entry[6] + 1)
+        return True
+
+    def _unpin(self, slot):
+        pid = os.getpid()
+        for i in range(self.max_pins):
+            if self._pin_record(i) == (slot, pid):
+                PIN.pack_into(self._shm.buf, self._pins_offset + i * PIN.size, 0, 0)
+                entry = self._entry(slot)
+                self._write(slot, entry, pins=max(0, entry[6] - 1))
+                return
+
+    def _reap(self):
+        """Drops the pins of the processes that have exited; returns True
+        if there were any"""
+        alive = {}
+        reaped = False
+        for i in range(self.max_pins):
+            slot, pid = self._pin_record(i)
+            if pid == 0:
+                continue
+            if pid not in alive:
+                alive[pid] = _process_exists(pid)
+            if not alive[pid]:
+                PIN.pack_into(self._shm.buf, self._pins_offset + i * PIN.size, 0, 0)
+                entry = self._entry(slot)
+                self._write(slot, entry, pins=max(0, entry[6] - 1))
+                reaped = True
+        return reaped
+
+    def _probe(self, digest):
+        start = int.from_bytes(digest[:8], "little") % self.slots
+        for i in range(self.slots):
+            yield (start + i) % self.slots
+
+    def _find(self, digest, state=USED):
+        for slot in self._probe(digest):
+            entry = self._entry(slot)
+            if entry[0] == EMPTY:
+                return None
+            if entry[0] == state and entry[1] == digest:
+                return slot
+        return None
+
+    def _free_slot(self, digest):
+        for slot in self._probe(digest):
+            state = self._entry(slot)[0]
+            if state == DELETED:
+                self._count_deleted(-1)
+            if state in (EMPTY, DELETED):
+                return slot
+        return None
+
+    def _remove(self, slot):
+        entry = self._entry(slot)
+        self._block_map[entry[2]:entry[2] + entry[3]] = bytes(entry[3])
+        self._write(slot, entry, state=DELETED)
+        deleted = self._count_deleted(1)
+        # A tombstone followed by an empty slot ends no probe that an empty
+        # slot would not, so clear the run of them that ends here.
+        while (self._entry(slot)[0] == DELETED and
+               self._entry((slot + 1) % self.slots)[0] == EMPTY):
+            self._write(slot, self._entry(slot), state=EMPTY)
+            deleted = self._count_deleted(-1)
+            slot = (slot - 1) % self.slots
+        # Otherwise misses would probe ever longer runs of tombstones.
+        if deleted > self.slots // 4:
+            self._rebuild()
+
+    def _rebuild(self):
+        """Inserts the entries again into an empty table, without
+        tombstones, and moves their pins with them"""
+        entries = [(slot, self._entry(slot)) for slot in range(self.slots)
+                   if self._entry(slot)[0] in (USED, FILLING)]
+        self._shm.buf[self._table_offset:self._pins_offset] = bytes(self._pins_offset - self._table_offset)
+        moved = {}
+        for slot, entry in entries:
+            moved[slot] = self._free_slot(entry[1])
+            self._write(moved[slot], entry)
+        for i in range(self.max_pins):
+            slot, pid = self._pin_record(i)
+            if pid:
+                PIN.pack_into(self._shm.buf, self._pins_offset + i * PIN.size, moved[slot], pid)
+        self._count_deleted(-HEADER.unpack_from(self._shm.buf, 0)[1])
+
+    def _allocate(self, nblocks):
+        """Marks a run of nblocks free blocks as used, evicting the least
+        recently used entries that are not pinned until there is one, and
+        returns its first block, or None"""
+        while True:
+            first = bytes(self._block_map).find(bytes(nblocks))
+            if first >= 0:
+                self._block_map[first:first + nblocks] = b"\x01" * nblocks
+                return first
+            if not self._evict():
+                return None
+
+    def _evict(self):
+        victim = None
+        for slot in range(self.slots):
+            entry = self._entry(slot)
+            if entry[0] != USED or entry[6]:
+                continue
+            if victim is None or entry[5] < victim[1]:
+                victim = (slot, entry[5])
+        if victim is None:
+            # Everything is pinned; some of the pins may be of dead processes.
+            return self._reap() and self._evict()
+        self._remove(victim[0])
+        self.stats.evictions += 1
+        return True
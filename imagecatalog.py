@@ -0,0 +1,478 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Index of the images that BIPServer serves from its image directory
+
+Images are files named <handle>_<anything>.jpg, where the handle is the
+7 digit image handle of BIP. The index maps each handle to an ImageEntry
+describing its file, so requests find their image without scanning the
+directory. A CatalogStore keeps the entries in an SQLite database between
+runs, so that only new and changed files have to be read at startup.
+An ImageListing answers the images-listing queries of one generation of
+the index from arrays sorted by handle, created and modified time.
+"""
+
+import bisect
+import collections
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+IMAGE_NAME = re.compile(r"^(\d{7})_.*\.jpg$")
+
+# created and modified are seconds since the epoch; width, height and
+# encoding are None if the file cannot be read as an image. mtime_ns is the
+# modification time that the entry was read at and digest the BLAKE2b hash
+# of the file's content, if it was computed.
+ImageEntry = collections.namedtuple(
+    "ImageEntry", "handle path size width height encoding created modified mtime_ns digest")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    handle TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    encoding TEXT,
+    created REAL NOT NULL,
+    modified REAL NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT
+);
+CREATE INDEX IF NOT EXISTS images_handle ON images (directory, handle, path);
+DROP INDEX IF EXISTS images_created;
+DROP INDEX IF EXISTS images_modified;
+"""
+
+COLUMNS = "path, handle, size, width, height, encoding, created, modified, mtime_ns, digest"
+
+
+def image_handle(name):
+    """Returns the image handle of the file name, or None if it is not an image"""
+    match = IMAGE_NAME.match(name)
+    return match.group(1) if match else None
+
+
+def scan_files(rootdir):
+    """Returns {path: (size, mtime_ns)} of the image files in rootdir, or
+    None if rootdir does not exist"""
+    files = {}
+    try:
+        with os.scandir(rootdir) as scan:
+            for dir_entry in scan:
+                if image_handle(dir_entry.name) is None:
+                    continue
+                try:
+                    if not dir_entry.is_file():
+                        continue
+                    status = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                files[dir_entry.path] = (status.st_size, status.st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    return files
+
+
+def file_digest(path):
+    """Returns the hexadecimal BLAKE2b digest of the content of the file at path"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(0x10000), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_entry(path, status=None, digest=False):
+    """Returns the ImageEntry of the image file at path, whose os.stat result
+    may be given, with the digest of its content if digest is True"""
+    if status is None:
+        status = os.stat(path)
+    width = height = encoding = None
+    try:
+        # Only the header of the image is read.
+        with Image.open(path) as img:
+            width, height, encoding = img.width, img.height, img.format
+    except (OSError, ValueError) as err:
+        logger.warning("cannot read image %s: %s", path, err)
+    content_digest = None
+    if digest:
+        try:
+            content_digest = file_digest(path)
+        except FileNotFoundError:
+            raise
+        except OSError as err:
+            logger.warning("cannot hash image %s: %s", path, err)
+    created = getattr(status, "st_birthtime", status.st_mtime)
+    return ImageEntry(image_handle(os.path.basename(path)), path, status.st_size,
+                      width, height, encoding, created, status.st_mtime,
+                      status.st_mtime_ns, content_digest)
+
+
+class CatalogStore(object):
+    """Catalog of the images of any number of directories, kept in the
+    SQLite database filename.
+
+    sync() compares the size and modification time of each file with those
+    stored, and only reads the files that are new or have changed. Lookups
+    by handle use an index; listings are answered from the entries in
+    memory by ImageListing. One store may be used from several threads, and
+    from processes forked after it was made, which open their own
+    connection.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._pid = None
+        self._db = None
+        with self._lock:
+            with self._connection() as db:
+                db.executescript(SCHEMA)
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.filename, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._db
+
+    def sync(self, rootdir):
+        """Updates the entries of the images in rootdir from its files and
+        returns the numbers of entries (updated, removed)"""
+        rootdir = os.path.abspath(rootdir)
+        known = self.files(rootdir)
+        current = scan_files(rootdir) or {}
+
+        updated = []
+        for path, status in current.items():
+            if known.get(path) == status:
+                continue
+            try:
+                updated.append(read_entry(path, digest=True))
+            except FileNotFoundError:
+                pass
+        updated_paths = set(entry.path for entry in updated)
+        removed = [path for path in known
+                   if path not in current or (known[path] != current[path] and path not in updated_paths)]
+
+        self.update(updated, removed)
+        logger.info("catalog of %s: %u updated, %u removed, %u unchanged",
+                    rootdir, len(updated), len(removed), len(current) - len(updated))
+        return len(updated), len(removed)
+
+    def files(self, rootdir):
+        """Returns {path: (size, mtime_ns)} of the files of rootdir in the catalog"""
+        with self._lock:
+            return dict(((path, (size, mtime_ns)) for path, size, mtime_ns in
+                         self._connection().execute(
+                             "SELECT path, size, mtime_ns FROM images WHERE directory = ?",
+                             (os.path.abspath(rootdir),))))
+
+    def update(self, entries, removed=()):
+        """Adds or replaces entries and removes the entries of the image
+        files at the paths removed, in one transaction"""
+        with self._lock:
+            with self._connection() as db:
+                db.executemany("INSERT OR REPLACE INTO images (directory, %s) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % COLUMNS,
+                               [self._row(entry) for entry in entries])
+                db.executemany("DELETE FROM images WHERE path = ?",
+                               [(os.path.abspath(path),) for path in removed])
+
+    def entry(self, rootdir, handle):
+        """Returns the ImageEntry of handle in rootdir, or None"""
+        entries = self._query("directory = ? AND handle = ? ORDER BY path LIMIT 1",
+                              (os.path.abspath(rootdir), handle))
+        return entries[0] if entries else None
+
+    def entries(self, rootdir):
+        """Returns the ImageEntry of each image in rootdir ordered by handle"""
+        return self._query("directory = ? ORDER BY handle, path", (os.path.abspath(rootdir),))
+
+    def _query(self, condition, parameters):
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT %s FROM images WHERE %s" % (COLUMNS, condition), parameters).fetchall()
+        return [ImageEntry(handle, path, *values) for path, handle, *values in rows]
+
+    @staticmethod
+    def _row(entry):
+        return (os.path.dirname(os.path.abspath(entry.path)), entry.path, entry.handle, entry.size, entry.width, entry.height,
+                entry.encoding, entry.created, entry.modified, entry.mtime_ns, entry.digest)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self._pid = None
+
+
+class ImageListing(object):
+    """The images of one generation of an ImageIndex, sorted for listings.
+
+    entries are sorted by handle; the images are referred to by their
+    position in it. created and modified are the times of the images in
+    ascending order, for bisect, and by_created and by_modified the
+    positions of the images in the same order.
+    """
+
+    def __init__(self, entries, generation=0):
+        self.generation = generation
+        self.entries = sorted(entries, key=lambda entry: entry.handle)
+        positions = range(len(self.entries))
+        self.by_created = sorted(positions, key=lambda position: self.entries[position].created)
+        self.by_modified = sorted(positions, key=lambda position: self.entries[position].modified)
+        self.created = [self.entries[position].created for position in self.by_created]
+        self.modified = [self.entries[position].modified for position in self.by_modified]
+        # Rank of each position in by_created
+        self._created_rank = [0] * len(self.entries)
+        for rank, position in enumerate(self.by_created):
+            self._created_rank[position] = rank
+
+    def __len__(self):
+        return len(self.entries)
+
+    def select(self, created=None, modified=None, accept=None, latest=False):
+        """Returns the positions of the images created and modified in the
+        (start, end) ranges of epoch seconds given, if any, and accepted by
+        the function accept of an ImageEntry, if given. They are in handle
+        order, or in created order if latest is True; page() then takes the
+        newest first. The ranges are found by bisection, and only the images
+        in the first range are looked at."""
+        if created is not None:
+            positions = self.by_created[bisect.bisect_left(self.created, created[0]):
+                                        bisect.bisect_right(self.created, created[1])]
+            order = "created"
+        elif modified is not None:
+            positions = self.by_modified[bisect.bisect_left(self.modified, modified[0]):
+                                         bisect.bisect_right(self.modified, modified[1])]
+            order = "modified"
+        elif latest:
+            positions = self.by_created
+            order = "created"
+        else:
+            positions = range(len(self.entries))
+            order = "handle"
+
+        if created is not None and modified is not None:
+            start, end = modified
+            positions = [position for position in positions
+                         if start <= self.entries[position].modified <= end]
+        if accept is not None:
+            positions = [position for position in positions if accept(self.entries[position])]
+
+        if latest and order != "created":
+            positions = sorted(positions, key=self._created_rank.__getitem__)
+        elif not latest and order != "handle":
+            positions = sorted(positions)
+        return positions
+
+    def page(self, positions, offset, count, latest=False):
+        """Returns the ImageEntry of count images of positions from offset,
+        counting from the end if latest is True"""
+        if latest:
+            end = max(0, len(positions) - offset)
+            page = positions[max(0, end - count):end][::-1]
+        else:
+            page = positions[offset:offset + count]
+        return [self.entries[position] for position in page]
+
+
+class ImageIndex(object):
+    """Maps the handles of the images in rootdir to their ImageEntry.
+
+    refresh() rescans the directory and replaces the whole mapping at once,
+    so a lookup sees either the old index or the new one. Lookups do not
+    lock. If there are several files for one handle, the first by name is
+    used. If a CatalogStore is given, the index is loaded from it after it
+    has been brought up to date, and changes are saved in it.
+
+    generation counts the changes of the index: it is incremented each time
+    the mapping is replaced. Without a store, the status of every file of
+    each handle is kept, so that when the file used for a handle is removed
+    the next one takes its place.
+    """
+
+    def __init__(self, rootdir, store=None):
+        self.rootdir = os.path.abspath(rootdir)
+        self.store = store
+        self.generation = 0
+        self._entries = {}
+        self._files = {}
+        self._listing = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Rebuilds the index from the files in rootdir, which is empty if
+        rootdir does not exist"""
+        if self.store is not None:
+            self.store.sync(self.rootdir)
+            self._load()
+            return
+        entries = {}
+        files = {}
+        for path, status in sorted((scan_files(self.rootdir) or {}).items()):
+            handle = image_handle(os.path.basename(path))
+            if handle not in entries:
+                try:
+                    entries[handle] = read_entry(path)
+                except FileNotFoundError:
+                    continue
+            files.setdefault(handle, {})[path] = status
+        self._replace(entries, files)
+
+    def _load(self):
+        entries = {}
+        for entry in self.store.entries(self.rootdir):
+            entries.setdefault(entry.handle, entry)
+        self._replace(entries)
+
+    def _replace(self, entries, files=None):
+        with self._lock:
+            self._entries = entries
+            self._files = files or {}
+            self.generation += 1
+        logger.info("indexed %u images in %s", len(entries), self.rootdir)
+
+    def files(self):
+        """Returns {path: (size, mtime_ns)} of the files indexed, or of all
+        the files of rootdir in the store if there is one"""
+        if self.store is not None:
+            return self.store.files(self.rootdir)
+        return dict((path, status) for files in self._files.values() for path, status in files.items())
+
+    def changed_paths(self, current=None):
+        """Returns the paths of the image files that are new, changed or
+        removed in rootdir since they were indexed. Only their status is
+        read. current is the scan_files() result of rootdir, if known."""
+        if current is None:
+            current = scan_files(self.rootdir) or {}
+        known = self.files()
+        changed = [path for path, status in current.items() if known.get(path) != status]
+        changed.extend(path for path in known if path not in current)
+        return changed
+
+    def follow(self):
+        """Catches up with the changes made to rootdir since the index was
+        built or last followed, as found by a watcher in another process:
+        loads the index from the store, or else reads the changed files"""
+        if self.store is not None:
+            self._load()
+        else:
+            self.update(self.changed_paths())
+
+    def get(self, handle):
+        """Returns the ImageEntry of handle, or None"""
+        return self._entries.get(handle)
+
+    def listing(self):
+        """Returns the ImageListing of the current generation, which is
+        sorted when it is first asked for"""
+        listing = self._listing
+        if listing is None or listing.generation != self.generation:
+            with self._lock:
+                entries, generation = self._entries, self.generation
+            listing = ImageListing(entries.values(), generation)
+            self._listing = listing
+        return listing
+
+    def add(self, path):
+        """Adds or updates the entry of the image file at path and returns
+        the entry of its handle"""
+        self.update([path])
+        return self.get(image_handle(os.path.basename(path)))
+
+    def update(self, paths):
+        """Adds, updates or removes the entries of the image files at paths,
+        as the files are now, and returns the new generation. The files are
+        read before the index is locked."""
+        updated = []
+        removed = []
+        for path in paths:
+            try:
+                updated.append(read_entry(path, digest=self.store is not None))
+            except FileNotFoundError:
+                removed.append(path)
+        files = None
+        others = {}
+        if self.store is not None:
+            self.store.update(updated, removed)
+        else:
+            files = self._update_files(updated, removed)
+            # The entries of the files that take the place of removed ones
+            for path in removed:
+                handle = image_handle(os.path.basename(path))
+                current = self._entries.get(handle)
+                if current is not None and current.path == path:
+                    others[handle] = self._first_entry(files.get(handle, {}))
+
+        with self._lock:
+            entries = dict(self._entries)
+            for entry in updated:
+                current = entries.get(entry.handle)
+                if current is None or entry.path <= current.path:
+                    entries[entry.handle] = entry
+            for path in removed:
+                handle = image_handle(os.path.basename(path))
+                current = entries.get(handle)
+                if current is None or current.path != path:
+                    continue
+                # Another file of the same handle, if there is one
+                if self.store is not None:
+                    other = self.store.entry(self.rootdir, handle)
+                else:
+                    other = others.get(handle)
+                if other is not None:
+                    entries[handle] = other
+                else:
+                    del entries[handle]
+            self._entries = entries
+            if files is not None:
+                self._files = files
+            self.generation += 1
+            return self.generation
+
+    def _update_files(self, updated, removed):
+        """Returns a copy of the {handle: {path: (size, mtime_ns)}} of the
+        files of each handle, with the updated entries and without the
+        removed paths"""
+        files = dict(self._files)
+        for entry in updated:
+            files[entry.handle] = dict(files.get(entry.handle, ()))
+            files[entry.handle][entry.path] = (entry.size, entry.mtime_ns)
+        for path in removed:
+            handle = image_handle(os.path.basename(path))
+            if path not in files.get(handle, ()):
+                continue
+            files[handle] = dict(files[handle])
+            del files[handle][path]
+            if not files[handle]:
+                del files[handle]
+        return files
+
+    @staticmethod
+    def _first_entry(paths):
+        """Returns the entry of the first of paths by name that can still
+        be read, or None"""
+        for path in sorted(paths):
+            try:
+                return read_entry(path)
+            except FileNotFoundError:
+                pass
+        return None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
@@ -0,0 +1,212 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Watcher that keeps an imagecatalog.ImageIndex up to date with its directory
+
+Images created, modified and deleted in the directory while the server runs
+are found with inotify, called through ctypes, or where it is not available
+by polling the size and modification time of the files with scandir. The
+changed files are applied to the index in small batches from a background
+thread; requests keep using the previous index until each batch is in.
+
+Only one watcher should write a CatalogStore. Worker processes that do not
+run it follow its changes with ImageIndex.follow() when the shared
+generation it publishes moves on.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+import imagecatalog
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) flags
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+
+# watch descriptor, mask, cookie, length of the name that follows
+EVENT = struct.Struct("iIII")
+
+# Returned by the sources when the whole directory has to be scanned again
+RESCAN = None
+
+
+class InotifySource(object):
+    """Changed file names in rootdir, from inotify"""
+
+    def __init__(self, rootdir):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if libc.inotify_add_watch(self.fd, os.fsencode(rootdir), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), rootdir)
+
+    def changes(self, timeout, stopped):
+        """Waits up to timeout seconds for events and returns the set of
+        names changed, or RESCAN"""
+        names = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            try:
+                data = os.read(self.fd, 0x10000)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    logger.warning("inotify: events lost or directory moved, rescanning")
+                    return RESCAN
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingSource(object):
+    """Changed file names in rootdir, from comparing the size and
+    modification time of its images between scans. files is the
+    imagecatalog.scan_files() result to compare the first scan with."""
+
+    def __init__(self, rootdir, files=None):
+        self.rootdir = rootdir
+        self.files = files
+
+    def changes(self, timeout, stopped):
+        """Waits timeout seconds and returns the set of names changed, or
+        RESCAN if rootdir has been created again"""
+        if stopped.wait(timeout):
+            return set()
+        files = imagecatalog.scan_files(self.rootdir)
+        if files is not None and self.files is None:
+            self.files = files
+            return RESCAN
+        current = files or {}
+        previous = self.files or {}
+        names = set(os.path.basename(path) for path, status in current.items()
+                    if previous.get(path) != status)
+        names.update(os.path.basename(path) for path in previous if path not in current)
+        # None while rootdir does not exist, so that its creation is seen
+        self.files = files
+        return names
+
+    def close(self):
+        pass
+
+
+class ImageWatcher(object):
+    """Applies the changes to the images of index.rootdir to index, batch_size
+    files at a time. Polls every interval seconds if inotify cannot be used.
+
+    The source of changes is opened, and the directory compared with the
+    index, by the watcher's thread, so starting it does not wait for the
+    directory. The comparison only reads the status of the files, and is
+    skipped at the start if catch_up is False because the index has just
+    been built. It is done again whenever the source has to be opened
+    again, as when the directory is removed and created again or events
+    were lost.
+
+    shared_generation, a multiprocessing.Value, is set to the generation of
+    the index after each batch, for processes that follow the index.
+    """
+
+    def __init__(self, index, interval=1.0, batch_size=32, catch_up=True, shared_generation=None):
+        self.index = index
+        self.interval = interval
+        self.batch_size = batch_size
+        self.catch_up = catch_up
+        self.shared_generation = shared_generation
+        self._source = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="ImageWatcher", daemon=True)
+
+    @property
+    def generation(self):
+        """The generation of the index, incremented by each batch applied"""
+        return self.index.generation
+
+    def start(self):
+        """Watches from a daemon thread"""
+        self._thread.start()
+        return self
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _open_source(self, catch_up):
+        """Opens the source of changes, and returns the names of the files
+        that have changed since they were indexed if catch_up is True"""
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        rootdir = self.index.rootdir
+        try:
+            self._source = InotifySource(rootdir)
+        except (OSError, AttributeError) as err:
+            # AttributeError: the C library has no inotify. A directory that
+            # does not exist is polled until it is created.
+            logger.info("inotify not available (%s), polling %s", err, rootdir)
+        if self._source is not None and not catch_up:
+            return set()
+        current = imagecatalog.scan_files(rootdir)
+        if self._source is None:
+            self._source = PollingSource(rootdir, current)
+        return set(os.path.basename(path) for path in self.index.changed_paths(current or {}))
+
+    def _apply(self, names):
+        paths = sorted(os.path.join(self.index.rootdir, name) for name in names
+                       if imagecatalog.image_handle(name) is not None)
+        for start in range(0, len(paths), self.batch_size):
+            generation = self.index.update(paths[start:start + self.batch_size])
+            logger.debug("image index generation %u", generation)
+            if self.shared_generation is not None:
+                self.shared_generation.value = generation
+
+    def run(self):
+        """Watches until stop() is called"""
+        catch_up = self.catch_up
+        names = RESCAN
+        while not self._stopped.is_set():
+            try:
+                if names is RESCAN:
+                    names = self._open_source(catch_up)
+                    catch_up = True
+                self._apply(names)
+                names = self._source.changes(self.interval, self._stopped)
+            except Exception as err:
+                # Look at the whole directory again, so that no change is lost.
+                logger.error("watching %s: %s", self.index.rootdir, err)
+                names = RESCAN
+                self._stopped.wait(self.interval)
+        if self._source is not None:
+            self._source.close()
@@ -0,0 +1,348 @@
+"""
+linkemu.py - A local stand-in for a Bluetooth L2CAP link.
+
+This file is part of the PyOBEX Python package.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import collections
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+
+from transports import Transport, UnixTransport
+
+logger = logging.getLogger(__name__)
+
+
+class LinkProfile:
+
+    """LinkProfile(mtu=1024, latency=0.015, bandwidth=175000, mode=3,
+                   tx_win_size=5, max_tx=10, loss=0.0,
+                   retransmit_delay=0.1, mps=None, frame_overhead=10)
+
+    Describes one direction of an emulated L2CAP link.
+
+    mtu is the largest SDU that may be sent, which on a real link is the
+    smaller of the sender's omtu and the receiver's imtu. Each SDU is sent
+    as I-frames of at most mps bytes (mtu if None), each costing
+    frame_overhead extra bytes on air. bandwidth is in bytes per second and
+    latency is the one-way delay in seconds.
+
+    In ERTM (mode 3) at most tx_win_size frames may be unacknowledged; a
+    frame is acknowledged one latency after it arrives. Each transmission of
+    a frame is lost with probability loss and repeated after
+    retransmit_delay seconds; after max_tx transmissions the link fails. In
+    basic mode (mode 0) there is no window and no loss.
+    """
+
+    def __init__(self, mtu=1024, latency=0.015, bandwidth=175000, mode=3,
+                 tx_win_size=5, max_tx=10, loss=0.0, retransmit_delay=0.1,
+                 mps=None, frame_overhead=10):
+
+        self.mtu = mtu
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.mode = mode
+        self.tx_win_size = tx_win_size
+        self.max_tx = max_tx
+        self.loss = loss
+        self.retransmit_delay = retransmit_delay
+        self.mps = mps or mtu
+        self.frame_overhead = frame_overhead
+
+    @classmethod
+    def from_l2cap_options(cls, sender, receiver, **kwargs):
+
+        """Returns the profile of the direction from a socket with the
+        L2CAPTransport options sender to one with the options receiver."""
+
+        kwargs.setdefault("mtu", min(sender.get("omtu", 672),
+                                     receiver.get("imtu", 672)))
+        for name in ("mode", "max_tx", "tx_win_size"):
+            if name in sender:
+                kwargs.setdefault(name, sender[name])
+        return cls(**kwargs)
+
+
+# The L2CAP options that bipserver.run_server and bipclient.REPL.do_connect
+# set on their sockets.
+BIP_SERVER_OPTIONS = {"omtu": 1024, "imtu": 1024, "mode": 3, "max_tx": 10,
+                      "tx_win_size": 5}
+BIP_CLIENT_OPTIONS = {"omtu": 4096, "imtu": 4096, "mode": 3, "max_tx": 10,
+                      "tx_win_size": 5}
+
+# Named (client to server, server to client) profiles. "coverart" is the
+# link between BIPClient and BIPServer with their default options on a
+# typical BR/EDR connection; "lossy" adds 2% frame loss to it.
+profiles = {
+    "coverart": (
+        LinkProfile.from_l2cap_options(BIP_CLIENT_OPTIONS,
+                                       BIP_SERVER_OPTIONS),
+        LinkProfile.from_l2cap_options(BIP_SERVER_OPTIONS,
+                                       BIP_CLIENT_OPTIONS)),
+    "lossy": (
+        LinkProfile.from_l2cap_options(BIP_CLIENT_OPTIONS,
+                                       BIP_SERVER_OPTIONS, loss=0.02),
+        LinkProfile.from_l2cap_options(BIP_SERVER_OPTIONS,
+                                       BIP_CLIENT_OPTIONS, loss=0.02)),
+    "basic": (
+        LinkProfile(mtu=1024, mode=0),
+        LinkProfile(mtu=1024, mode=0)),
+}
+
+
+class LinkStats:
+
+    """Counters for one direction of an emulated link."""
+
+    def __init__(self):
+
+        self.sdus = 0
+        self.bytes = 0
+        self.frames = 0
+        self.retransmissions = 0
+        self.window_stalls = 0
+
+    def __repr__(self):
+
+        return ("LinkStats(sdus=%i, bytes=%i, frames=%i, retransmissions=%i,"
+                " window_stalls=%i)" % (self.sdus, self.bytes, self.frames,
+                                        self.retransmissions,
+                                        self.window_stalls))
+
+
+class LinkFailure(IOError):
+
+    pass
+
+
+class Channel:
+
+    """Channel(profile, rng=None)
+
+    Works out when each SDU sent in one direction of a link arrives. The
+    model is sequential: frames are sent back to back as the window allows,
+    and a lost frame holds up the frames behind it until it has been
+    retransmitted, as ERTM delivers SDUs in order.
+    """
+
+    def __init__(self, profile, rng=None):
+
+        self.profile = profile
+        self.rng = rng or random.Random()
+        self.stats = LinkStats()
+        self._free_at = 0.0
+        self._acks = collections.deque()
+
+    def arrival_time(self, size, now):
+
+        """Returns the time at which an SDU of size bytes, handed to the link
+        at now, has been received completely."""
+
+        profile = self.profile
+        if size > profile.mtu:
+            raise LinkFailure("SDU of %i bytes exceeds the MTU of %i"
+                              % (size, profile.mtu))
+
+        ertm = profile.mode == 3
+        t = max(now, self._free_at)
+        arrival = t
+        remaining = size
+        while True:
+
+            frame = min(remaining, profile.mps)
+            remaining -= frame
+
+            if ertm:
+                while self._acks and self._acks[0] <= t:
+                    self._acks.popleft()
+                if len(self._acks) >= profile.tx_win_size:
+                    self.stats.window_stalls += 1
+                    t = self._acks.popleft()
+
+            frame_time = (frame + profile.frame_overhead) / profile.bandwidth
+            for _ in range(profile.max_tx if ertm else 1):
+                t += frame_time
+                self.stats.frames += 1
+                if not ertm or self.rng.random() >= profile.loss:
+                    break
+                self.stats.retransmissions += 1
+                t += profile.retransmit_delay
+            else:
+                raise LinkFailure("frame lost %i times" % profile.max_tx)
+
+            arrival = t + profile.latency
+            if ertm:
+                self._acks.append(arrival + profile.latency)
+
+            if remaining <= 0:
+                break
+
+        self._free_at = t
+        self.stats.sdus += 1
+        self.stats.bytes += size
+        return arrival
+
+
+class Link:
+
+    """Link(a, b, link_profiles=None, seed=None)
+
+    Relays SDUs between the sockets a and b, delaying each one as an L2CAP
+    link described by link_profiles, a (a to b, b to a) pair of LinkProfile
+    objects, would. The "coverart" profiles are used by default. Each
+    direction uses one thread to receive and one to deliver.
+    """
+
+    def __init__(self, a, b, link_profiles=None, seed=None):
+
+        if link_profiles is None:
+            link_profiles = profiles["coverart"]
+        rng = random.Random(seed)
+
+        self.sockets = (a, b)
+        self.channels = (Channel(link_profiles[0], rng),
+                         Channel(link_profiles[1], rng))
+        self.failed = False
+
+        for source, destination, channel in ((a, b, self.channels[0]),
+                                             (b, a, self.channels[1])):
+            deliveries = queue.Queue()
+            threading.Thread(target=self._receive,
+                             args=(source, channel, deliveries),
+                             daemon=True).start()
+            threading.Thread(target=self._deliver,
+                             args=(destination, deliveries),
+                             daemon=True).start()
+
+    @property
+    def stats(self):
+
+        return tuple(channel.stats for channel in self.channels)
+
+    def _receive(self, source, channel, deliveries):
+
+        try:
+            while True:
+                data = source.recv(0x10000)
+                if not data:
+                    break
+                deliveries.put(
+                    (channel.arrival_time(len(data), time.monotonic()), data))
+        except LinkFailure as err:
+            logger.warning("emulated link failed: %s", err)
+            self.failed = True
+        except OSError:
+            pass
+        deliveries.put(None)
+
+    def _deliver(self, destination, deliveries):
+
+        try:
+            while True:
+                item = deliveries.get()
+                if item is None or self.failed:
+                    break
+                arrival, data = item
+                delay = arrival - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                destination.sendall(data)
+        except OSError:
+            pass
+
+        if self.failed:
+            self.close()
+        else:
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+
+        for socket_ in self.sockets:
+            try:
+                socket_.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class EmulatedLinkTransport(Transport):
+
+    """EmulatedLinkTransport(profile="coverart", transport=None, seed=None)
+
+    A transport that behaves like an L2CAP link between two local sockets.
+
+    Connections are made with the underlying transport, which must keep
+    packet boundaries like the default Unix SOCK_SEQPACKET sockets, and
+    relayed through a Link with the named profiles, or a
+    (client to server, server to client) pair of LinkProfile objects. Point
+    both the client and the server at an instance so that the server sees
+    the emulated MTU. The links created are kept in the links attribute for
+    their statistics.
+    """
+
+    def __init__(self, profile="coverart", transport=None, seed=None):
+
+        if isinstance(profile, str):
+            profile = profiles[profile]
+        self.profiles = profile
+        self.transport = transport or UnixTransport()
+        self.seed = seed
+        self.links = []
+
+    @property
+    def bluetooth(self):
+
+        return self.transport.bluetooth
+
+    def socket_address(self, address, port=None):
+
+        return self.transport.socket_address(address, port)
+
+    def listen(self, address, port=None, backlog=1):
+
+        # The link is emulated by the connecting side.
+        return self.transport.listen(address, port, backlog)
+
+    def connect(self, address, port=None):
+
+        remote = self.transport.connect(address, port)
+        local, relay = socket.socketpair(socket.AF_UNIX,
+                                         socket.SOCK_SEQPACKET)
+        self.links.append(Link(relay, remote, self.profiles, self.seed))
+        return local
+
+    def pair(self):
+
+        """Returns a (client, server) pair of sockets joined by a link."""
+
+        client, client_relay = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_SEQPACKET)
+        server, server_relay = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_SEQPACKET)
+        self.links.append(Link(client_relay, server_relay, self.profiles,
+                               self.seed))
+        return client, server
+
+    def mtu(self, socket_):
+
+        _ = socket_
+        return min(profile.mtu for profile in self.profiles)
@@ -0,0 +1,689 @@
+"""
+protocol.py - OBEX protocol engines that do no I/O of their own.
+
+This file is part of the PyOBEX Python package.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import collections
+import copy
+import itertools
+
+from common import FilePayload, FrameEncoder, ObexVersion, PacketReader
+import headers
+import requests
+import responses
+
+
+class ProtocolError(IOError):
+
+    pass
+
+
+class Event:
+
+    pass
+
+
+class RequestReceived(Event):
+
+    """A complete request that the application should respond to."""
+
+    def __init__(self, request):
+
+        self.request = request
+
+
+class ResponseReceived(Event):
+
+    """A response to the request in progress. The operation is complete
+    when final is True."""
+
+    def __init__(self, request, response, final):
+
+        self.request = request
+        self.response = response
+        self.final = final
+
+
+class OperationAborted(Event):
+
+    """The peer aborted the operation in progress. The Abort request has
+    already been answered."""
+
+    def __init__(self, request):
+
+        self.request = request
+
+
+class ConnectionClosed(Event):
+
+    pass
+
+
+def _srm_values(message):
+
+    """Returns the values of the SingleResponseMode and
+    SingleResponseModeParameters headers of message, with None for those
+    that it does not contain."""
+
+    header_data = message.header_data
+    values = []
+    for header_class in (headers.SingleResponseMode,
+                         headers.SingleResponseModeParameters):
+        value = None
+        for header in header_data:
+            if isinstance(header, header_class):
+                value = header.decode()
+                break
+        values.append(value)
+    return values
+
+
+def _payload(header):
+
+    """Returns the data of a Body or EndOfBody header without its header ID
+    and length: a memoryview, or a FilePayload."""
+
+    if isinstance(header.payload, FilePayload):
+        return header.payload
+    if header.payload is not None:
+        return memoryview(header.payload)
+    return memoryview(header.data)[3:]
+
+
+def _split(payload, size):
+
+    """Returns the first size bytes of payload and the rest of it."""
+
+    if isinstance(payload, FilePayload):
+        return payload.read(size), payload
+    return payload[:size], payload[size:]
+
+
+class ObexProtocol:
+
+    """ObexProtocol(max_packet_length=0xffff)
+
+    Base class of the OBEX state machines shared by the blocking, threaded
+    and asyncio front-ends.
+
+    The engine never touches a socket. Received data is passed to
+    receive_data(), which returns a list of events. Messages to be sent are
+    passed to send(), which returns the bytes to transmit; packets that the
+    engine produces by itself, such as the continuations of a multi-packet
+    operation, are collected with data_to_send() or, for front-ends that
+    encode messages themselves, next_message().
+
+    If srm is set to True, Get and Put operations use OBEX Single Response
+    Mode when the peer agrees to it: the packets of a multi-packet request
+    or response are then returned by next_message() one after the other
+    instead of one for each packet received, until the peer asks us to wait
+    with a SingleResponseModeParameters header.
+    """
+
+    handler_class = None
+
+    def __init__(self, max_packet_length=0xffff):
+
+        self.max_packet_length = max_packet_length
+        self.obex_version = ObexVersion()
+        self.connected = False
+        self.remote_info = None
+
+        self.reader = PacketReader()
+        self.handler = self.handler_class()
+        self.handler.body_views = True
+        self.frame_encoder = FrameEncoder()
+
+        # The operation in progress, the packets of it that have not been
+        # sent yet and the next of those, which is fetched ahead so that the
+        # last packet can be recognised.
+        self.request = None
+        self._pending = None
+        self._next = None
+
+        self._outgoing = collections.deque()
+
+        # Whether Single Response Mode may be used, whether it is in use for
+        # the operation in progress and whether the peer has asked us to
+        # wait for its next packet before sending another.
+        self.srm = False
+        self._srm_active = False
+        self._srm_wait = False
+
+    def max_length(self):
+
+        """Returns the largest packet that may be sent to the peer."""
+
+        if self.remote_info is not None:
+            return min(self.max_packet_length,
+                       self.remote_info.max_packet_length)
+        return self.max_packet_length
+
+    def receive_data(self, data):
+
+        """Processes data received from the peer and returns a list of the
+        events it caused. Pass an empty bytes object at end of file."""
+
+        if not data:
+            return [ConnectionClosed()]
+
+        self.reader.feed(data)
+        return self._process()
+
+    def receive_from(self, socket_):
+
+        """Receives from socket_ directly into the packet buffer and returns
+        the events caused. This avoids a copy for blocking front-ends."""
+
+        if not self.reader.fill(socket_):
+            return [ConnectionClosed()]
+        return self._process()
+
+    def _process(self):
+
+        events = []
+        while True:
+            packet = self.reader.next_packet()
+            if packet is None:
+                return events
+            events.extend(self._handle_packet(*packet))
+
+    def _handle_packet(self, code, length, data):
+
+        raise NotImplementedError()
+
+    def queue(self, message, header_list=()):
+
+        raise NotImplementedError()
+
+    def send(self, message, header_list=()):
+
+        """Starts sending message with the headers in header_list and
+        returns the bytes that can be transmitted now."""
+
+        self.queue(message, header_list)
+        return self.data_to_send()
+
+    def next_message(self):
+
+        """Returns the next message waiting to be sent, or None."""
+
+        if not self._outgoing and self._streaming():
+            self._send_next()
+        if self._outgoing:
+            return self._outgoing.popleft()
+        return None
+
+    def data_to_send(self):
+
+        """Returns the encoded form of all messages waiting to be sent."""
+
+        data = []
+        while True:
+            message = self.next_message()
+            if message is None:
+                return b"".join(data)
+            data.extend(bytes(buffer) for buffer in
+                        self.frame_encoder.encode(message))
+
+    def _streaming(self):
+
+        """Returns True if the next packet of the operation in progress may
+        be sent without waiting for the peer."""
+
+        return (self._next is not None and self._srm_active and
+                not self._srm_wait)
+
+    def _end_srm(self):
+
+        self._srm_active = False
+        self._srm_wait = False
+
+    def _packets(self, message, header_list, code):
+
+        """Yields copies of message that carry the headers in header_list,
+        each one no longer than the negotiated maximum. All packets but the
+        last are given the code specified.
+
+        Body and EndOfBody headers are split to fill each packet exactly:
+        the part that fits in the space left is sent as a Body header and
+        the rest goes on in the next packet, so callers can pass a whole
+        object in one header. The data of a FilePayload is read as each
+        packet is made. Other headers that do not fit start a new
+        packet."""
+
+        max_length = self.max_length()
+        final_code = message.code
+
+        packet = self._copy(message)
+        length = packet.minimum_length
+        for header in header_list:
+
+            header_length = header.encoded_length()
+            if isinstance(header, (headers.Body, headers.EndOfBody)) and (
+                    length + header_length > max_length or
+                    isinstance(header.payload, FilePayload)):
+
+                payload = _payload(header)
+                while length + 3 + len(payload) > max_length:
+                    room = max_length - length - 3
+                    if room > 0:
+                        chunk, payload = _split(payload, room)
+                        packet.header_data.append(
+                            headers.Body.from_payload(chunk))
+                    elif not packet.header_data:
+                        raise ProtocolError(
+                            "no room for body data in a %i byte packet"
+                            % max_length)
+                    packet.code = code
+                    yield packet
+
+                    packet = self._copy(message)
+                    length = packet.minimum_length
+
+                if not payload and isinstance(header, headers.Body):
+                    continue
+                if isinstance(payload, FilePayload):
+                    payload = payload.read(len(payload))
+                header = type(header).from_payload(payload)
+                header_length = len(payload) + 3
+
+            elif length + header_length > max_length:
+                if not packet.header_data:
+                    raise ProtocolError(
+                        "header 0x%02x does not fit in a %i byte packet"
+                        % (header.code, max_length))
+                packet.code = code
+                yield packet
+
+                packet = self._copy(message)
+                length = packet.minimum_length
+
+            packet.header_data.append(header)
+            length += header_length
+
+        packet.code = final_code
+        yield packet
+
+    @staticmethod
+    def _copy(message):
+
+        packet = copy.copy(message)
+        packet.header_data = []
+        return packet
+
+    def _start(self, packets):
+
+        self._pending = packets
+        self._next = next(packets)
+        self._send_next()
+
+    def _send_next(self):
+
+        self._outgoing.append(self._next)
+        self._next = next(self._pending, None)
+        if self._next is None:
+            self._pending = None
+
+    def _drop_pending(self):
+
+        self._pending = None
+        self._next = None
+
+
+class ClientProtocol(ObexProtocol):
+
+    """ClientProtocol(max_packet_length=0xffff)
+
+    The client side of an OBEX session.
+
+    One operation is in progress at a time. Requests whose headers do not
+    fit in one packet are split, and the next packet is sent whenever the
+    server answers Continue. Once all of a Get request has been sent, a
+    GetFinal request is sent for each Continue response until the server
+    completes the operation. Every response is reported as a
+    ResponseReceived event.
+
+    With srm set, Get and Put requests carry a SingleResponseMode header.
+    If the server echoes it, the remaining request packets are sent without
+    waiting for Continue responses and no GetFinal requests are sent while
+    the server streams its response. Servers that do not echo it are served
+    as before.
+    """
+
+    handler_class = responses.ResponseHandler
+
+    def __init__(self, max_packet_length=0xffff):
+
+        super().__init__(max_packet_length)
+        self.connection_id = None
+
+        # The operation each sent packet belongs to, in the order that the
+        # responses will arrive.
+        self._in_flight = collections.deque()
+
+        # Set when an operation in Single Response Mode is aborted, as the
+        # server may still be streaming responses to it.
+        self._srm_aborted = False
+
+        # Set when the request asked the server to wait with a
+        # SingleResponseModeParameters header, so that the server expects a
+        # GetFinal request before it sends more.
+        self._srm_wait_sent = False
+
+    def queue(self, message, header_list=(), bodies=()):
+
+        """Starts the operation for the request given as message.
+
+        bodies is an iterable of further headers, usually Body headers,
+        that are sent after those in header_list. It is only consumed as
+        the packets are made, so it may be a generator that reads the
+        object being sent."""
+
+        if self.request is not None:
+            raise ProtocolError("an operation is already in progress")
+
+        header_list = list(header_list)
+        if self.connection_id is not None and not isinstance(
+                message, requests.Connect):
+            header_list.insert(0, self.connection_id)
+
+        self._end_srm()
+        self._srm_wait_sent = any(
+            isinstance(header, headers.SingleResponseModeParameters)
+            for header in header_list)
+        if isinstance(message, (requests.Get, requests.Put)):
+            if self.srm:
+                # The Connection ID must remain the first header.
+                header_list.insert(int(self.connection_id is not None),
+                                   headers.SingleResponseMode(
+                                       headers.SingleResponseMode.Enable))
+            # Send the headers in non-final packets and finish with the final
+            # form of the request.
+            code = message.code & 0x7f
+            message = self._copy(message)
+            message.code = code | 0x80
+        else:
+            code = message.code
+
+        self.request = message
+        self._start(self._packets(message, itertools.chain(header_list, bodies),
+                                  code))
+
+    def abort(self, header_list=()):
+
+        """Abandons the operation in progress, if any, and sends an Abort
+        request. Responses to packets of the abandoned operation that are
+        still in flight are discarded."""
+
+        self._drop_pending()
+        self.request = None
+        self._srm_aborted = self._srm_active
+        self.queue(requests.Abort(), header_list)
+
+    def _send_next(self):
+
+        # In Single Response Mode only the last packet of a request is
+        # answered.
+        streaming = self._srm_active and not self._srm_wait
+        request = self.request
+        super()._send_next()
+        if not streaming or self._next is None:
+            self._in_flight.append(request)
+
+    def _handle_packet(self, code, length, data):
+
+        if self._srm_aborted and self._streamed(code, length, data):
+            return []
+
+        if self._in_flight:
+            request = self._in_flight.popleft()
+        elif self._srm_active and self.request is not None:
+            # A response streamed in Single Response Mode.
+            request = self.request
+        else:
+            raise ProtocolError("unexpected response 0x%02x" % code)
+
+        if isinstance(request, requests.Connect):
+            response = self.handler.decode_connection_packet(code, length,
+                                                             data)
+        else:
+            response = self.handler.decode_packet(code, length, data)
+
+        if request is not self.request:
+            # The response belongs to an aborted operation.
+            return []
+
+        if self.srm and isinstance(request, (requests.Get, requests.Put)):
+            srm, srmp = _srm_values(response)
+            if srm == headers.SingleResponseMode.Enable:
+                self._srm_active = True
+            self._srm_wait = (self._srm_active and
+                              srmp == headers.SingleResponseModeParameters.Wait)
+
+        if isinstance(response, responses.Continue):
+            if self._next is not None:
+                self._send_next()
+                return [ResponseReceived(request, response, False)]
+            if isinstance(request, requests.Get):
+                if not self._srm_active or self._srm_wait_sent:
+                    self._srm_wait_sent = False
+                    self._in_flight.append(request)
+                    self._outgoing.append(requests.GetFinal())
+                return [ResponseReceived(request, response, False)]
+
+        self._drop_pending()
+        self._end_srm()
+        self._srm_aborted = False
+        self.request = None
+
+        if isinstance(request, requests.Connect):
+            if isinstance(response, responses.ConnectSuccess):
+                self.connected = True
+                self.remote_info = response
+                self.connection_id = self._connection_id(response)
+        elif isinstance(request, requests.Disconnect):
+            self.connected = False
+            self.remote_info = None
+            self.connection_id = None
+
+        return [ResponseReceived(request, response, True)]
+
+    def _streamed(self, code, length, data):
+
+        """Returns True if a response received after an operation in Single
+        Response Mode was aborted was streamed by the server before it saw
+        the Abort: a Continue response or the final response of the object,
+        which carries its EndOfBody header, rather than the response to the
+        Abort request."""
+
+        if code == responses.Continue.code:
+            return True
+        response = self.handler.decode_packet(code, length, data)
+        return any(isinstance(header, headers.EndOfBody)
+                   for header in response.header_data)
+
+    @staticmethod
+    def _connection_id(response):
+
+        for header in response.header_data:
+            if isinstance(header, headers.ConnectionId):
+                # Recycle the Connection ID data to create a new header for
+                # future use.
+                return headers.ConnectionId(header.decode())
+        return None
+
+
+class ServerProtocol(ObexProtocol):
+
+    """ServerProtocol(max_packet_length=0xffff)
+
+    The server side of an OBEX session.
+
+    Each request is reported as a RequestReceived event once it is complete:
+    the headers of non-final Get packets are collected and answered with
+    Continue by the engine. The application answers with send() or queue();
+    a response that does not fit in one packet is split, all packets but
+    the last are sent as Continue, and each of them after the first is sent
+    when the client asks for it with another GetFinal request. Abort
+    requests are answered by the engine and reported as OperationAborted.
+
+    With srm set, a Get or Put request that carries a SingleResponseMode
+    header enabling it is answered with one: the packets of the response to
+    a Get are then sent back to back, and the Continue responses to the
+    packets of a Put are not sent, until the operation is complete. A
+    Continue response that carries a SingleResponseModeParameters header
+    asking the client to wait is sent, and so is the response to the packet
+    that follows it. The SRM headers are removed from the requests
+    reported.
+    """
+
+    handler_class = requests.RequestHandler
+
+    def __init__(self, max_packet_length=0xffff):
+
+        super().__init__(max_packet_length)
+        self._get_headers = []
+
+        # Whether the next response must confirm Single Response Mode.
+        self._srm_reply = False
+
+        # Set when the last response asked the client to wait with a
+        # SingleResponseModeParameters header, so that the client expects a
+        # response to its next packet.
+        self._srm_wait_sent = False
+
+    def _handle_packet(self, code, length, data):
+
+        request = self.handler.decode_packet(code, length, data)
+
+        if isinstance(request, requests.Abort):
+            aborted = self.request
+            self._drop_pending()
+            self._end_srm()
+            self._get_headers = []
+            self.request = None
+            self._outgoing.append(responses.Success())
+            return [OperationAborted(aborted)]
+
+        if isinstance(request, (requests.Get, requests.Put)):
+            self._read_srm(request)
+
+        if self._next is not None:
+            if request.code != self.request.code:
+                raise ProtocolError(
+                    "expected request 0x%02x to continue the response, "
+                    "received 0x%02x" % (self.request.code, request.code))
+            self._send_next()
+            return []
+
+        if isinstance(request, requests.Get) and not request.is_final():
+            self._get_headers.extend(request.header_data)
+            if self._srm_reply:
+                self._srm_reply = False
+                self._outgoing.append(self._srm_response())
+            elif not self._srm_active or self._srm_wait:
+                self._outgoing.append(responses.Continue())
+            return []
+
+        if isinstance(request, requests.Get) and self._get_headers:
+            request.header_data = self._get_headers + list(
+                request.header_data)
+            self._get_headers = []
+
+        if isinstance(request, requests.Connect):
+            self.remote_info = request
+
+        self.request = request
+        return [RequestReceived(request)]
+
+    def queue(self, message, header_list=()):
+
+        """Starts sending the response given as message to the request that
+        was last received."""
+
+        if self._next is not None:
+            raise ProtocolError("the previous response is still being sent")
+
+        request = self.request
+        if isinstance(request, requests.Connect):
+            self.connected = isinstance(message, responses.ConnectSuccess)
+        elif isinstance(request, requests.Disconnect):
+            self.connected = False
+
+        header_list = list(header_list)
+        wait_sent = self._srm_wait_sent
+        self._srm_wait_sent = any(
+            isinstance(header, headers.SingleResponseModeParameters)
+            for header in header_list)
+        if self._srm_reply:
+            self._srm_reply = False
+            header_list.insert(0, headers.SingleResponseMode(
+                headers.SingleResponseMode.Enable))
+        elif (self._srm_active and not self._srm_wait and not wait_sent and
+              not self._srm_wait_sent and
+              isinstance(request, requests.Put) and not request.is_final() and
+              isinstance(message, responses.Continue)):
+            # The client does not wait for these in Single Response Mode.
+            self.request = None
+            return
+
+        self._start(self._packets(message, header_list,
+                                  responses.Continue.code))
+
+    def _send_next(self):
+
+        super()._send_next()
+        if self._next is None:
+            self.request = None
+            if self._outgoing[-1].code != responses.Continue.code:
+                # The operation is complete.
+                self._end_srm()
+
+    def _end_srm(self):
+
+        super()._end_srm()
+        self._srm_reply = False
+        self._srm_wait_sent = False
+
+    def _read_srm(self, request):
+
+        """Updates the Single Response Mode state from the headers of
+        request and removes those headers from it."""
+
+        srm, srmp = _srm_values(request)
+        if srm is not None or srmp is not None:
+            request.header_data = [
+                header for header in request.header_data
+                if not isinstance(header, (
+                    headers.SingleResponseMode,
+                    headers.SingleResponseModeParameters))]
+
+        if (self.srm and not self._srm_active and
+                srm == headers.SingleResponseMode.Enable):
+            self._srm_active = True
+            self._srm_reply = True
+        self._srm_wait = (self._srm_active and
+                          srmp == headers.SingleResponseModeParameters.Wait)
+
+    @staticmethod
+    def _srm_response():
+
+        response = responses.Continue()
+        response.header_data = [headers.SingleResponseMode(
+            headers.SingleResponseMode.Enable)]
+        return response
@@ -45,7 +45,7 @@ class Connect(Request):
     code = OBEX_Connect = 0x80
     format = "BBH"
 
-    def read_data(self, data):
+    def read_data(self, data, body_views=False):
 
         # Extract the connection data from the complete data.
         extra_data = data[self.length(Message.format):self.minimum_length]
@@ -57,7 +57,7 @@ class Connect(Request):
         self.flags = flags
         self.max_packet_length = max_packet_length
 
-        Request.read_data(self, data)
+        Request.read_data(self, data, body_views)
 
 
 class Disconnect(Request):
@@ -102,7 +102,7 @@ class SetPath(Request):
         self.flags = None
         self.constants = None
 
-    def read_data(self, data):
+    def read_data(self, data, body_views=False):
 
         # Extract the extra message data from the complete data.
         extra_data = data[self.length(Message.format):self.minimum_length]
@@ -112,7 +112,7 @@ class SetPath(Request):
         self.flags = flags
         self.constants = constants
 
-        Request.read_data(self, data)
+        Request.read_data(self, data, body_views)
 
 
 class Abort(Request):
@@ -81,9 +81,9 @@ class ResponseHandler(MessageHandler):
 
     def decode_connection(self, socket):
 
-        code, length, data = self._read_packet(socket)
+        return self.decode_connection_packet(*self._read_packet(socket))
 
-        print (code, length, data)
+    def decode_connection_packet(self, code, length, data):
 
         if code == ConnectSuccess.code:
             message = ConnectSuccess()
@@ -94,13 +94,12 @@ class ResponseHandler(MessageHandler):
 
         obex_version, flags, max_packet_length = struct.unpack(">BBH",
                                                                data[3:7])
-        print (obex_version, flags, max_packet_length)
 
         message.obex_version = ObexVersion()
         message.obex_version.from_byte(obex_version)
         message.flags = flags
         message.max_packet_length = max_packet_length
-        message.read_data(data)
+        message.read_data(data, self.body_views)
         return message
 
 
@@ -19,47 +19,108 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from bluetooth import (BluetoothSocket, RFCOMM, OBEX_FILETRANS_CLASS,
-                       OBEX_FILETRANS_PROFILE, OBEX_OBJPUSH_CLASS,
-                       OBEX_OBJPUSH_PROFILE, OBEX_UUID, PUBLIC_BROWSE_GROUP,
-                       RFCOMM_UUID, advertise_service, stop_advertising,
-                       PORT_ANY)
-
-from common import ObexVersion
+from bluetooth import (OBEX_FILETRANS_CLASS, OBEX_FILETRANS_PROFILE,
+                       OBEX_OBJPUSH_CLASS, OBEX_OBJPUSH_PROFILE, OBEX_UUID,
+                       PUBLIC_BROWSE_GROUP, RFCOMM_UUID, advertise_service,
+                       stop_advertising, PORT_ANY)
+
+import array
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import selectors
+import socket as socket_module
+import threading
+import time
+import weakref
+
+from common import FilePayload, ObexVersion, flush_async, nonblocking
+from protocol import (ConnectionClosed, OperationAborted, RequestReceived,
+                      ServerProtocol)
+from transports import RFCOMMTransport
 import requests
 import responses
 
+logger = logging.getLogger(__name__)
+
+
+class Session:
+
+    """Session(socket, protocol, mtu=None)
+
+    Holds the state of one connection to a Server: the socket, its protocol
+    engine, the largest packet that the link takes in one piece (None if the
+    transport does not limit it), the Connect request received from the
+    client, whether the connection is still being served and the file
+    payloads of the response being sent, which are closed if it is aborted
+    or the connection ends before they have been read to the end.
+    """
+
+    def __init__(self, socket, protocol, mtu=None):
+
+        self.socket = socket
+        self.protocol = protocol
+        self.mtu = mtu
+        self.remote_info = None
+        self.connected = False
+        self.payloads = []
+
+    def close_payloads(self):
+
+        while self.payloads:
+            self.payloads.pop().close()
+
 
 class Server:
 
-    def __init__(self, address=""):
+    """Server(address="", transport=None)
+
+    Provides common functionality for OBEX servers. The transport creates
+    the listening socket in start_service(); it is an RFCOMMTransport by
+    default.
+
+    Set srm to True to accept requests for OBEX Single Response Mode, in
+    which the packets of a response are sent back to back instead of one
+    for each GetFinal request.
+
+    The state of each connection is kept in a Session, so that a server
+    can serve several connections at once with serve_threaded() or
+    serve_async(). Subclasses that do so must keep any state they share
+    between connections safe to use from several threads.
+    """
+
+    def __init__(self, address="", transport=None):
 
         self.address = address
+        if transport is None:
+            transport = RFCOMMTransport()
+        self.transport = transport
         self.max_packet_length = 0xffff
         self.obex_version = ObexVersion()
-        self.request_handler = requests.RequestHandler()
-        self.connected = False
-        self.remote_info = None
+        self.srm = False
+        self._sessions = weakref.WeakKeyDictionary()
+        self._sessions_lock = threading.Lock()
 
     def start_service(self, port, name, uuid, service_classes,
                       service_profiles, provider, description, protocols):
 
-        socket = BluetoothSocket(RFCOMM)
-        socket.bind((self.address, port))
-        socket.listen(1)
+        socket = self.transport.listen(self.address, port)
 
-        advertise_service(
-            socket, name, uuid, service_classes, service_profiles,
-            provider, description, protocols
-            )
+        if self.transport.bluetooth:
+            advertise_service(
+                socket, name, uuid, service_classes, service_profiles,
+                provider, description, protocols
+                )
 
-        print("Starting server for %s on port %i" % socket.getsockname())
+        # The address is a (host, port) tuple, or a path for Unix sockets.
+        logger.info("Starting server on %r", socket.getsockname())
         return socket
 
-    @staticmethod
-    def stop_service(socket):
+    def stop_service(self, socket):
 
-        stop_advertising(socket)
+        if self.transport.bluetooth:
+            stop_advertising(socket)
 
     def serve(self, socket):
 
@@ -70,34 +131,270 @@ class Server:
                 connection.close()
                 continue
 
-            self.connected = True
+            self.serve_connection(connection)
 
-            while self.connected:
+    def serve_threaded(self, socket, max_connections=4):
 
-                request = self.request_handler.decode(connection)
+        """Accepts connections on the listening socket and serves up to
+        max_connections of them at once, each on a thread of a pool. Further
+        connections wait in the listening socket's backlog until one of the
+        others ends."""
 
-                self.process_request(connection, request)
+        slots = threading.BoundedSemaphore(max_connections)
 
-    def _max_length(self):
+        with concurrent.futures.ThreadPoolExecutor(max_connections) as executor:
+            while True:
 
-        if hasattr(self, "remote_info"):
-            return self.remote_info.max_packet_length
-        return self.max_packet_length
+                slots.acquire()
+                try:
+                    connection, _ = socket.accept()
+                except BaseException:
+                    slots.release()
+                    raise
 
-    def send_response(self, socket, response, header_list=None):
+                if not self.accept_connection():
+                    connection.close()
+                    slots.release()
+                    continue
+
+                future = executor.submit(self._serve_and_close, connection)
+                future.add_done_callback(lambda _: slots.release())
 
-        # TODO: This needs to be able to split messages that are longer than
-        # the maximum message length agreed with the other party.
-        while header_list:
+    def serve_processes(self, socket, workers=4, max_connections=4):
 
-            if response.add_header(header_list[0], self._max_length()):
-                header_list.pop(0)
-            else:
-                socket.sendall(response.encode())
-                response.reset_headers()
+        """Accepts connections on the listening socket and passes each of
+        them to the one of a number of worker processes that is serving the
+        fewest, so that requests are processed on more than one core.
+
+        Connections are passed over Unix sockets with SCM_RIGHTS, and each
+        worker serves up to max_connections of them at once on a pool of
+        threads. A worker that exits or crashes is replaced; the connections
+        it was serving are lost. The workers are forked from this process,
+        so they share no state with it or with each other after they start.
+        """
+
+        selector = selectors.DefaultSelector()
+        pool = []
+        for _ in range(workers):
+            pool.append(WorkerProcess(self, socket, pool, max_connections))
+        for worker in pool:
+            selector.register(worker.control, selectors.EVENT_READ, worker)
+        selector.register(socket, selectors.EVENT_READ)
+
+        try:
+            while True:
+                for key, _ in selector.select():
+
+                    worker = key.data
+                    if worker is None:
+                        self._hand_off(socket, pool)
+                    elif not worker.read_reports():
+                        selector.unregister(worker.control)
+                        worker.restart()
+                        selector.register(worker.control,
+                                          selectors.EVENT_READ, worker)
+        finally:
+            selector.close()
+            for worker in pool:
+                worker.stop()
+
+    def _hand_off(self, socket, pool):
+
+        connection, _ = socket.accept()
+        try:
+            if not self.accept_connection():
+                return
+            worker = min(pool, key=lambda worker: worker.load)
+            worker.send(connection)
+        finally:
+            connection.close()
+
+    def _serve_and_close(self, connection):
+
+        try:
+            self.serve_connection(connection)
+        finally:
+            self._close_session(connection)
+            connection.close()
+
+    def session(self, socket):
+
+        """Returns the Session of the connection on socket, creating one on
+        first use."""
+
+        try:
+            return self._sessions[socket]
+        except KeyError:
+            pass
+
+        with self._sessions_lock:
+            session = self._sessions.get(socket)
+            if session is None:
+                session = self._sessions[socket] = self.create_session(socket)
+            return session
+
+    def _close_session(self, socket):
+
+        session = self._sessions.pop(socket, None)
+        if session is not None:
+            self.session_closed(session)
+
+    def session_closed(self, session):
+
+        """Called when the connection of session has ended.
+
+        This method can be reimplemented in subclasses to release what was
+        held for the connection.
+        """
+
+    def create_session(self, socket):
+
+        """Returns a new Session for the connection on socket. The packets
+        sent on it are limited to the MTU of the transport, if any.
+
+        This method can be reimplemented in subclasses to keep more state
+        for each connection.
+        """
 
-        # Always send at least one request.
-        socket.sendall(response.encode())
+        mtu = self.transport.mtu(socket)
+        protocol = self.create_protocol(socket)
+        if mtu:
+            protocol.max_packet_length = min(protocol.max_packet_length, mtu)
+        return Session(socket, protocol, mtu)
+
+    def protocol(self, socket):
+
+        """Returns the protocol engine for the connection on socket."""
+
+        return self.session(socket).protocol
+
+    def create_protocol(self, socket):
+
+        """Returns a new protocol engine for the connection on socket.
+
+        This method can be reimplemented in subclasses to apply limits of
+        the underlying transport to the engine.
+        """
+
+        _ = socket
+        protocol = ServerProtocol(self.max_packet_length)
+        protocol.obex_version = self.obex_version
+        protocol.srm = self.srm
+        return protocol
+
+    def serve_connection(self, connection):
+
+        """Handles the requests received on connection until the client
+        disconnects."""
+
+        session = self.session(connection)
+        protocol = session.protocol
+        session.connected = True
+
+        try:
+            while session.connected:
+
+                for event in protocol.receive_from(connection):
+
+                    if isinstance(event, ConnectionClosed):
+                        session.connected = False
+                    elif isinstance(event, OperationAborted):
+                        session.close_payloads()
+                    elif isinstance(event, RequestReceived):
+                        self.process_request(connection, event.request)
+
+                # Send the responses queued by process_request and the
+                # continuations and Abort responses that the protocol engine
+                # produced by itself.
+                self._flush(connection)
+        finally:
+            session.close_payloads()
+
+    async def serve_async(self, socket, executor=None):
+
+        """Accepts any number of connections on the listening socket and
+        serves each of them in its own task.
+
+        Requests are processed by calling process_request in executor (the
+        event loop's default executor if None), so that file access and
+        image conversion do not hold up the other connections.
+        """
+
+        loop = asyncio.get_running_loop()
+        socket = nonblocking(socket)
+        tasks = set()
+
+        while True:
+
+            connection, _ = await loop.sock_accept(socket)
+            if not self.accept_connection():
+                connection.close()
+                continue
+
+            task = loop.create_task(
+                self.serve_connection_async(connection, executor))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def serve_connection_async(self, connection, executor=None):
+
+        """Handles the requests received on connection until the client
+        disconnects or closes the connection."""
+
+        loop = asyncio.get_running_loop()
+        connection = nonblocking(connection)
+        session = self.session(connection)
+        protocol = session.protocol
+        session.connected = True
+
+        try:
+            while True:
+
+                data = await loop.sock_recv(connection, 0x10000)
+                for event in protocol.receive_data(data):
+
+                    if isinstance(event, ConnectionClosed):
+                        return
+                    if isinstance(event, OperationAborted):
+                        session.close_payloads()
+                    elif isinstance(event, RequestReceived):
+                        await loop.run_in_executor(
+                            executor, self.process_request, connection,
+                            event.request)
+                        if isinstance(event.request, requests.Disconnect):
+                            await flush_async(protocol, connection,
+                                              protocol.frame_encoder)
+                            return
+
+                await flush_async(protocol, connection, protocol.frame_encoder)
+        finally:
+            session.close_payloads()
+            self._close_session(connection)
+            connection.close()
+
+    def _flush(self, socket):
+
+        protocol = self.protocol(socket)
+        while True:
+            message = protocol.next_message()
+            if message is None:
+                return
+            protocol.frame_encoder.send(socket, message)
+
+    def send_response(self, socket, response, header_list=None):
+
+        """Queues response with the headers in header_list. It is sent once
+        process_request returns. If the headers do not fit in one packet,
+        the first packet is sent as Continue and the rest follow as the
+        client asks for them, or straight away in Single Response Mode."""
+
+        header_list = list(header_list or ())
+        session = self.session(socket)
+        # The previous response has been sent in full, so its payloads have
+        # been read to the end and closed.
+        session.payloads = [header.payload for header in header_list
+                            if isinstance(header.payload, FilePayload)]
+        session.protocol.queue(response, header_list)
 
     def _reject(self, socket):
 
@@ -132,9 +429,14 @@ class Server:
 
         if request.obex_version > self.obex_version:
             self._reject(socket)
+            return
+
+        session = self.session(socket)
+        session.remote_info = request
 
-        self.remote_info = request
-        max_length = self.remote_info.max_packet_length
+        # Advertise our own maximum, limited to the MTU of the link; the
+        # protocol engine sends packets no longer than the client's.
+        max_length = session.protocol.max_packet_length
 
         flags = 0
         data = (self.obex_version.to_byte(), flags, max_length)
@@ -146,13 +448,136 @@ class Server:
 
         response = responses.Success()
         self.send_response(socket, response)
-        self.connected = False
+        self.session(socket).connected = False
 
     def put(self, socket, _):
 
         self._reject(socket)
 
 
+class WorkerProcess:
+
+    """WorkerProcess(server, listening_socket, pool, max_connections=4)
+
+    A process forked to serve the connections that Server.serve_processes
+    passes to it. pool is the list of all the workers. load is the number
+    of connections it is serving, as far as the accepting process knows:
+    one is added for each connection sent and the worker reports each one
+    that ends with a byte on its control socket.
+    """
+
+    # Workers that exit sooner than this after starting are restarted after
+    # this delay, so that one that cannot start does not use all the CPU.
+    restart_delay = 1.0
+
+    def __init__(self, server, listening_socket, pool, max_connections=4):
+
+        self.server = server
+        self.listening_socket = listening_socket
+        self.pool = pool
+        self.max_connections = max_connections
+        self.process = None
+        self.control = None
+        self.load = 0
+        self.started = 0
+        self.start()
+
+    def start(self):
+
+        self.control, worker_control = socket_module.socketpair(
+            socket_module.AF_UNIX, socket_module.SOCK_SEQPACKET)
+        # Fork so that the server, which may hold sockets and other
+        # resources that cannot be pickled, is inherited as it is.
+        context = multiprocessing.get_context("fork")
+        self.process = context.Process(target=self._run,
+                                       args=(worker_control,), daemon=True)
+        self.process.start()
+        worker_control.close()
+        self.load = 0
+        self.started = time.monotonic()
+
+    def restart(self):
+
+        self.stop()
+        logger.warning("worker %s exited with status %s; restarting",
+                       self.process.pid, self.process.exitcode)
+        if time.monotonic() - self.started < self.restart_delay:
+            time.sleep(self.restart_delay)
+        self.start()
+
+    def stop(self):
+
+        self.control.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def send(self, connection):
+
+        _send_fd(self.control, connection.fileno())
+        self.load += 1
+
+    def read_reports(self):
+
+        """Reads the reports of connections that have ended and returns
+        False if the worker has exited."""
+
+        try:
+            data = self.control.recv(64)
+        except OSError:
+            return False
+        self.load = max(0, self.load - len(data))
+        return bool(data)
+
+    def _run(self, control):
+
+        # Only the accepting process uses the listening socket and the
+        # control sockets of the workers, so close them here. The worker
+        # then sees the end of its control socket if that process stops.
+        self.listening_socket.close()
+        self.control.close()
+        for worker in self.pool:
+            worker.control.close()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                self.max_connections) as executor:
+            while True:
+                fds = _receive_fds(control)
+                if not fds:
+                    # The accepting process has stopped.
+                    break
+                connection = socket_module.socket(fileno=fds[0])
+                future = executor.submit(self.server._serve_and_close,
+                                         connection)
+                future.add_done_callback(lambda _: control.send(b"d"))
+
+
+def _send_fd(socket_, fd):
+
+    """Sends the file descriptor fd over the Unix socket socket_ with a one
+    byte message. Like socket.send_fds, which needs Python 3.9."""
+
+    socket_.sendmsg([b"c"], [(socket_module.SOL_SOCKET,
+                              socket_module.SCM_RIGHTS,
+                              array.array("i", [fd]))])
+
+
+def _receive_fds(socket_):
+
+    """Receives a one byte message from the Unix socket socket_ and returns
+    the list of the file descriptors sent with it, which is empty at the
+    end of the connection. Like socket.recv_fds, which needs Python 3.9."""
+
+    fds = array.array("i")
+    _, ancdata, _, _ = socket_.recvmsg(1, socket_module.CMSG_LEN(fds.itemsize))
+    for level, type_, data in ancdata:
+        if (level == socket_module.SOL_SOCKET and
+                type_ == socket_module.SCM_RIGHTS):
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return list(fds)
+
+
 class BrowserServer(Server):
 
     def start_service(self, port=PORT_ANY):
@@ -0,0 +1,116 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the pins, eviction and table rebuild of imagecache.ImageCache"""
+
+import io
+import os
+import random
+import unittest
+
+import imagecache
+
+
+def _fill(value):
+    def fill(view):
+        view[:] = bytes([value]) * len(view)
+        return len(view)
+    return fill
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = imagecache.ImageCache(0x8000, block_size=0x400)
+        self.views = []
+
+    def tearDown(self):
+        for view in self.views:
+            view.release()
+        self.cache.close()
+
+    def put(self, key, length, value=0):
+        view = self.cache.put(key, length, _fill(value))
+        if view is not None:
+            self.views.append(view)
+        return view
+
+    def store(self, key, length, value=0):
+        """Stores data for key without keeping it pinned"""
+        view = self.cache.put(key, length, _fill(value))
+        if view is not None:
+            view.release()
+            self.cache.release(key)
+        return view is not None
+
+    def test_pinned_entry_is_not_evicted(self):
+        pinned = self.put("pinned", 0x1000, 1)
+        for i in range(32):
+            self.assertTrue(self.store(i, 0x1000))
+        self.assertGreater(self.cache.stats.evictions, 0)
+        self.assertEqual(bytes(pinned), b"\x01" * 0x1000)
+
+        view = self.cache.get("pinned")
+        self.assertIsNotNone(view)
+        view.release()
+        self.cache.release("pinned")
+
+        # Once released, it is evicted like any other entry.
+        self.cache.release("pinned")
+        for i in range(32, 64):
+            self.store(i, 0x1000)
+        self.assertIsNone(self.cache.get("pinned"))
+
+    def test_put_fails_when_all_space_is_pinned(self):
+        for i in range(4):
+            self.assertIsNotNone(self.put(i, 0x2000, i))
+        self.assertIsNone(self.put("more", 0x400))
+        for i in range(4):
+            self.assertEqual(bytes(self.views[i]), bytes([i]) * 0x2000)
+
+    def test_pins_of_dead_process_are_dropped(self):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(4):
+                self.cache.put_file(i, io.BytesIO(bytes(0x2000)), 0x2000)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertTrue(self.store("after", 0x2000))
+
+    def test_rebuild_keeps_pinned_entries(self):
+        rebuilds = []
+        rebuild = self.cache._rebuild
+
+        def counting_rebuild():
+            rebuilds.append(True)
+            rebuild()
+        self.cache._rebuild = counting_rebuild
+
+        held = dict((("held", i), self.put(("held", i), 0x380, i)) for i in range(4))
+        generator = random.Random(0)
+        for _ in range(3000):
+            key = generator.randrange(200)
+            view = self.cache.get(key)
+            if view is None:
+                self.store(key, 0x3e8)
+            else:
+                view.release()
+                self.cache.release(key)
+            deleted = imagecache.HEADER.unpack_from(self.cache._shm.buf, 0)[1]
+            self.assertLessEqual(deleted, self.cache.slots // 4)
+        self.assertTrue(rebuilds)
+
+        for key, view in held.items():
+            self.assertEqual(bytes(view), bytes([key[1]]) * 0x380)
+            found = self.cache.get(key)
+            self.assertIsNotNone(found)
+            found.release()
+            self.cache.release(key)
+            # The pin taken by put moved with the entry.
+            self.cache.release(key)
+        self.assertEqual(sum(self.cache._entry(slot)[6] for slot in range(self.cache.slots)), 0)
+        self.assertEqual(sum(self.cache._pin_record(i)[1] for i in range(self.cache.max_pins)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of imagecatalog.CatalogStore and ImageIndex against a directory
+that is missing, removed or recreated"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import imagecatalog
+
+
+class CatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rootdir = os.path.join(self.tmpdir, "images")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data=b"image"):
+        os.makedirs(self.rootdir, exist_ok=True)
+        path = os.path.join(self.rootdir, name)
+        with open(path, "wb") as fobj:
+            fobj.write(data)
+        return path
+
+    def handles(self, index):
+        return sorted(entry.handle for entry in index)
+
+
+class CatalogStoreTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.store = imagecatalog.CatalogStore(os.path.join(self.tmpdir, "catalog.db"))
+
+    def tearDown(self):
+        self.store.close()
+        super().tearDown()
+
+    def test_sync_missing_directory(self):
+        self.assertEqual(self.store.sync(self.rootdir), (0, 0))
+        self.assertEqual(self.store.entries(self.rootdir), [])
+
+    def test_sync_removed_directory(self):
+        self.write("1000001_a.jpg")
+        self.write("1000002_b.jpg")
+        self.assertEqual(self.store.sync(self.rootdir), (2, 0))
+        shutil.rmtree(self.rootdir)
+        self.assertEqual(self.store.sync(self.rootdir), (0, 2))
+        self.assertEqual(self.store.entries(self.rootdir), [])
+        self.assertIsNone(self.store.entry(self.rootdir, "1000001"))
+
+    def test_sync_recreated_directory(self):
+        self.write("1000001_a.jpg")
+        self.write("1000002_b.jpg")
+        self.store.sync(self.rootdir)
+        shutil.rmtree(self.rootdir)
+        self.write("1000001_a.jpg", b"another image")
+        self.write("1000003_c.jpg")
+
+        self.assertEqual(self.store.sync(self.rootdir), (2, 1))
+        entries = self.store.entries(self.rootdir)
+        self.assertEqual([entry.handle for entry in entries], ["1000001", "1000003"])
+        self.assertEqual(entries[0].size, len(b"another image"))
+        self.assertEqual(self.store.sync(self.rootdir), (0, 0))
+
+    def test_index_follows_recreated_directory(self):
+        index = imagecatalog.ImageIndex(self.rootdir, self.store)
+        index.refresh()
+        self.assertEqual(len(index), 0)
+
+        self.write("1000001_a.jpg")
+        index.refresh()
+        self.assertEqual(self.handles(index), ["1000001"])
+
+        shutil.rmtree(self.rootdir)
+        index.refresh()
+        self.assertEqual(len(index), 0)
+
+        self.write("1000002_b.jpg")
+        index.refresh()
+        self.assertEqual(self.handles(index), ["1000002"])
+        self.assertIsNone(index.get("1000001"))
+
+
+class ImageIndexTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.index = imagecatalog.ImageIndex(self.rootdir)
+
+    def test_refresh_missing_directory(self):
+        self.index.refresh()
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.changed_paths(), [])
+
+    def test_follow_removed_and_recreated_directory(self):
+        self.write("1000001_a.jpg")
+        self.write("1000002_b.jpg")
+        self.index.refresh()
+        generation = self.index.generation
+
+        shutil.rmtree(self.rootdir)
+        self.index.follow()
+        self.assertEqual(len(self.index), 0)
+        self.assertGreater(self.index.generation, generation)
+
+        path = self.write("1000002_b.jpg", b"another image")
+        self.index.follow()
+        self.assertEqual(self.handles(self.index), ["1000002"])
+        self.assertEqual(self.index.get("1000002").size, len(b"another image"))
+        self.assertEqual(self.index.changed_paths(), [])
+        self.assertEqual(list(self.index.files()), [path])
+
+    def test_handle_shared_by_two_files(self):
+        first = self.write("1000001_a.jpg")
+        second = self.write("1000001_b.jpg")
+        self.index.refresh()
+        self.assertEqual(self.index.get("1000001").path, first)
+        self.assertEqual(self.index.changed_paths(), [])
+
+        os.remove(first)
+        self.index.follow()
+        self.assertEqual(self.index.get("1000001").path, second)
+
+        self.write("1000001_a.jpg", b"another image")
+        self.index.follow()
+        self.assertEqual(self.index.get("1000001").path, first)
+
+        os.remove(first)
+        os.remove(second)
+        self.index.follow()
+        self.assertIsNone(self.index.get("1000001"))
+        self.assertEqual(self.index.files(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
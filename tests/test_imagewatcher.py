@@ -0,0 +1,169 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the rescans of imagewatcher.ImageWatcher after events are lost"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import imagecatalog
+import imagewatcher
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class LosingSource(object):
+    """Source that reports no change until told to, then asks for a rescan,
+    as InotifySource does when its queue overflows"""
+
+    opened = 0
+    lost = None
+
+    def __init__(self, rootdir):
+        LosingSource.opened += 1
+
+    def changes(self, timeout, stopped):
+        if LosingSource.lost.wait(timeout):
+            LosingSource.lost.clear()
+            return imagewatcher.RESCAN
+        return set()
+
+    def close(self):
+        pass
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rootdir = os.path.join(self.tmpdir, "images")
+        self.index = imagecatalog.ImageIndex(self.rootdir)
+        self.watcher = None
+
+    def tearDown(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data=b"image"):
+        os.makedirs(self.rootdir, exist_ok=True)
+        with open(os.path.join(self.rootdir, name), "wb") as fobj:
+            fobj.write(data)
+
+    def watch(self, refresh=True):
+        if refresh:
+            self.index.refresh()
+        self.watcher = imagewatcher.ImageWatcher(self.index, interval=0.02, catch_up=False)
+        return self.watcher.start()
+
+
+class InotifySourceTest(unittest.TestCase):
+
+    def test_overflow_asks_for_rescan(self):
+        rootdir = tempfile.mkdtemp()
+        try:
+            source = imagewatcher.InotifySource(rootdir)
+        except (OSError, AttributeError) as err:
+            shutil.rmtree(rootdir)
+            self.skipTest("inotify not available: %s" % err)
+        os.close(source.fd)
+        source.fd, write_fd = os.pipe()
+        os.set_blocking(source.fd, False)
+        try:
+            os.write(write_fd, imagewatcher.EVENT.pack(1, imagewatcher.IN_CLOSE_WRITE, 0, 16) +
+                     b"1000001_a.jpg".ljust(16, b"\0"))
+            self.assertEqual(source.changes(0, threading.Event()), {"1000001_a.jpg"})
+            os.write(write_fd, imagewatcher.EVENT.pack(-1, imagewatcher.IN_Q_OVERFLOW, 0, 0))
+            self.assertIs(source.changes(0, threading.Event()), imagewatcher.RESCAN)
+        finally:
+            source.close()
+            os.close(write_fd)
+            shutil.rmtree(rootdir)
+
+
+class PollingSourceTest(unittest.TestCase):
+
+    def test_created_directory_asks_for_rescan(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rootdir = os.path.join(tmpdir, "images")
+            stopped = threading.Event()
+            source = imagewatcher.PollingSource(rootdir, imagecatalog.scan_files(rootdir))
+            self.assertEqual(source.changes(0, stopped), set())
+            os.mkdir(rootdir)
+            self.assertIs(source.changes(0, stopped), imagewatcher.RESCAN)
+            with open(os.path.join(rootdir, "1000001_a.jpg"), "wb") as fobj:
+                fobj.write(b"image")
+            self.assertEqual(source.changes(0, stopped), {"1000001_a.jpg"})
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ImageWatcherTest(WatcherTestCase):
+
+    def test_rescan_after_lost_events(self):
+        LosingSource.opened = 0
+        LosingSource.lost = threading.Event()
+        self.write("1000001_a.jpg")
+        with mock.patch.object(imagewatcher, "InotifySource", LosingSource):
+            self.watch()
+            self.assertTrue(_wait_for(lambda: LosingSource.opened == 1))
+
+            # Changes whose events are lost are found by the rescan.
+            os.remove(os.path.join(self.rootdir, "1000001_a.jpg"))
+            self.write("1000002_b.jpg")
+            time.sleep(0.1)
+            self.assertIsNotNone(self.index.get("1000001"))
+            LosingSource.lost.set()
+            self.assertTrue(_wait_for(lambda: self.index.get("1000002") is not None))
+            self.assertIsNone(self.index.get("1000001"))
+            self.assertEqual(LosingSource.opened, 2)
+
+    def test_rescan_after_source_error(self):
+        self.write("1000001_a.jpg")
+        self.index.refresh()
+        # Not reported by the source, nor caught up with at the start
+        self.write("1000002_b.jpg")
+        errors = [OSError("read failed")]
+
+        def changes(timeout, stopped):
+            if errors:
+                raise errors.pop()
+            stopped.wait(timeout)
+            return set()
+        source = mock.Mock()
+        source.changes.side_effect = changes
+        with mock.patch.object(imagewatcher, "InotifySource", return_value=source):
+            self.watch(refresh=False)
+            self.assertTrue(_wait_for(lambda: self.index.get("1000002") is not None))
+        self.assertEqual(source.close.call_count, 1)
+
+    def test_recreated_directory(self):
+        self.write("1000001_a.jpg")
+        self.watch()
+        self.assertTrue(_wait_for(lambda: self.watcher._source is not None))
+
+        shutil.rmtree(self.rootdir)
+        self.assertTrue(_wait_for(lambda: len(self.index) == 0))
+
+        self.write("1000002_b.jpg")
+        self.assertTrue(_wait_for(lambda: self.index.get("1000002") is not None))
+        self.write("1000003_c.jpg")
+        self.assertTrue(_wait_for(lambda: self.index.get("1000003") is not None))
+        self.assertIsNone(self.index.get("1000001"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+"""
+test_protocol.py - Tests of the Single Response Mode of the protocol engines.
+
+This file is part of the PyOBEX Python package.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+import headers
+import requests
+import responses
+from protocol import (ClientProtocol, RequestReceived, ResponseReceived,
+                      ServerProtocol)
+
+MAX_PACKET_LENGTH = 0x100
+BODY = bytes(range(256)) * 8
+
+
+def _transfer(sender, receiver):
+
+    """Passes the messages that sender has ready to receiver, one by one,
+    and returns the messages and the events that they caused."""
+
+    messages = []
+    events = []
+    while True:
+        message = sender.next_message()
+        if message is None:
+            return messages, events
+        messages.append(message)
+        events.extend(receiver.receive_data(_encode(sender, message)))
+
+
+def _encode(protocol, message):
+
+    return b"".join(bytes(buffer) for buffer in
+                    protocol.frame_encoder.encode(message))
+
+
+def _srmp_wait():
+
+    return headers.SingleResponseModeParameters(
+        headers.SingleResponseModeParameters.Wait)
+
+
+def _has_header(message, header_class):
+
+    return any(isinstance(header, header_class)
+               for header in message.header_data)
+
+
+def _body(messages):
+
+    return b"".join(bytes(header.decode()) for message in messages
+                    for header in message.header_data
+                    if isinstance(header, (headers.Body, headers.EndOfBody)))
+
+
+class SingleResponseModeTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.client = ClientProtocol(MAX_PACKET_LENGTH)
+        self.server = ServerProtocol(MAX_PACKET_LENGTH)
+        self.client.srm = self.server.srm = True
+
+        self.client.queue(requests.Connect((0x10, 0, MAX_PACKET_LENGTH)))
+        _transfer(self.client, self.server)
+        self.server.queue(
+            responses.ConnectSuccess((0x10, 0, MAX_PACKET_LENGTH)),
+            [headers.ConnectionId(1)])
+        _transfer(self.server, self.client)
+        self.assertTrue(self.client.connected)
+
+    def test_get_streams_response(self):
+
+        self.client.queue(requests.Get(), [headers.Type(b"x-test")])
+        _, events = _transfer(self.client, self.server)
+        self.assertIsInstance(events[0], RequestReceived)
+        self.assertFalse(_has_header(events[0].request,
+                                     headers.SingleResponseMode))
+
+        self.server.queue(responses.Success(), [headers.EndOfBody(BODY)])
+        messages, events = _transfer(self.server, self.client)
+
+        # Every packet is sent without a GetFinal request in between.
+        self.assertGreater(len(messages), 2)
+        self.assertTrue(_has_header(messages[0], headers.SingleResponseMode))
+        self.assertEqual(_body(messages), BODY)
+        self.assertTrue(events[-1].final)
+        self.assertIsNone(self.client.next_message())
+        self.assertIsNone(self.client.request)
+        self.assertIsNone(self.server.request)
+
+    def test_get_waits_for_client(self):
+
+        self.client.queue(requests.Get(),
+                          [headers.Type(b"x-test"), _srmp_wait()])
+        _transfer(self.client, self.server)
+        self.server.queue(responses.Success(), [headers.EndOfBody(BODY)])
+
+        # The server sends one packet and waits for the GetFinal request.
+        messages, events = _transfer(self.server, self.client)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].code, responses.Continue.code)
+        self.assertFalse(events[0].final)
+
+        requests_sent, _ = _transfer(self.client, self.server)
+        self.assertEqual(len(requests_sent), 1)
+        self.assertTrue(requests_sent[0].is_final())
+
+        # The rest of the response then follows without further requests.
+        rest, events = _transfer(self.server, self.client)
+        self.assertGreater(len(rest), 1)
+        self.assertEqual(_body(messages + rest), BODY)
+        self.assertTrue(events[-1].final)
+        self.assertIsNone(self.client.next_message())
+
+    def test_put_streams_request(self):
+
+        self.client.queue(requests.Put(), [headers.Name("test")],
+                          [headers.EndOfBody(BODY)])
+        _, events = _transfer(self.client, self.server)
+        self.assertEqual(len(events), 1)
+
+        # The first packet is answered to enable Single Response Mode.
+        self.server.queue(responses.Continue())
+        _transfer(self.server, self.client)
+
+        self._receive_put()
+
+    def test_put_waits_for_server(self):
+
+        self.client.queue(requests.Put(), [headers.Name("test")],
+                          [headers.EndOfBody(BODY)])
+        messages, _ = _transfer(self.client, self.server)
+        self.assertEqual(len(messages), 1)
+
+        # While the server asks it to wait, the client sends one packet for
+        # each response.
+        for _ in range(2):
+            self.server.queue(responses.Continue(), [_srmp_wait()])
+            _, events = _transfer(self.server, self.client)
+            self.assertIsInstance(events[0], ResponseReceived)
+            messages, events = _transfer(self.client, self.server)
+            self.assertEqual(len(messages), 1)
+            self.assertIsInstance(events[0], RequestReceived)
+
+        # Without the wait, the client streams the rest of the request.
+        self.server.queue(responses.Continue())
+        responses_sent, _ = _transfer(self.server, self.client)
+        self.assertEqual(len(responses_sent), 1)
+        self._receive_put()
+
+    def _receive_put(self):
+
+        """Passes the rest of the Put request that the client streams to
+        the server, answering each packet as the application would, and
+        checks that only the final response is sent."""
+
+        messages = []
+        while True:
+            message = self.client.next_message()
+            if message is None:
+                break
+            messages.append(message)
+            events = self.server.receive_data(_encode(self.client, message))
+            self.assertIsInstance(events[0], RequestReceived)
+            if message.is_final():
+                self.server.queue(responses.Success())
+            else:
+                self.server.queue(responses.Continue())
+                self.assertIsNone(self.server.next_message())
+
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(messages[-1].is_final())
+        responses_sent, events = _transfer(self.server, self.client)
+        self.assertEqual(len(responses_sent), 1)
+        self.assertTrue(events[0].final)
+        self.assertIsNone(self.client.request)
+        self.assertIsNone(self.server.request)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -63,6 +63,21 @@ class DatetimeRange(object):
         return str(self.start) + "  -  " + str(self.end)
 
 
+def timestamp_range(timestamp_range):
+    """Returns a range in the formats of DatetimeRange as (start, end) in
+    seconds since the epoch. Times without Z are local time."""
+    if "-" not in timestamp_range:
+        raise TypeError("Given value is not a range. ex: YYYYMMDDTHHMMSS[Z]-YYYYMMDDTHHMMSS[Z]")
+    start, end = timestamp_range.split("-")
+    return (float("-inf") if start == "*" else dateutil.parser.parse(start).timestamp(),
+            float("inf") if end == "*" else dateutil.parser.parse(end).timestamp())
+
+
+def format_datetime(timestamp):
+    """Returns seconds since the epoch as a BIP UTC timestamp, YYYYMMDDTHHMMSSZ"""
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
 @functools.total_ordering
 class Pixel(object):
     def __init__(self, pixel_str):
@@ -180,10 +195,10 @@ def generate_dummy_image_properties(handle):
     #root.attachment.append(image_properties.attachment(content_type="audio/basic", name="ABCD0001.wav", size="102400"))
     return root
 
-def generate_image_properties(handle, size):
+def generate_image_properties(handle, size, pixel="300*300", encoding="JPEG"):
     root = image_properties.image_properties()
     root.version= "1.0"
     root.handle = handle
-    root.native = image_properties.native(encoding="JPEG", pixel="300*300", size = ("%u" % size) )
+    root.native = image_properties.native(encoding=encoding, pixel=pixel, size = ("%u" % size) )
     root.variant.append(image_properties.variant(encoding="JPEG", pixel="200*200"))
     return root
@@ -0,0 +1,196 @@
+"""
+transports.py - Classes creating the sockets that OBEX sessions run over.
+
+This file is part of the PyOBEX Python package.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import socket
+
+
+class Transport:
+
+    """Transport
+
+    Creates the sockets for one kind of link. Clients and servers take a
+    transport so that the same OBEX session can run over Bluetooth, over IP
+    or between processes on one machine.
+
+    Addresses are given as an address and a port, as for Bluetooth. Ports
+    that are None are replaced by default_port.
+    """
+
+    # Whether services on this transport can be advertised with SDP.
+    bluetooth = False
+
+    default_port = None
+
+    def create_socket(self):
+
+        raise NotImplementedError()
+
+    def socket_address(self, address, port=None):
+
+        if port is None:
+            port = self.default_port
+        return (address, port)
+
+    def connect(self, address, port=None):
+
+        """Returns a socket connected to the server at address and port."""
+
+        socket_ = self.create_socket()
+        try:
+            socket_.connect(self.socket_address(address, port))
+        except OSError:
+            socket_.close()
+            raise
+        return socket_
+
+    def listen(self, address, port=None, backlog=1):
+
+        """Returns a socket listening on address and port."""
+
+        socket_ = self.create_socket()
+        try:
+            socket_.bind(self.socket_address(address, port))
+            socket_.listen(backlog)
+        except OSError:
+            socket_.close()
+            raise
+        return socket_
+
+    def mtu(self, socket_):
+
+        """Returns the largest packet that can be sent on socket_ in one
+        piece, or None if the transport does not limit it."""
+
+        _ = socket_
+        return None
+
+
+class RFCOMMTransport(Transport):
+
+    """RFCOMM, the transport used by most OBEX profiles."""
+
+    bluetooth = True
+
+    def create_socket(self):
+
+        from common import Socket
+        return Socket()
+
+
+class L2CAPTransport(Transport):
+
+    """L2CAPTransport(omtu=None, imtu=None, mode=None, max_tx=None,
+                      tx_win_size=None)
+
+    L2CAP, as used by GOEP 2.0 profiles such as the BIP cover art service.
+    The options given are set on each socket before it is bound or
+    connected; options left as None keep the values of the Bluetooth stack.
+    """
+
+    bluetooth = True
+    default_port = 0x1021
+
+    # Positions of the options in the list used by bluetooth.get_l2cap_options.
+    option_index = {"omtu": 0, "imtu": 1, "flush_to": 2, "mode": 3,
+                    "max_tx": 5, "tx_win_size": 6}
+
+    def __init__(self, **options):
+
+        for name in options:
+            if name not in self.option_index:
+                raise TypeError("unknown L2CAP option %r" % name)
+        self.options = options
+
+    def create_socket(self):
+
+        import bluetooth
+
+        socket_ = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+        if self.options:
+            opt = bluetooth.get_l2cap_options(socket_)
+            for name, value in self.options.items():
+                if value is not None:
+                    opt[self.option_index[name]] = value
+            bluetooth.set_l2cap_options(socket_, opt)
+        return socket_
+
+    def mtu(self, socket_):
+
+        import bluetooth
+
+        opt = bluetooth.get_l2cap_options(socket_)
+        return min(opt[0], opt[1])
+
+
+class TCPTransport(Transport):
+
+    """OBEX over TCP/IP, on the port assigned to OBEX (650) by default."""
+
+    default_port = 650
+
+    def create_socket(self):
+
+        socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return socket_
+
+
+class UnixTransport(Transport):
+
+    """UnixTransport(type_=socket.SOCK_SEQPACKET)
+
+    Unix domain sockets, addressed by path; the port is ignored. The default
+    socket type keeps packet boundaries, like L2CAP.
+    """
+
+    def __init__(self, type_=socket.SOCK_SEQPACKET):
+
+        self.type = type_
+
+    def create_socket(self):
+
+        return socket.socket(socket.AF_UNIX, self.type)
+
+    def socket_address(self, address, port=None):
+
+        return address
+
+    def listen(self, address, port=None, backlog=1):
+
+        # Remove the socket file left behind by an earlier server.
+        if os.path.exists(address):
+            os.unlink(address)
+        return Transport.listen(self, address, port, backlog)
+
+    def pair(self):
+
+        """Returns a pair of connected sockets, for running a client and a
+        server in one process."""
+
+        return socket.socketpair(socket.AF_UNIX, self.type)
+
+
+transport_dict = {
+    "rfcomm": RFCOMMTransport,
+    "l2cap": L2CAPTransport,
+    "tcp": TCPTransport,
+    "unix": UnixTransport
+}